@@ -14,8 +14,8 @@ except ImportError:
     __version__ = "dev"
 
 from .imr import FunctionArgument, FunctionSpec
-from .query import Query
-from .tool import BowlerTool
+from .query import Query, run_all
+from .tool import BowlerTool, Pool
 from .types import (
     ARG_ELEMS,
     ARG_END,
@@ -34,6 +34,7 @@ from .types import (
     Fixers,
     Hunk,
     IMRError,
+    Match,
     Processor,
     Stringish,
 )
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import re
+import sys
+import sysconfig
+import tempfile
+import types
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import attr
+import fissix
+from fissix.pgen2.grammar import Grammar
+from fissix.pytree import Node
+
+from . import __version__
+from .types import Filename, Hunk
+
+log = logging.getLogger(__name__)
+
+# re.Pattern and types.MethodDescriptorType need python 3.7
+Pattern = type(re.compile(""))
+MethodDescriptor = type(str.join)
+
+
+def default_cache_dir(kind: str = "parse") -> Path:
+    """Where cache entries of the given kind live when no directory is given."""
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(root) / "bowler" / kind
+
+
+class Unstable(Exception):
+    """Raised when an object has no representation that is stable across runs."""
+
+
+# globals that functions are described by the value of, rather than by name
+DESCRIBED_GLOBALS = (
+    type(None),
+    bool,
+    int,
+    float,
+    str,
+    bytes,
+    tuple,
+    frozenset,
+    Pattern,
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    functools.partial,
+)
+
+
+# packages whose code is covered by `DiskCache.version`, besides the stdlib
+VERSIONED_PACKAGES = ("bowler", "fissix")
+STDLIB_PATHS = tuple(
+    os.path.join(sysconfig.get_paths()[key], "") for key in ("stdlib", "platstdlib")
+)
+
+
+def _versioned(name: Optional[str]) -> bool:
+    """Whether a module's code only changes along with `DiskCache.version`."""
+    if not name:
+        return False
+    if name.partition(".")[0] in VERSIONED_PACKAGES:
+        return True
+    module = sys.modules.get(name)
+    if module is None:
+        return False
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return name in sys.builtin_module_names
+    return path.startswith(STDLIB_PATHS) and "site-packages" not in path
+
+
+def _canonical(obj: Any, seen: Dict[int, int]) -> Any:
+    """Reduce an object to plain data that only changes when its behavior might.
+
+    Functions are described by their code, defaults, closures and the globals
+    they reference, and classes by their source. Modules, and module level
+    objects other than code and constants, are identified by name, so only
+    those of the stdlib, bowler and fissix are allowed. Other objects fall back
+    to pickle, which covers the compiled patterns and constants that queries
+    close over. Anything else raises `Unstable`.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return (type(obj).__name__, obj)
+
+    if id(obj) in seen:
+        return ("ref", seen[id(obj)])
+    seen[id(obj)] = len(seen)
+
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, [_canonical(item, seen) for item in obj])
+    if isinstance(obj, (set, frozenset)):
+        return ("set", sorted(repr(_canonical(item, seen)) for item in obj))
+    if isinstance(obj, dict):
+        return (
+            "dict",
+            sorted(
+                (repr(_canonical(k, seen)), _canonical(v, seen)) for k, v in obj.items()
+            ),
+        )
+    if isinstance(obj, types.ModuleType):
+        if not _versioned(obj.__name__):
+            raise Unstable(f"can't describe module {obj.__name__} by name")
+        return ("module", obj.__name__)
+    if isinstance(obj, types.CodeType):
+        return (
+            "code",
+            obj.co_code,
+            obj.co_names,
+            [_canonical(const, seen) for const in obj.co_consts],
+        )
+    if isinstance(obj, types.FunctionType):
+        names: Set[str] = set()
+        code_objects = [obj.__code__]
+        while code_objects:
+            code = code_objects.pop()
+            names.update(code.co_names)
+            code_objects.extend(
+                c for c in code.co_consts if isinstance(c, types.CodeType)
+            )
+        referenced = {}
+        for name in sorted(names):
+            if name not in obj.__globals__:
+                continue
+            value = obj.__globals__[name]
+            if isinstance(value, DESCRIBED_GLOBALS):
+                referenced[name] = _canonical(value, seen)
+            elif (
+                _versioned(obj.__module__)
+                or type(value).__module__.partition(".")[0] in VERSIONED_PACKAGES
+            ):
+                # module level state and singletons are known by name, since
+                # their contents may change as a side effect of running
+                referenced[name] = ("global", obj.__module__, name)
+            else:
+                raise Unstable(f"can't describe {obj.__module__}.{name} by name")
+        closure = [cell.cell_contents for cell in obj.__closure__ or ()]
+        return (
+            "function",
+            obj.__module__,
+            obj.__qualname__,
+            _canonical(obj.__code__, seen),
+            _canonical(obj.__defaults__, seen),
+            _canonical(obj.__kwdefaults__, seen),
+            _canonical(closure, seen),
+            sorted(referenced.items()),
+        )
+    if isinstance(obj, (types.BuiltinFunctionType, MethodDescriptor)):
+        return ("builtin", getattr(obj, "__module__", None), obj.__qualname__)
+    if isinstance(obj, functools.partial):
+        return (
+            "partial",
+            _canonical(obj.func, seen),
+            _canonical(obj.args, seen),
+            _canonical(obj.keywords, seen),
+        )
+    if isinstance(obj, type):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError) as e:
+            raise Unstable(f"can't find source for {obj.__qualname__}") from e
+        return ("class", obj.__module__, obj.__qualname__, source)
+    if isinstance(obj, Pattern):
+        return ("pattern", obj.pattern, obj.flags)
+    if attr.has(type(obj)):
+        return (
+            "attrs",
+            _canonical(type(obj), seen),
+            [_canonical(getattr(obj, f.name), seen) for f in attr.fields(type(obj))],
+        )
+
+    try:
+        data = pickle.dumps(obj, protocol=4)
+    except Exception as e:
+        raise Unstable(f"can't describe {obj!r}") from e
+    return ("object", _canonical(type(obj), seen), data)
+
+
+def fingerprint(obj: Any) -> Optional[str]:
+    """Stable hash of an object and everything it depends on, see `_canonical`.
+
+    Returns None if the object can't be described reliably, or if its
+    description depends on memory addresses.
+    """
+    try:
+        description = repr(_canonical(obj, {}))
+    except (Unstable, RecursionError) as e:
+        log.debug(f"not caching results: {e}")
+        return None
+    if re.search(r" at 0x[0-9a-f]+>", description):
+        log.debug("not caching results: transforms depend on object identity")
+        return None
+    return hashlib.sha256(description.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class DiskCache:
+    """Content addressed, on-disk cache of pickled values.
+
+    Entries are written atomically, touched when read, and `prune` evicts the
+    least recently used ones once the cache grows past `max_bytes`. Counts of
+    hits and misses are kept on the instance.
+    """
+
+    KIND = "cache"
+    MAX_BYTES = 512 * 1024 * 1024
+    SUFFIX = ".pickle"
+
+    def __init__(
+        self, path: Union[str, Path, None] = None, max_bytes: Optional[int] = None
+    ) -> None:
+        self.path = Path(path) if path else default_cache_dir(self.KIND)
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.version = (
+            f"{__version__}:{fissix.__version__}:"
+            f"{sys.version_info[0]}.{sys.version_info[1]}:{pickle.HIGHEST_PROTOCOL}"
+        )
+
+    def digest(self, *parts: str) -> str:
+        digest = hashlib.sha256(self.version.encode())
+        for part in parts:
+            digest.update(b"\0")
+            digest.update(part.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}{self.SUFFIX}"
+
+    def get(self, key: str) -> Any:
+        """Load a cached value, or return None and count a miss."""
+        path = self.entry(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            log.debug(f"discarding cache entry {path}: {e}")
+            self.misses += 1
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+
+        try:
+            os.utime(path)  # mark as recently used for `prune`
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Store a value; failures only cost recomputing it next time."""
+        path = self.entry(key)
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except (OSError, RecursionError, pickle.PicklingError) as e:
+            log.debug(f"failed to cache value at {path}: {e}")
+
+    def prune(self) -> int:
+        """Evict least recently used entries until under `max_bytes`.
+
+        Returns the number of entries removed.
+        """
+        entries: List[Tuple[float, int, Path]] = []
+        total = 0
+        try:
+            for subdir in os.scandir(self.path):
+                if not subdir.is_dir():
+                    continue
+                for item in os.scandir(subdir.path):
+                    if item.name.endswith(self.SUFFIX):
+                        stat = item.stat()
+                        entries.append((stat.st_mtime, stat.st_size, Path(item.path)))
+                        total += stat.st_size
+        except FileNotFoundError:
+            return 0
+
+        removed = 0
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        if removed:
+            log.debug(f"pruned {removed} entries from {self.KIND} cache {self.path}")
+        return removed
+
+
+class ParseCache(DiskCache):
+    """Cache of parsed syntax trees.
+
+    Trees are keyed by the source text, the grammar it was parsed with, and
+    the fissix and python versions, so a changed file or upgraded parser never
+    sees a stale tree.
+    """
+
+    KIND = "parse"
+
+    def key(self, data: str, grammar: Grammar) -> str:
+        """Key for source text parsed with the given grammar."""
+        return self.digest(",".join(sorted(grammar.keywords)), data)
+
+    def get(self, key: str) -> Optional[Node]:
+        return super().get(key)
+
+
+# (hunks, new text or None if unchanged)
+CachedResult = Tuple[List[Hunk], Optional[str]]
+
+
+class ResultCache(DiskCache):
+    """Cache of the hunks a set of transforms produced for a file.
+
+    Results are keyed by the file's name and contents, and the `fingerprint`
+    of the transforms, so files whose content and query are unchanged don't
+    need to be parsed or transformed again. This assumes that filters and
+    modifiers only depend on the nodes and filename they're given.
+    """
+
+    KIND = "results"
+
+    def key(self, filename: Filename, data: str, transforms: str) -> str:
+        """Key for a file refactored by transforms with the given fingerprint."""
+        return self.digest(transforms, filename, data)
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        return super().get(key)
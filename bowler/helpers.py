@@ -6,13 +6,25 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
-from typing import List, Optional, Sequence, Union
+import os
+import re
+import subprocess
+from typing import Any, List, Optional, Pattern, Sequence, Union
 
 import click
 from fissix.pgen2.token import tok_name
 from fissix.pytree import Leaf, Node, type_repr
 
-from .types import LN, SYMBOL, TOKEN, Capture, Filename, FilenameMatcher
+from .types import (
+    LN,
+    SYMBOL,
+    TOKEN,
+    Capture,
+    Filename,
+    FilenameMatcher,
+    GitError,
+    Match,
+)
 
 log = logging.getLogger(__name__)
 
@@ -99,6 +111,42 @@ def print_tree(
             click.secho(f"results[{repr(key)}] = {value}", fg="red")
 
 
+def summarize_capture(value: Any, limit: int = 80) -> str:
+    """Source of a captured node or list of nodes, on one line and shortened."""
+    nodes = value if isinstance(value, list) else [value]
+    text = "".join(str(node) for node in nodes)
+    if nodes and isinstance(nodes[0], (Leaf, Node)):
+        text = text[len(nodes[0].prefix) :]
+    text = " ".join(text.split())
+    if len(text) > limit:
+        text = text[: limit - 3] + "..."
+    return text
+
+
+def match_record(node: LN, capture: Capture, filename: Filename) -> Match:
+    """Describe where a query matched, without holding on to the tree."""
+    leaf = node if isinstance(node, Leaf) else next(node.leaves(), None)
+    if leaf is not None:
+        line, column = leaf.lineno, leaf.column
+    else:
+        line, column = node.get_lineno() or 0, 0
+    if isinstance(node, Leaf):
+        node_type = tok_name.get(node.type, str(node.type))
+    else:
+        node_type = str(type_repr(node.type))
+    captures = {
+        key: summarize_capture(value) for key, value in capture.items() if key != "node"
+    }
+    return Match(filename, line, column, node_type, captures)
+
+
+def format_match(match: Match) -> str:
+    """One line describing a match, like `path:line:column: type name='value'`."""
+    parts = [f"{match.filename}:{match.line}:{match.column}:", match.node_type]
+    parts.extend(f"{key}={value!r}" for key, value in match.captures.items())
+    return " ".join(parts)
+
+
 def dotted_parts(name: str) -> List[str]:
     pre, dot, post = name.partition(".")
     if post:
@@ -224,3 +272,129 @@ def filename_endswith(ext: Union[Sequence, str]) -> FilenameMatcher:
         return any(filename.endswith(e) for e in ext)
 
     return inner
+
+
+def glob_pattern(globs: Sequence[str]) -> Optional[Pattern]:
+    """Compile globs for paths relative to a searched directory into one regex.
+
+    Paths use '/' as a separator. `**` matches any number of directories,
+    while `*`, `?` and `[...]` only match within a single name. Returns None if
+    there are no globs.
+    """
+    regexes = []
+    for glob in globs:
+        glob = glob[2:] if glob.startswith("./") else glob
+        regex = ""
+        i = 0
+        while i < len(glob):
+            if glob.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif glob.startswith("/**", i) and i + 3 == len(glob):
+                regex += "(?:/.*)?"
+                i += 3
+            elif glob.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif glob[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif glob[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif glob[i] == "[" and "]" in glob[i + 2 :]:
+                end = glob.index("]", i + 2)
+                chars = glob[i + 1 : end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += f"[{chars.replace(chr(92), chr(92) * 2)}]"
+                i = end + 1
+            else:
+                regex += re.escape(glob[i])
+                i += 1
+        regexes.append(f"(?:{regex})")
+    if not regexes:
+        return None
+    return re.compile("|".join(regexes))
+
+
+def git(*args: str, cwd: str = ".") -> str:
+    """Run a command with the local git binary and return its output."""
+    try:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            errors="surrogateescape",
+            check=True,
+        )
+    except FileNotFoundError as e:
+        raise GitError(f"git not found: {e}") from e
+    except subprocess.CalledProcessError as e:
+        raise GitError(f"git {' '.join(args)} failed: {e.stderr.strip()}") from e
+    return result.stdout
+
+
+def changed_files(path: str, revision: str) -> List[Filename]:
+    """Files in `path` that were added or modified since `revision`.
+
+    Changes are relative to the merge base of `revision` and HEAD, and include
+    uncommitted and untracked files. Like `BowlerTool.refactor_dir`, files and
+    directories starting with '.' are skipped.
+    """
+    if os.path.isdir(path):
+        cwd, spec = path, "."
+    else:
+        cwd, spec = os.path.dirname(path) or ".", os.path.basename(path)
+
+    base = git("merge-base", revision, "HEAD", cwd=cwd).strip()
+    names = git(
+        "diff",
+        "--name-only",
+        "--relative",
+        "-z",
+        "--diff-filter=ACMRT",
+        base,
+        "--",
+        spec,
+        cwd=cwd,
+    ).split("\0")
+    names += git(
+        "ls-files", "--others", "--exclude-standard", "-z", "--", spec, cwd=cwd
+    ).split("\0")
+
+    filenames = set()
+    for name in names:
+        if not name:
+            continue
+        if spec != ".":
+            filenames.add(Filename(path))
+            continue
+        parts = name.split("/")  # git always uses forward slashes
+        if not any(part.startswith(".") for part in parts):
+            filenames.add(Filename(os.path.join(path, *parts)))
+    return sorted(filenames)
+
+
+def tracked_files(path: str) -> List[str]:
+    """Files in directory `path` that git knows about, without walking it.
+
+    Lists files in the index, and untracked files that aren't ignored. Names
+    are relative to `path`, with forward slashes, and sorted in the order
+    `BowlerTool.walk` would find them: each directory's files by name, then
+    its subdirectories. Raises `GitError` outside of a git checkout.
+    """
+    output = git(
+        "ls-files", "-z", "--cached", "--others", "--exclude-standard", cwd=path
+    )
+
+    def walk_order(name: str) -> str:
+        # mark directories with \1 and files with \0, so files come first
+        head, _, tail = name.rpartition("/")
+        if not head:
+            return "\0" + tail
+        return "\1" + head.replace("/", "\1") + "\0" + tail
+
+    return sorted({name for name in output.split("\0") if name}, key=walk_order)
@@ -13,20 +13,59 @@ import sys
 import unittest
 from importlib.abc import Loader
 from pathlib import Path
-from typing import List, cast
+from typing import List, Optional, cast
 
 import click
 
+from .helpers import format_match
 from .query import Query
 from .tool import BowlerTool
-from .types import START, SYMBOL, TOKEN
+from .types import START, SYMBOL, TOKEN, GitError
 
 
 @click.group(invoke_without_command=True)
 @click.option("--debug/--quiet", default=False, help="Logging output level")
 @click.option("--version", "-V", is_flag=True, help="Print version string and exit")
+@click.option(
+    "--parse-cache",
+    type=click.Path(file_okay=False),
+    help="Cache parsed syntax trees in this directory",
+)
+@click.option(
+    "--result-cache",
+    type=click.Path(file_okay=False),
+    help="Cache the changes made to each file in this directory",
+)
+@click.option(
+    "--validate",
+    type=click.Choice(["compile", "incremental", "full"]),
+    help="How to check transformed files for syntax errors",
+)
+@click.option(
+    "--discovery",
+    type=click.Choice(["walk", "git"]),
+    help="How to find files in directories",
+)
+@click.option(
+    "--fsync", is_flag=True, help="Flush written files to disk before exiting"
+)
+@click.option(
+    "--journal",
+    type=click.Path(dir_okay=False),
+    help="List temporary files in this file, to clean up after interrupted runs",
+)
 @click.pass_context
-def main(ctx: click.Context, debug: bool, version: bool) -> None:
+def main(
+    ctx: click.Context,
+    debug: bool,
+    version: bool,
+    parse_cache: Optional[str],
+    result_cache: Optional[str],
+    validate: Optional[str],
+    discovery: Optional[str],
+    fsync: bool,
+    journal: Optional[str],
+) -> None:
     """Safe Python code modification and refactoring."""
     if version:
         from bowler import __version__
@@ -38,6 +77,19 @@ def main(ctx: click.Context, debug: bool, version: bool) -> None:
         BowlerTool.NUM_PROCESSES = 1
         BowlerTool.IN_PROCESS = True
 
+    if parse_cache:
+        BowlerTool.PARSE_CACHE = parse_cache
+    if result_cache:
+        BowlerTool.RESULT_CACHE = result_cache
+    if validate:
+        BowlerTool.VALIDATE = validate
+    if discovery:
+        BowlerTool.DISCOVERY = discovery
+    if fsync:
+        BowlerTool.FSYNC = True
+    if journal:
+        BowlerTool.JOURNAL = journal
+
     root = logging.getLogger()
     if not root.hasHandlers():
         logging.addLevelName(logging.DEBUG, "DBG")
@@ -66,9 +118,12 @@ def dump(selector_pattern: bool, paths: List[str]) -> None:
 
 @main.command()
 @click.option("-i", "--interactive", is_flag=True)
+@click.option("--since", metavar="REV", help="Only process files changed since REV")
 @click.argument("query", required=False)
 @click.argument("paths", type=click.Path(exists=True), nargs=-1, required=False)
-def do(interactive: bool, query: str, paths: List[str]) -> None:
+def do(
+    interactive: bool, query: str, paths: List[str], since: Optional[str] = None
+) -> None:
     """Execute a query or enter interactive mode."""
     if not query or query == "-":
 
@@ -95,11 +150,44 @@ def do(interactive: bool, query: str, paths: List[str]) -> None:
             exc = click.ClickException("query failed")
             exc.exit_code = result.retcode
             raise exc
-        result.diff(interactive=interactive)
+        if since:
+            result.since(since)
+        try:
+            result.diff(interactive=interactive)
+        except GitError as e:
+            raise click.ClickException(str(e))
     elif result:
         click.echo(repr(result))
 
 
+@main.command()
+@click.option("--since", metavar="REV", help="Only search files changed since REV")
+@click.argument("query", required=True)
+@click.argument("paths", type=click.Path(exists=True), nargs=-1, required=False)
+def find(query: str, paths: List[str], since: Optional[str] = None) -> None:
+    """Print where a query matches, without changing anything.
+
+    Searches <paths> if given, rather than the query's own paths.
+    """
+    code = compile(query, "<console>", "eval")
+    result = eval(code)  # noqa eval() - developer tool, like `do`
+
+    if not isinstance(result, Query):
+        raise click.ClickException("query must evaluate to a Query")
+    if paths:
+        result.paths = list(paths)
+    if since:
+        result.since(since)
+    try:
+        for match in result.iter_matches():
+            click.echo(format_match(match))
+    except GitError as e:
+        raise click.ClickException(str(e))
+    if result.retcode:
+        click.echo("Error: query failed", err=True)
+        click.get_current_context().exit(result.retcode)
+
+
 @main.command()
 @click.argument("codemod", required=True, type=str)
 @click.argument("argv", required=False, type=str, nargs=-1)
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Match fixer patterns with Python closures instead of fissix's generators.
+
+fissix interprets patterns with nested generators, and every candidate match
+copies its results dict, so even a plain sequence of leaves goes through the
+generic wildcard machinery. Here each pattern is compiled once to closures that
+try the same alternatives in the same order, and record captures on a trail
+that is only turned into a dict once the whole pattern matches. The first
+match found, and so the captures, are the same as fissix's.
+
+Unlike fissix, states that failed to match are remembered, so patterns with
+several wildcards don't retry the same ways of splitting up a node's children.
+"""
+
+import itertools
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from fissix.pytree import (
+    HUGE,
+    BasePattern,
+    Leaf,
+    LeafPattern,
+    NegatedPattern,
+    NodePattern,
+    WildcardPattern,
+)
+
+from .pattern import HeadDispatchPattern
+from .types import LN
+
+# captures in the order fissix would add them to the results
+Trail = List[Tuple[str, Any]]
+# whether a pattern matches a single node, adding its captures to the trail
+NodeMatcher = Callable[[LN, Trail], bool]
+# called with each index a sequence match could end at, until it returns True
+Continuation = Callable[[int], bool]
+# states of a sequence match known to fail, for one continuation, or None;
+# each memoized state is numbered from a base taken from `_states`
+Failures = Optional[Set[int]]
+# matches a sequence of patterns to nodes[i:], passing each end to the continuation
+SequenceMatcher = Callable[[List[LN], int, Trail, Continuation, Failures], bool]
+# whether a pattern matches a node, updating the results like `BasePattern.match`
+Matcher = Callable[[LN, Optional[Dict[str, Any]]], bool]
+
+_states = itertools.count(1)
+
+
+def _bounds(pattern: BasePattern) -> Tuple[int, int]:
+    """The fewest and most nodes a pattern can match in a sequence."""
+    if isinstance(pattern, (LeafPattern, NodePattern)):
+        return 1, 1
+    if isinstance(pattern, NegatedPattern):
+        return 0, 0
+    if isinstance(pattern, WildcardPattern):
+        if pattern.content is None:
+            return pattern.min, pattern.max
+        lengths = [_sequence_bounds(alternative) for alternative in pattern.content]
+        low = min(length[0] for length in lengths) * pattern.min
+        high = max(length[1] for length in lengths) * pattern.max
+        return low, min(high, HUGE)
+    return 0, HUGE
+
+
+def _sequence_bounds(patterns: Sequence[BasePattern]) -> Tuple[int, int]:
+    low = high = 0
+    for pattern in patterns:
+        pattern_low, pattern_high = _bounds(pattern)
+        low += pattern_low
+        high = min(high + pattern_high, HUGE)
+    return low, high
+
+
+def _flatten(patterns: Sequence[BasePattern]) -> List[BasePattern]:
+    """Inline unnamed groups that match exactly once, like `( a b )`."""
+    flat: List[BasePattern] = []
+    for pattern in patterns:
+        if (
+            type(pattern) is WildcardPattern
+            and pattern.content is not None
+            and len(pattern.content) == 1
+            and (pattern.min, pattern.max) == (1, 1)
+            and not pattern.name
+        ):
+            flat.extend(_flatten(pattern.content[0]))
+        else:
+            flat.append(pattern)
+    return flat
+
+
+def _ambiguous(pattern: BasePattern) -> bool:
+    """Whether a pattern can match the start of a sequence in more than one way."""
+    if isinstance(pattern, (LeafPattern, NodePattern, NegatedPattern)):
+        return False
+    if type(pattern) is WildcardPattern:
+        if pattern.content is None:
+            return pattern.min != pattern.max
+        return pattern.min != pattern.max or _repeats_ambiguously(pattern)
+    return True
+
+
+def _repeats_ambiguously(pattern: WildcardPattern) -> bool:
+    """Whether a repetition can reach the same index in more than one way."""
+    return len(pattern.content) > 1 or any(
+        any(_ambiguous(p) for p in alternative) for alternative in pattern.content
+    )
+
+
+def _needs_memo(patterns: Sequence[BasePattern]) -> bool:
+    """Whether matching a sequence can try the same state more than once."""
+    patterns = _flatten(patterns)
+    if sum(1 for p in patterns if _ambiguous(p)) > 1:
+        return True
+    return any(
+        type(p) is WildcardPattern
+        and p.content is not None
+        and p.name != "bare_name"
+        and (_repeats_ambiguously(p) or any(_needs_memo(alt) for alt in p.content))
+        for p in patterns
+    )
+
+
+def _nesting(patterns: Sequence[BasePattern]) -> int:
+    """How deeply repetitions of groups of varying length nest in a sequence.
+
+    Doesn't look at the children of nodes, which are matched separately.
+    """
+    depth = 0
+    for pattern in patterns:
+        if isinstance(pattern, NegatedPattern) and pattern.content is not None:
+            depth = max(depth, _nesting([pattern.content]))
+        elif isinstance(pattern, WildcardPattern) and pattern.content is not None:
+            inner = max(_nesting(alternative) for alternative in pattern.content)
+            if pattern.max > 1 and any(
+                len(set(_sequence_bounds(alternative))) > 1
+                for alternative in pattern.content
+            ):
+                inner += 1
+            depth = max(depth, inner)
+    return depth
+
+
+def _subpatterns(pattern: BasePattern) -> Iterator[BasePattern]:
+    yield pattern
+    if isinstance(pattern.content, BasePattern):
+        yield from _subpatterns(pattern.content)
+    elif isinstance(pattern, NodePattern) and pattern.content is not None:
+        for child in pattern.content:
+            yield from _subpatterns(child)
+    elif isinstance(pattern, WildcardPattern) and pattern.content is not None:
+        for alternative in pattern.content:
+            for child in alternative:
+                yield from _subpatterns(child)
+
+
+def expensive(pattern: BasePattern) -> bool:
+    """Whether a pattern is predicted to be slow to match, even when compiled.
+
+    Compiled matchers memoize failed states, so matching a node's children is
+    at worst quadratic in their number, but each level of nested repetitions
+    of groups with a varying length, like `( ( any* trailer )* any )*`, adds
+    another factor.
+    """
+    if _nesting([pattern]) > 1:
+        return True
+    return any(
+        _nesting(p.content) > 1
+        for p in _subpatterns(pattern)
+        if isinstance(p, NodePattern) and p.content is not None
+    )
+
+
+def compile_node(pattern: BasePattern) -> NodeMatcher:
+    """Compile a pattern that matches exactly one node."""
+    name = pattern.name
+    node_type = pattern.type
+
+    if isinstance(pattern, LeafPattern):
+        value = pattern.content
+
+        def match_leaf(node: LN, trail: Trail) -> bool:
+            if not isinstance(node, Leaf):
+                return False
+            if node_type is not None and node.type != node_type:
+                return False
+            if value is not None and node.value != value:
+                return False
+            if name:
+                trail.append((name, node))
+            return True
+
+        return match_leaf
+
+    assert isinstance(pattern, NodePattern), pattern
+    if pattern.content is None:
+
+        def match_any(node: LN, trail: Trail) -> bool:
+            if node_type is not None and node.type != node_type:
+                return False
+            if name:
+                trail.append((name, node))
+            return True
+
+        return match_any
+
+    content = _flatten(pattern.content)
+    if all(isinstance(p, (LeafPattern, NodePattern)) for p in content):
+        children_matchers = [compile_node(p) for p in content]
+        count = len(children_matchers)
+
+        def match_children(node: LN, trail: Trail) -> bool:
+            if node_type is not None and node.type != node_type:
+                return False
+            if len(node.children) != count:
+                return False
+            mark = len(trail)
+            for matcher, child in zip(children_matchers, node.children):
+                if not matcher(child, trail):
+                    del trail[mark:]
+                    return False
+            if name:
+                trail.append((name, node))
+            return True
+
+        return match_children
+
+    sequence = compile_sequence(content, anchored=True)
+    low, high = _sequence_bounds(content)
+    memoize = _needs_memo(content)
+
+    def match_sequence(node: LN, trail: Trail) -> bool:
+        if node_type is not None and node.type != node_type:
+            return False
+        children = node.children
+        end = len(children)
+        if end < low or end > high:
+            return False
+        failed: Failures = set() if memoize else None
+        if not sequence(children, 0, trail, lambda i: i == end, failed):
+            return False
+        if name:
+            trail.append((name, node))
+        return True
+
+    return match_sequence
+
+
+def _memoized(sequence: SequenceMatcher) -> SequenceMatcher:
+    """Remember the indexes a sequence failed to match from, see `Failures`."""
+
+    base = next(_states) << 64
+
+    def match_memoized(
+        nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+    ) -> bool:
+        if failed is None:
+            return sequence(nodes, i, trail, k, failed)
+        key = base + i
+        if key in failed:
+            return False
+        if sequence(nodes, i, trail, k, failed):
+            return True
+        failed.add(key)
+        return False
+
+    return match_memoized
+
+
+def compile_sequence(
+    patterns: Sequence[BasePattern], anchored: bool = False, ambiguous: int = 0
+) -> SequenceMatcher:
+    """Compile a sequence of patterns, trying matches in fissix's order.
+
+    When `anchored`, the sequence must match every remaining node, so
+    wildcards only try counts that leave enough nodes for the rest of it.
+    Matchers leave the trail as they found it when they return False.
+
+    Failed states are memoized, see `Failures`, so matching takes polynomial
+    time: `ambiguous` counts the preceding patterns that can match in more
+    than one way, and the rest of the sequence is memoized after the second.
+    """
+    patterns = _flatten(patterns)
+    if not patterns:
+        return lambda nodes, i, trail, k, failed: k(i)
+
+    first = patterns[0]
+    if _ambiguous(first):
+        ambiguous += 1
+        if type(first) is WildcardPattern and first.content is not None:
+            # a repetition can end at the same index in several ways by itself
+            ambiguous += _repeats_ambiguously(first)
+    rest = compile_sequence(patterns[1:], anchored, ambiguous)
+    rest_low, rest_high = _sequence_bounds(patterns[1:]) if anchored else (0, HUGE)
+    name = first.name
+
+    if isinstance(first, (LeafPattern, NodePattern)):
+        node_matcher = compile_node(first)
+
+        def match_node(
+            nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+        ) -> bool:
+            if i >= len(nodes):
+                return False
+            mark = len(trail)
+            if node_matcher(nodes[i], trail) and rest(nodes, i + 1, trail, k, failed):
+                return True
+            del trail[mark:]
+            return False
+
+        return match_node
+
+    if isinstance(first, NegatedPattern):
+        negated = first.content
+        inner = compile_sequence([negated]) if negated is not None else None
+
+        def match_negated(
+            nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+        ) -> bool:
+            if inner is None:
+                if i != len(nodes):
+                    return False
+            elif inner(nodes, i, [], lambda j: True, set()):
+                return False
+            return rest(nodes, i, trail, k, failed)
+
+        return match_negated
+
+    # the rest of the sequence can be reached at the same index in several ways
+    if ambiguous > 1:
+        rest = _memoized(rest)
+
+    if (
+        type(first) is WildcardPattern
+        and first.content is None
+        and first.name != "bare_name"
+    ):
+        wildcard_min, wildcard_max = first.min, first.max
+
+        def match_wildcard(
+            nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+        ) -> bool:
+            available = len(nodes) - i
+            low = max(wildcard_min, available - rest_high)
+            high = min(wildcard_max, available - rest_low)
+            mark = len(trail)
+            for count in range(low, high + 1):
+                if name:
+                    trail.append((name, nodes[i : i + count]))
+                if rest(nodes, i + count, trail, k, failed):
+                    return True
+                del trail[mark:]
+            return False
+
+        return match_wildcard
+
+    if (
+        type(first) is WildcardPattern
+        and first.content is not None
+        and first.name != "bare_name"
+    ):
+        repeat_min, repeat_max = first.min, first.max
+        repeated = _flatten(first.content[0])
+        if len(first.content) == 1 and len(repeated) == 1:
+            if isinstance(repeated[0], (LeafPattern, NodePattern)):
+                node_matcher = compile_node(repeated[0])
+
+                def match_nodes(
+                    nodes: List[LN],
+                    i: int,
+                    trail: Trail,
+                    k: Continuation,
+                    failed: Failures,
+                ) -> bool:
+                    # one way to match each node, so there's nothing to backtrack
+                    mark = len(trail)
+                    j = i
+                    while True:
+                        if j - i >= repeat_min:
+                            level = len(trail)
+                            if name:
+                                trail.append((name, nodes[i:j]))
+                            if rest(nodes, j, trail, k, failed):
+                                return True
+                            del trail[level:]
+                        if (
+                            j - i >= repeat_max
+                            or j >= len(nodes)
+                            or not node_matcher(nodes[j], trail)
+                        ):
+                            break
+                        j += 1
+                    del trail[mark:]
+                    return False
+
+                return match_nodes
+
+        alternatives = [compile_sequence(alt) for alt in first.content]
+        memoize_states = _repeats_ambiguously(first)
+        base = next(_states) << 64
+        memoize_alternatives = any(_needs_memo(alt) for alt in first.content)
+
+        def match_repeat(
+            nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+        ) -> bool:
+            def repeat(j: int, count: int) -> bool:
+                key = None
+                if memoize_states and failed is not None:
+                    # past the minimum, the count only matters if there's a maximum
+                    if count >= repeat_min and repeat_max == HUGE:
+                        count_class = repeat_min
+                    else:
+                        count_class = count
+                    key = base + (count_class << 32) + j
+                    if key in failed:
+                        return False
+                mark = len(trail)
+                if count >= repeat_min:
+                    if name:
+                        trail.append((name, nodes[i:j]))
+                    if rest(nodes, j, trail, k, failed):
+                        return True
+                    del trail[mark:]
+                if count < repeat_max:
+                    # the alternatives all continue the same way from here
+                    scope: Failures = set() if memoize_alternatives else None
+                    for alternative in alternatives:
+                        if alternative(
+                            nodes,
+                            j,
+                            trail,
+                            # an empty repetition can't lead anywhere new
+                            lambda end: (end > j or count < repeat_min)
+                            and repeat(end, count + 1),
+                            scope,
+                        ):
+                            return True
+                if key is not None:
+                    failed.add(key)  # type: ignore
+                return False
+
+            return repeat(i, 0)
+
+        return match_repeat
+
+    # anything else is matched by fissix itself
+    def match_generic(
+        nodes: List[LN], i: int, trail: Trail, k: Continuation, failed: Failures
+    ) -> bool:
+        mark = len(trail)
+        for count, results in first.generate_matches(nodes[i:]):
+            trail.extend(results.items())
+            if rest(nodes, i + count, trail, k, failed):
+                return True
+            del trail[mark:]
+        return False
+
+    return match_generic
+
+
+def compile_matcher(pattern: BasePattern) -> Matcher:
+    """Compile a pattern to a function that works like `pattern.match`.
+
+    Matches too deeply nested for the compiled closures fall back to fissix,
+    which also gives the same results as fissix when it runs out of stack.
+    """
+    if isinstance(pattern, HeadDispatchPattern):
+        heads = {
+            node_type: [compile_node(p) for p in alternatives]
+            for node_type, alternatives in pattern.heads.items()
+        }
+        others = [compile_node(p) for p in pattern.others]
+
+        def match_heads(node: LN, results: Optional[Dict[str, Any]] = None) -> bool:
+            trail: Trail = []
+            try:
+                for matcher in heads.get(node.type, others):
+                    if matcher(node, trail):
+                        if results is not None:
+                            results.update(trail)
+                        return True
+            except RecursionError:
+                return pattern.match(node, results)
+            return False
+
+        return match_heads
+
+    if isinstance(pattern, (LeafPattern, NodePattern)):
+        node_matcher = compile_node(pattern)
+
+        def match_node(node: LN, results: Optional[Dict[str, Any]] = None) -> bool:
+            trail: Trail = []
+            try:
+                if not node_matcher(node, trail):
+                    return False
+            except RecursionError:
+                return pattern.match(node, results)
+            if results is not None:
+                results.update(trail)
+            return True
+
+        return match_node
+
+    if type(pattern) is WildcardPattern:
+        sequence = compile_sequence([pattern], anchored=True)
+
+        def match_wildcard(node: LN, results: Optional[Dict[str, Any]] = None) -> bool:
+            trail: Trail = []
+            try:
+                if not sequence([node], 0, trail, lambda i: i == 1, set()):
+                    return False
+            except RecursionError:
+                return pattern.match(node, results)
+            if results is not None:
+                results.update(trail)
+                if pattern.name:
+                    results[pattern.name] = [node]
+            return True
+
+        return match_wildcard
+
+    return pattern.match
+
+
+# compiled matchers by pattern id, along with the pattern to keep the id unique
+_matchers: Dict[int, Tuple[BasePattern, Matcher]] = {}
+
+
+def pattern_matcher(pattern: BasePattern) -> Matcher:
+    """The compiled matcher for a pattern, see `compile_matcher`."""
+    entry = _matchers.get(id(pattern))
+    if entry is None:
+        entry = _matchers[id(pattern)] = (pattern, compile_matcher(pattern))
+    return entry[1]
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import keyword
+import mmap
+import re
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from fissix.fixer_base import BaseFix
+from fissix.patcomp import PatternCompiler
+from fissix.pytree import BasePattern, Leaf, LeafPattern, NodePattern, WildcardPattern
+
+from .types import LN
+
+# Source that matches a pattern contains a literal from every one of these sets.
+Literals = Tuple[FrozenSet[str], ...]
+Clause = FrozenSet[str]
+# A leaf value, and the node types from the leaf's parent up to a matching node.
+Anchor = Tuple[str, Tuple[Optional[int], ...]]
+# compiled patterns by text, shared by every fixer built in this process
+_compiled: Dict[str, BasePattern] = {}
+
+
+def _useful(clause: Clause) -> bool:
+    """Whether a clause is worth scanning for, and safe to scan for as bytes."""
+    return all(
+        max(map(ord, literal), default=128) < 128
+        and any(c.isalnum() for c in literal)
+        and not keyword.iskeyword(literal)
+        for literal in clause
+    )
+
+
+def _best(clauses: List[Clause]) -> Clause:
+    """The clause most likely to rule out unrelated source."""
+    return min(
+        clauses, key=lambda c: (not _useful(c), len(c), -min(len(lit) for lit in c))
+    )
+
+
+def _sequence(patterns: Sequence[BasePattern]) -> List[Clause]:
+    clauses: List[Clause] = []
+    for pattern in patterns:
+        clauses.extend(_requirements(pattern))
+    return clauses
+
+
+def _requirements(pattern: BasePattern) -> List[Clause]:
+    """Literals that any match of the pattern must contain, as a list of clauses."""
+    if isinstance(pattern, LeafPattern):
+        if isinstance(pattern.content, str):
+            return [frozenset((pattern.content,))]
+        return []
+
+    if isinstance(pattern, NodePattern):
+        if pattern.content is None:
+            return []
+        if isinstance(pattern.content, BasePattern):
+            return _requirements(pattern.content)
+        return _sequence(pattern.content)
+
+    if isinstance(pattern, WildcardPattern):
+        if pattern.min == 0 or pattern.content is None:
+            return []
+        alternatives = [_sequence(alternative) for alternative in pattern.content]
+        if not all(alternatives):
+            return []
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return [frozenset().union(*(_best(clauses) for clauses in alternatives))]
+
+    # negated patterns, and anything else, don't require anything
+    return []
+
+
+def required_literals(pattern: str) -> Optional[Literals]:
+    """Find literal tokens that any source matching a fixer pattern must contain.
+
+    Returns None if the pattern could match without any distinctive literals,
+    like names or strings. Keywords and punctuation are left out, since they
+    appear in almost every file.
+    """
+    compiled = compile_pattern(pattern)
+    clauses: List[Clause] = []
+    for clause in _requirements(compiled):
+        if _useful(clause) and clause not in clauses:
+            clauses.append(clause)
+    return tuple(clauses) or None
+
+
+def _regex(clause: Clause) -> Pattern[bytes]:
+    alternatives = []
+    for literal in sorted(clause):
+        escaped = re.escape(literal.encode())
+        if literal.isidentifier():
+            escaped = rb"\b" + escaped + rb"\b"
+        alternatives.append(escaped)
+    return re.compile(b"|".join(alternatives))
+
+
+class Prefilter:
+    """Rules out source that can't match any of a set of fixers, before parsing.
+
+    Takes the `required_literals` of each fixer, where None means that fixer
+    could match anything. Counts how many sources were ruled out in `skipped`.
+    """
+
+    def __init__(self, requirements: Sequence[Optional[Literals]]) -> None:
+        self.fixers: Optional[List[List[Pattern[bytes]]]] = None
+        if requirements and all(literals for literals in requirements):
+            self.fixers = [
+                [_regex(clause) for clause in literals]
+                for literals in requirements
+                if literals
+            ]
+        self.skipped = 0
+
+    def may_match(self, data: Union[bytes, mmap.mmap]) -> bool:
+        if self.fixers is None:
+            return True
+        for clauses in self.fixers:
+            if all(regex.search(data) for regex in clauses):
+                return True
+        self.skipped += 1
+        return False
+
+
+def _anchor_rank(anchors: List[Anchor]) -> Tuple[int, int]:
+    weak = sum(1 for value, _path in anchors if not _useful(frozenset((value,))))
+    return weak, len(anchors)
+
+
+def _anchor_sequence(patterns: Sequence[BasePattern]) -> Optional[List[Anchor]]:
+    best = None
+    for pattern in patterns:
+        anchors = _anchors(pattern)
+        if anchors and (best is None or _anchor_rank(anchors) < _anchor_rank(best)):
+            best = anchors
+    return best
+
+
+def _anchors(pattern: BasePattern) -> Optional[List[Anchor]]:
+    """Leaves that any match of the pattern must contain, at a fixed depth.
+
+    Every node matching the pattern has one of the returned leaf values below
+    it, with the given node types on the way up. Returns None if no such set
+    of leaves can be found.
+    """
+    if isinstance(pattern, LeafPattern):
+        if isinstance(pattern.content, str):
+            return [(pattern.content, ())]
+        return None
+
+    if isinstance(pattern, NodePattern):
+        if pattern.content is None:
+            return None
+        if isinstance(pattern.content, BasePattern):
+            inner = _anchors(pattern.content)
+        else:
+            inner = _anchor_sequence(pattern.content)
+        if not inner:
+            return None
+        return [(value, path + (pattern.type,)) for value, path in inner]
+
+    if isinstance(pattern, WildcardPattern):
+        if pattern.min == 0 or pattern.content is None:
+            return None
+        anchors: List[Anchor] = []
+        for alternative in pattern.content:
+            found = _anchor_sequence(alternative)
+            if not found:
+                return None
+            anchors.extend(found)
+        return anchors
+
+    return None
+
+
+class HeadDispatchPattern(WildcardPattern):
+    """A top level `( a | b | c )` pattern that only tries plausible alternatives.
+
+    Alternatives are grouped by the node type they match, so matching a node
+    only tries the alternatives for its type, in their original order, and
+    skips the wildcard's generic sequence matching.
+    """
+
+    def __init__(self, pattern: WildcardPattern) -> None:
+        super().__init__(pattern.content, pattern.min, pattern.max, pattern.name)
+        self.heads: Dict[int, List[BasePattern]] = {}
+        # alternatives that can match any node type
+        self.others: List[BasePattern] = []
+        for (alternative,) in self.content:
+            if alternative.type is None:
+                self.others.append(alternative)
+                for alternatives in self.heads.values():
+                    alternatives.append(alternative)
+            else:
+                alternatives = self.heads.setdefault(
+                    alternative.type, list(self.others)
+                )
+                alternatives.append(alternative)
+
+    def match(self, node: LN, results: Optional[Dict] = None) -> bool:
+        for alternative in self.heads.get(node.type, self.others):
+            if alternative.match(node, results):
+                return True
+        return False
+
+
+def dispatch_heads(pattern: BasePattern) -> BasePattern:
+    """Wrap a compiled pattern in a `HeadDispatchPattern` if it's an alternation.
+
+    Returns other patterns unchanged.
+    """
+    if (
+        type(pattern) is not WildcardPattern
+        or pattern.content is None
+        or pattern.name
+        or (pattern.min, pattern.max) != (1, 1)
+        or len(pattern.content) < 2
+    ):
+        return pattern
+    for alternative in pattern.content:
+        if len(alternative) != 1 or not isinstance(
+            alternative[0], (LeafPattern, NodePattern)
+        ):
+            return pattern
+    return HeadDispatchPattern(pattern)
+
+
+class CandidateMatcher:
+    """Finds the nodes a set of fixers could match in one pass over the leaves.
+
+    Each fixer built by `Query` is anchored by the literal leaves its pattern
+    requires, see `_anchors`. Every leaf with an anchor's value, and the right
+    node types above it, makes the node at the top of that path a candidate
+    for the fixer. Nodes that aren't candidates can't match.
+    """
+
+    def __init__(self, fixers: Sequence[BaseFix]) -> None:
+        self.anchors: Dict[str, List[Tuple[BaseFix, Tuple[Optional[int], ...]]]] = {}
+        # whether every fixer is anchored, and so no other nodes can match
+        self.complete = True
+        for fixer in fixers:
+            anchors = None
+            # other fixers may override `match`, and can't be narrowed down
+            if hasattr(fixer, "TRANSFORM"):
+                anchors = _anchors(fixer.pattern)
+            if not anchors:
+                self.complete = False
+                continue
+            for value, path in anchors:
+                self.anchors.setdefault(value, []).append((fixer, path))
+
+        # candidates, and their ancestors, by id, as of the last `update`
+        self.found: Dict[int, Tuple[LN, Set[BaseFix]]] = {}
+        self.marked: Set[int] = set()
+
+    def update(self, tree: LN) -> None:
+        """Find the candidates in a tree, after it was built or changed."""
+        self.found.clear()
+        self.marked.clear()
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children)
+                continue
+            if not isinstance(node, Leaf) or node.value not in self.anchors:
+                continue
+            for fixer, path in self.anchors[node.value]:
+                candidate: Optional[LN] = node
+                for node_type in path:
+                    candidate = candidate.parent  # type: ignore
+                    if candidate is None:
+                        break
+                    if node_type is not None and candidate.type != node_type:
+                        candidate = None
+                        break
+                if candidate is not None:
+                    entry = self.found.setdefault(id(candidate), (candidate, set()))
+                    entry[1].add(fixer)
+
+        for candidate, _fixers in self.found.values():
+            ancestor: Optional[LN] = candidate
+            while ancestor is not None and id(ancestor) not in self.marked:
+                self.marked.add(id(ancestor))
+                ancestor = ancestor.parent
+
+    def run(self, tree: LN) -> Iterator[Tuple[LN, Set[BaseFix]]]:
+        """Yield candidate nodes in post-order, with the fixers they might match.
+
+        Like `Node.post_order`, each node's children are iterated as they were
+        when it was entered. Subtrees without candidates are skipped, so
+        `update` must be called whenever the tree changes.
+        """
+        self.update(tree)
+        if id(tree) in self.marked:
+            yield from self._visit(tree)
+
+    def _visit(self, node: LN) -> Iterator[Tuple[LN, Set[BaseFix]]]:
+        for child in node.children:
+            if id(child) in self.marked:
+                yield from self._visit(child)
+        found = self.found.get(id(node))
+        if found is not None:
+            yield found
+
+
+def resume_post_order(node: LN) -> Iterator[LN]:
+    """Continue a post-order traversal from just after `node`.
+
+    Must be called before `node` is modified. Like `Node.post_order`, this
+    iterates over the children lists as they were, and sees changes made to
+    them in place.
+    """
+    levels = []
+    child = node
+    while child.parent is not None:
+        parent = child.parent
+        children = parent.children
+        index = next(i for i, sibling in enumerate(children) if sibling is child)
+        levels.append((children, index, parent))
+        child = parent
+
+    def resume() -> Iterator[LN]:
+        for children, index, parent in levels:
+            index += 1
+            while index < len(children):
+                yield from children[index].post_order()
+                index += 1
+            yield parent
+
+    return resume()
+
+
+def compile_pattern(pattern: str) -> BasePattern:
+    """Compile a fixer pattern once per process, see `dispatch_heads`.
+
+    Patterns are never modified by matching, so fixers can share them.
+    """
+    compiled = _compiled.get(pattern)
+    if compiled is None:
+        compiled = PatternCompiler().compile_pattern(pattern)
+        compiled = _compiled[pattern] = dispatch_heads(compiled)
+    return compiled
+
+
+def compiled_patterns(patterns: Iterable[str]) -> Dict[str, BasePattern]:
+    """Compiled forms of the given patterns, to ship to other processes."""
+    return {pattern: compile_pattern(pattern) for pattern in patterns}
+
+
+def load_patterns(compiled: Dict[str, BasePattern]) -> None:
+    """Reuse patterns compiled by another process, see `compiled_patterns`."""
+    _compiled.update(compiled)
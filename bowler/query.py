@@ -9,8 +9,21 @@ import inspect
 import logging
 import pathlib
 import re
-from functools import wraps
-from typing import Callable, List, Optional, Type, TypeVar, Union, cast
+from functools import partial, wraps
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
 
 from fissix.fixer_base import BaseFix
 from fissix.fixer_util import Attr, Comma, Dot, LParen, Name, Newline, RParen
@@ -29,6 +42,8 @@ from .helpers import (
     quoted_parts,
 )
 from .imr import FunctionArgument, FunctionSpec
+from .matcher import expensive, pattern_matcher
+from .pattern import compile_pattern, dispatch_heads, required_literals
 from .tool import BowlerTool
 from .types import (
     LN,
@@ -43,6 +58,7 @@ from .types import (
     FilenameMatcher,
     Filter,
     Hunk,
+    Match,
     Processor,
     Stringish,
     Transform,
@@ -83,20 +99,422 @@ def selector(pattern: str) -> Callable[[QM], QM]:
     return wrapper
 
 
+# Filters and modifiers added by `Query` methods live at module level, with their
+# arguments bound by `partial`, so they can be pickled for worker processes.
+
+
+def filter_filename_include(
+    regex: Pattern, node: LN, capture: Capture, filename: Filename
+) -> bool:
+    return regex.search(filename) is not None
+
+
+def filter_filename_exclude(
+    regex: Pattern, node: LN, capture: Capture, filename: Filename
+) -> bool:
+    return regex.search(filename) is None
+
+
+def filter_is_call(node: LN, capture: Capture, filename: Filename) -> bool:
+    return bool("function_call" in capture or "class_call" in capture)
+
+
+def filter_is_def(node: LN, capture: Capture, filename: Filename) -> bool:
+    return bool("function_def" in capture or "class_def" in capture)
+
+
+def filter_in_class(
+    class_name: str,
+    include_subclasses: bool,
+    node: LN,
+    capture: Capture,
+    filename: Filename,
+) -> bool:
+    while node.parent is not None:
+        if node.type == SYMBOL.classdef:
+            if node.children[1].value == class_name:
+                return True
+            if not include_subclasses:
+                return False
+            for leaf in node.leaves():
+                if leaf.type == TOKEN.COLON:
+                    break
+                elif leaf.type == TOKEN.NAME and leaf.value == class_name:
+                    return True
+            return False
+        node = node.parent
+    return False
+
+
+def encapsulate_transform(
+    old_name: str,
+    new_name: str,
+    make_property: Once,
+    node: LN,
+    capture: Capture,
+    filename: Filename,
+) -> None:
+    if "attr_assignment" in capture:
+        leaf = capture["attr_name"]
+        leaf.replace(Name(new_name, prefix=leaf.prefix))
+
+        if make_property:
+            # TODO: capture and use type annotation from original assignment
+
+            class_node = get_class(node)
+            suite = find_first(class_node, SYMBOL.suite)
+            assert isinstance(suite, Node)
+            indent_node = find_first(suite, TOKEN.INDENT)
+            assert isinstance(indent_node, Leaf)
+            indent = indent_node.value
+
+            getter = Node(
+                SYMBOL.decorated,
+                [
+                    Node(
+                        SYMBOL.decorator,
+                        [
+                            Leaf(TOKEN.INDENT, indent),
+                            Leaf(TOKEN.AT, "@"),
+                            Name("property"),
+                            Leaf(TOKEN.NEWLINE, "\n"),
+                        ],
+                    ),
+                    Node(
+                        SYMBOL.funcdef,
+                        [
+                            Name("def", indent),
+                            Name(old_name, prefix=" "),
+                            Node(
+                                SYMBOL.parameters,
+                                [LParen(), Name("self"), RParen()],
+                            ),
+                            Leaf(TOKEN.COLON, ":"),
+                            Node(
+                                SYMBOL.suite,
+                                [
+                                    Newline(),
+                                    Leaf(TOKEN.INDENT, indent + "    "),
+                                    Node(
+                                        SYMBOL.simple_stmt,
+                                        [
+                                            Node(
+                                                SYMBOL.return_stmt,
+                                                [
+                                                    Name("return"),
+                                                    Node(
+                                                        SYMBOL.power,
+                                                        Attr(
+                                                            Name("self"),
+                                                            Name(new_name),
+                                                        ),
+                                                        prefix=" ",
+                                                    ),
+                                                ],
+                                            ),
+                                            Newline(),
+                                        ],
+                                    ),
+                                    Leaf(TOKEN.DEDENT, "\n" + indent),
+                                ],
+                            ),
+                        ],
+                        prefix=indent,
+                    ),
+                ],
+            )
+
+            setter = Node(
+                SYMBOL.decorated,
+                [
+                    Node(
+                        SYMBOL.decorator,
+                        [
+                            Leaf(TOKEN.AT, "@"),
+                            Node(
+                                SYMBOL.dotted_name,
+                                [Name(old_name), Dot(), Name("setter")],
+                            ),
+                            Leaf(TOKEN.NEWLINE, "\n"),
+                        ],
+                    ),
+                    Node(
+                        SYMBOL.funcdef,
+                        [
+                            Name("def", indent),
+                            Name(old_name, prefix=" "),
+                            Node(
+                                SYMBOL.parameters,
+                                [
+                                    LParen(),
+                                    Node(
+                                        SYMBOL.typedargslist,
+                                        [
+                                            Name("self"),
+                                            Comma(),
+                                            Name("value", prefix=" "),
+                                        ],
+                                    ),
+                                    RParen(),
+                                ],
+                            ),
+                            Leaf(TOKEN.COLON, ":"),
+                            Node(
+                                SYMBOL.suite,
+                                [
+                                    Newline(),
+                                    Leaf(TOKEN.INDENT, indent + "    "),
+                                    Node(
+                                        SYMBOL.simple_stmt,
+                                        [
+                                            Node(
+                                                SYMBOL.expr_stmt,
+                                                [
+                                                    Node(
+                                                        SYMBOL.power,
+                                                        Attr(
+                                                            Name("self"),
+                                                            Name(new_name),
+                                                        ),
+                                                    ),
+                                                    Leaf(
+                                                        TOKEN.EQUAL,
+                                                        "=",
+                                                        prefix=" ",
+                                                    ),
+                                                    Name("value", prefix=" "),
+                                                ],
+                                            ),
+                                            Newline(),
+                                        ],
+                                    ),
+                                    Leaf(TOKEN.DEDENT, "\n" + indent),
+                                ],
+                            ),
+                        ],
+                        prefix=indent,
+                    ),
+                ],
+            )
+
+            suite.insert_child(-1, getter)
+            suite.insert_child(-1, setter)
+
+            prev = find_previous(getter, TOKEN.DEDENT, recursive=True)
+            curr = find_last(setter, TOKEN.DEDENT, recursive=True)
+            if prev and curr:
+                assert isinstance(prev, Leaf) and isinstance(curr, Leaf)
+                prev.prefix, curr.prefix = curr.prefix, prev.prefix
+                prev.value, curr.value = curr.value, prev.value
+
+
+def rename_transform(
+    old_name: str, new_name: str, node: LN, capture: Capture, filename: Filename
+) -> None:
+    log.debug(f"{filename} [{list(capture)}]: {node}")
+
+    # If two keys reference the same underlying object, do not modify it twice
+    visited: List[LN] = []
+    for _key, value in capture.items():
+        log.debug(f"{_key}: {value}")
+        if value in visited:
+            continue
+        visited.append(value)
+
+        if isinstance(value, Leaf) and value.type == TOKEN.NAME:
+            if value.value == old_name and value.parent is not None:
+                value.replace(Name(new_name, prefix=value.prefix))
+                break
+        elif isinstance(value, Node):
+            if type_repr(value.type) == "dotted_name":
+                dp_old = dotted_parts(old_name)
+                dp_new = dotted_parts(new_name)
+                parts = zip(dp_old, dp_new, value.children)
+                for old, new, leaf in parts:
+                    if old != leaf.value:
+                        break
+                    if old != new:
+                        leaf.replace(Name(new, prefix=leaf.prefix))
+
+                if len(dp_new) < len(dp_old):
+                    # if new path is shorter, remove excess children
+                    del value.children[len(dp_new) : len(dp_old)]
+                elif len(dp_new) > len(dp_old):
+                    # if new path is longer, add new children
+                    children = [Name(new) for new in dp_new[len(dp_old) : len(dp_new)]]
+                    value.children[len(dp_old) : len(dp_old)] = children
+
+            elif type_repr(value.type) == "power":
+                # We don't actually need the '.' so just skip it
+                dp_old = old_name.split(".")
+                dp_new = new_name.split(".")
+
+                for old, new, leaf in zip(dp_old, dp_new, value.children):
+                    if isinstance(leaf, Node):
+                        name_leaf = leaf.children[1]
+                    else:
+                        name_leaf = leaf
+                    if old != name_leaf.value:
+                        break
+                    name_leaf.replace(Name(new, prefix=name_leaf.prefix))
+
+                if len(dp_new) < len(dp_old):
+                    # if new path is shorter, remove excess children
+                    del value.children[len(dp_new) : len(dp_old)]
+                elif len(dp_new) > len(dp_old):
+                    # if new path is longer, add new trailers in the middle
+                    for i in range(len(dp_old), len(dp_new)):
+                        value.insert_child(
+                            i, Node(SYMBOL.trailer, [Dot(), Name(dp_new[i])])
+                        )
+
+
+def add_argument_transform(
+    name: str,
+    value: str,
+    positional: bool,
+    after: Stringish,
+    type_annotation: Stringish,
+    stop_at: int,
+    node: Node,
+    capture: Capture,
+    filename: Filename,
+) -> None:
+    if "function_def" not in capture and "function_call" not in capture:
+        return
+
+    spec = FunctionSpec.build(node, capture)
+    done = False
+    keyword = not positional
+    value_leaf = Name(value)
+
+    if spec.is_def:
+        new_arg = FunctionArgument(
+            name,
+            value_leaf if keyword else None,
+            cast(str, type_annotation) if type_annotation != SENTINEL else "",
+        )
+        for index, argument in enumerate(spec.arguments):
+            if after == argument.name:
+                spec.arguments.insert(index + 1, new_arg)
+                done = True
+                break
+
+            if (
+                after == START
+                or (positional and (argument.value or argument.star))
+                or (
+                    keyword and argument.star and argument.star.type == TOKEN.DOUBLESTAR
+                )
+            ):
+                spec.arguments.insert(index, new_arg)
+                done = True
+                break
+
+        if not done:
+            spec.arguments.append(new_arg)
+
+    elif positional:
+        new_arg = FunctionArgument(value=value_leaf)
+        for index, argument in enumerate(spec.arguments):
+            if argument.star and argument.star.type == TOKEN.STAR:
+                log.debug(f"noping out due to *{argument.name}")
+                done = True
+                break
+
+            if index == stop_at:
+                spec.arguments.insert(index + 1, new_arg)
+                done = True
+                break
+
+            if after == START or argument.name or argument.star:
+                spec.arguments.insert(index, new_arg)
+                done = True
+                break
+
+        if not done:
+            spec.arguments.append(new_arg)
+
+    spec.explode()
+
+
+def modify_argument_transform(
+    name: str,
+    new_name: Stringish,
+    type_annotation: Stringish,
+    default_value: Stringish,
+    node: Node,
+    capture: Capture,
+    filename: Filename,
+) -> None:
+    if "function_def" not in capture and "function_call" not in capture:
+        return
+
+    spec = FunctionSpec.build(node, capture)
+
+    for argument in spec.arguments:
+        if argument.name == name:
+            if new_name is not SENTINEL:
+                argument.name = str(new_name)
+            if spec.is_def and type_annotation is not SENTINEL:
+                argument.annotation = str(type_annotation)
+            if spec.is_def and default_value is not SENTINEL:
+                argument.value = Name(default_value, prefix=" ")
+
+    spec.explode()
+
+
+def remove_argument_transform(
+    name: str,
+    positional: bool,
+    stop_at: int,
+    node: Node,
+    capture: Capture,
+    filename: Filename,
+) -> None:
+    if "function_def" not in capture and "function_call" not in capture:
+        return
+
+    spec = FunctionSpec.build(node, capture)
+
+    if spec.is_def or not positional:
+        for argument in spec.arguments:
+            if argument.name == name:
+                spec.arguments.remove(argument)
+                break
+
+    else:
+        for index, argument in reversed(list(enumerate(spec.arguments))):
+            if argument.name == name:
+                spec.arguments.pop(index)
+                break
+
+            if index == stop_at and not argument.name and not argument.star:
+                spec.arguments.pop(index)
+                break
+
+    spec.explode()
+
+
 class Query:
     def __init__(
         self,
         *paths: Union[str, List[str]],
         filename_matcher: Optional[FilenameMatcher] = None,
         python_version: int = 3,
+        include: Optional[Sequence[str]] = None,
+        exclude: Optional[Sequence[str]] = None,
     ) -> None:
         self.paths: List[str] = []
         self.transforms: List[Transform] = []
         self.processors: List[Processor] = []
         self.retcode: Optional[int] = None
         self.filename_matcher = filename_matcher
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
         self.python_version = python_version
         self.exceptions: List[BowlerException] = []
+        self.since_revision: Optional[str] = None
 
         for path in paths:
             if isinstance(path, str):
@@ -412,58 +830,26 @@ class Query:
     def is_filename(self, include: str = None, exclude: str = None) -> "Query":
         if include:
             regex = re.compile(include)
-
-            def filter_filename_include(
-                node: LN, capture: Capture, filename: Filename
-            ) -> bool:
-                return regex.search(filename) is not None
-
-            self.current.filters.append(filter_filename_include)
+            self.current.filters.append(partial(filter_filename_include, regex))
 
         if exclude:
             regex = re.compile(exclude)
-
-            def filter_filename_exclude(
-                node: LN, capture: Capture, filename: Filename
-            ) -> bool:
-                return regex.search(filename) is None
-
-            self.current.filters.append(filter_filename_exclude)
+            self.current.filters.append(partial(filter_filename_exclude, regex))
 
         return self
 
     def is_call(self) -> "Query":
-        def filter_is_call(node: LN, capture: Capture, filename: Filename) -> bool:
-            return bool("function_call" in capture or "class_call" in capture)
-
         self.current.filters.append(filter_is_call)
         return self
 
     def is_def(self) -> "Query":
-        def filter_is_def(node: LN, capture: Capture, filename: Filename) -> bool:
-            return bool("function_def" in capture or "class_def" in capture)
-
         self.current.filters.append(filter_is_def)
         return self
 
     def in_class(self, class_name: str, include_subclasses: bool = True) -> "Query":
-        def filter_in_class(node: LN, capture: Capture, filename: Filename) -> bool:
-            while node.parent is not None:
-                if node.type == SYMBOL.classdef:
-                    if node.children[1].value == class_name:
-                        return True
-                    if not include_subclasses:
-                        return False
-                    for leaf in node.leaves():
-                        if leaf.type == TOKEN.COLON:
-                            break
-                        elif leaf.type == TOKEN.NAME and leaf.value == class_name:
-                            return True
-                    return False
-                node = node.parent
-            return False
-
-        self.current.filters.append(filter_in_class)
+        self.current.filters.append(
+            partial(filter_in_class, class_name, include_subclasses)
+        )
         return self
 
     def encapsulate(self, internal_name: str = "") -> "Query":
@@ -471,7 +857,10 @@ class Query:
         if transform.selector not in ("attribute"):
             raise ValueError("encapsulate requires select_attribute")
 
-        if not any("filter_in_class" in f.__name__ for f in transform.filters):
+        if not any(
+            "filter_in_class" in getattr(f, "func", f).__name__
+            for f in transform.filters
+        ):
             raise ValueError("encapsulate requires in_class filter")
 
         make_property = Once()
@@ -484,230 +873,16 @@ class Query:
                 "please specify internal_name to avoid name mangling"
             )
 
-        def encapsulate_transform(
-            node: LN, capture: Capture, filename: Filename
-        ) -> None:
-            if "attr_assignment" in capture:
-                leaf = capture["attr_name"]
-                leaf.replace(Name(new_name, prefix=leaf.prefix))
-
-                if make_property:
-                    # TODO: capture and use type annotation from original assignment
-
-                    class_node = get_class(node)
-                    suite = find_first(class_node, SYMBOL.suite)
-                    assert isinstance(suite, Node)
-                    indent_node = find_first(suite, TOKEN.INDENT)
-                    assert isinstance(indent_node, Leaf)
-                    indent = indent_node.value
-
-                    getter = Node(
-                        SYMBOL.decorated,
-                        [
-                            Node(
-                                SYMBOL.decorator,
-                                [
-                                    Leaf(TOKEN.INDENT, indent),
-                                    Leaf(TOKEN.AT, "@"),
-                                    Name("property"),
-                                    Leaf(TOKEN.NEWLINE, "\n"),
-                                ],
-                            ),
-                            Node(
-                                SYMBOL.funcdef,
-                                [
-                                    Name("def", indent),
-                                    Name(old_name, prefix=" "),
-                                    Node(
-                                        SYMBOL.parameters,
-                                        [LParen(), Name("self"), RParen()],
-                                    ),
-                                    Leaf(TOKEN.COLON, ":"),
-                                    Node(
-                                        SYMBOL.suite,
-                                        [
-                                            Newline(),
-                                            Leaf(TOKEN.INDENT, indent + "    "),
-                                            Node(
-                                                SYMBOL.simple_stmt,
-                                                [
-                                                    Node(
-                                                        SYMBOL.return_stmt,
-                                                        [
-                                                            Name("return"),
-                                                            Node(
-                                                                SYMBOL.power,
-                                                                Attr(
-                                                                    Name("self"),
-                                                                    Name(new_name),
-                                                                ),
-                                                                prefix=" ",
-                                                            ),
-                                                        ],
-                                                    ),
-                                                    Newline(),
-                                                ],
-                                            ),
-                                            Leaf(TOKEN.DEDENT, "\n" + indent),
-                                        ],
-                                    ),
-                                ],
-                                prefix=indent,
-                            ),
-                        ],
-                    )
-
-                    setter = Node(
-                        SYMBOL.decorated,
-                        [
-                            Node(
-                                SYMBOL.decorator,
-                                [
-                                    Leaf(TOKEN.AT, "@"),
-                                    Node(
-                                        SYMBOL.dotted_name,
-                                        [Name(old_name), Dot(), Name("setter")],
-                                    ),
-                                    Leaf(TOKEN.NEWLINE, "\n"),
-                                ],
-                            ),
-                            Node(
-                                SYMBOL.funcdef,
-                                [
-                                    Name("def", indent),
-                                    Name(old_name, prefix=" "),
-                                    Node(
-                                        SYMBOL.parameters,
-                                        [
-                                            LParen(),
-                                            Node(
-                                                SYMBOL.typedargslist,
-                                                [
-                                                    Name("self"),
-                                                    Comma(),
-                                                    Name("value", prefix=" "),
-                                                ],
-                                            ),
-                                            RParen(),
-                                        ],
-                                    ),
-                                    Leaf(TOKEN.COLON, ":"),
-                                    Node(
-                                        SYMBOL.suite,
-                                        [
-                                            Newline(),
-                                            Leaf(TOKEN.INDENT, indent + "    "),
-                                            Node(
-                                                SYMBOL.simple_stmt,
-                                                [
-                                                    Node(
-                                                        SYMBOL.expr_stmt,
-                                                        [
-                                                            Node(
-                                                                SYMBOL.power,
-                                                                Attr(
-                                                                    Name("self"),
-                                                                    Name(new_name),
-                                                                ),
-                                                            ),
-                                                            Leaf(
-                                                                TOKEN.EQUAL,
-                                                                "=",
-                                                                prefix=" ",
-                                                            ),
-                                                            Name("value", prefix=" "),
-                                                        ],
-                                                    ),
-                                                    Newline(),
-                                                ],
-                                            ),
-                                            Leaf(TOKEN.DEDENT, "\n" + indent),
-                                        ],
-                                    ),
-                                ],
-                                prefix=indent,
-                            ),
-                        ],
-                    )
-
-                    suite.insert_child(-1, getter)
-                    suite.insert_child(-1, setter)
-
-                    prev = find_previous(getter, TOKEN.DEDENT, recursive=True)
-                    curr = find_last(setter, TOKEN.DEDENT, recursive=True)
-                    if prev and curr:
-                        assert isinstance(prev, Leaf) and isinstance(curr, Leaf)
-                        prev.prefix, curr.prefix = curr.prefix, prev.prefix
-                        prev.value, curr.value = curr.value, prev.value
-
-        transform.callbacks.append(encapsulate_transform)
+        transform.callbacks.append(
+            partial(encapsulate_transform, old_name, new_name, make_property)
+        )
         return self
 
     def rename(self, new_name: str) -> "Query":
         transform = self.current
         old_name = transform.kwargs["name"]
 
-        def rename_transform(node: LN, capture: Capture, filename: Filename) -> None:
-            log.debug(f"{filename} [{list(capture)}]: {node}")
-
-            # If two keys reference the same underlying object, do not modify it twice
-            visited: List[LN] = []
-            for _key, value in capture.items():
-                log.debug(f"{_key}: {value}")
-                if value in visited:
-                    continue
-                visited.append(value)
-
-                if isinstance(value, Leaf) and value.type == TOKEN.NAME:
-                    if value.value == old_name and value.parent is not None:
-                        value.replace(Name(new_name, prefix=value.prefix))
-                        break
-                elif isinstance(value, Node):
-                    if type_repr(value.type) == "dotted_name":
-                        dp_old = dotted_parts(old_name)
-                        dp_new = dotted_parts(new_name)
-                        parts = zip(dp_old, dp_new, value.children)
-                        for old, new, leaf in parts:
-                            if old != leaf.value:
-                                break
-                            if old != new:
-                                leaf.replace(Name(new, prefix=leaf.prefix))
-
-                        if len(dp_new) < len(dp_old):
-                            # if new path is shorter, remove excess children
-                            del value.children[len(dp_new) : len(dp_old)]
-                        elif len(dp_new) > len(dp_old):
-                            # if new path is longer, add new children
-                            children = [
-                                Name(new) for new in dp_new[len(dp_old) : len(dp_new)]
-                            ]
-                            value.children[len(dp_old) : len(dp_old)] = children
-
-                    elif type_repr(value.type) == "power":
-                        # We don't actually need the '.' so just skip it
-                        dp_old = old_name.split(".")
-                        dp_new = new_name.split(".")
-
-                        for old, new, leaf in zip(dp_old, dp_new, value.children):
-                            if isinstance(leaf, Node):
-                                name_leaf = leaf.children[1]
-                            else:
-                                name_leaf = leaf
-                            if old != name_leaf.value:
-                                break
-                            name_leaf.replace(Name(new, prefix=name_leaf.prefix))
-
-                        if len(dp_new) < len(dp_old):
-                            # if new path is shorter, remove excess children
-                            del value.children[len(dp_new) : len(dp_old)]
-                        elif len(dp_new) > len(dp_old):
-                            # if new path is longer, add new trailers in the middle
-                            for i in range(len(dp_old), len(dp_new)):
-                                value.insert_child(
-                                    i, Node(SYMBOL.trailer, [Dot(), Name(dp_new[i])])
-                                )
-
-        transform.callbacks.append(rename_transform)
+        transform.callbacks.append(partial(rename_transform, old_name, new_name))
         return self
 
     def add_argument(
@@ -718,8 +893,6 @@ class Query:
         after: Stringish = SENTINEL,
         type_annotation: Stringish = SENTINEL,
     ) -> "Query":
-        keyword = not positional
-
         transform = self.current
         if transform.selector not in ("function", "method"):
             raise ValueError("add_argument must follow select_function/select_method")
@@ -740,68 +913,17 @@ class Query:
             if names[0] in ("self", "cls", "meta"):
                 stop_at -= 1
 
-        def add_argument_transform(
-            node: Node, capture: Capture, filename: Filename
-        ) -> None:
-            if "function_def" not in capture and "function_call" not in capture:
-                return
-
-            spec = FunctionSpec.build(node, capture)
-            done = False
-            value_leaf = Name(value)
-
-            if spec.is_def:
-                new_arg = FunctionArgument(
-                    name,
-                    value_leaf if keyword else None,
-                    cast(str, type_annotation) if type_annotation != SENTINEL else "",
-                )
-                for index, argument in enumerate(spec.arguments):
-                    if after == argument.name:
-                        spec.arguments.insert(index + 1, new_arg)
-                        done = True
-                        break
-
-                    if (
-                        after == START
-                        or (positional and (argument.value or argument.star))
-                        or (
-                            keyword
-                            and argument.star
-                            and argument.star.type == TOKEN.DOUBLESTAR
-                        )
-                    ):
-                        spec.arguments.insert(index, new_arg)
-                        done = True
-                        break
-
-                if not done:
-                    spec.arguments.append(new_arg)
-
-            elif positional:
-                new_arg = FunctionArgument(value=value_leaf)
-                for index, argument in enumerate(spec.arguments):
-                    if argument.star and argument.star.type == TOKEN.STAR:
-                        log.debug(f"noping out due to *{argument.name}")
-                        done = True
-                        break
-
-                    if index == stop_at:
-                        spec.arguments.insert(index + 1, new_arg)
-                        done = True
-                        break
-
-                    if after == START or argument.name or argument.star:
-                        spec.arguments.insert(index, new_arg)
-                        done = True
-                        break
-
-                if not done:
-                    spec.arguments.append(new_arg)
-
-            spec.explode()
-
-        transform.callbacks.append(add_argument_transform)
+        transform.callbacks.append(
+            partial(
+                add_argument_transform,
+                name,
+                value,
+                positional,
+                after,
+                type_annotation,
+                stop_at,
+            )
+        )
         return self
 
     def modify_argument(
@@ -815,26 +937,15 @@ class Query:
         if transform.selector not in ("function", "method"):
             raise ValueError(f"modifier must follow select_function or select_method")
 
-        def modify_argument_transform(
-            node: Node, capture: Capture, filename: Filename
-        ) -> None:
-            if "function_def" not in capture and "function_call" not in capture:
-                return
-
-            spec = FunctionSpec.build(node, capture)
-
-            for argument in spec.arguments:
-                if argument.name == name:
-                    if new_name is not SENTINEL:
-                        argument.name = str(new_name)
-                    if spec.is_def and type_annotation is not SENTINEL:
-                        argument.annotation = str(type_annotation)
-                    if spec.is_def and default_value is not SENTINEL:
-                        argument.value = Name(default_value, prefix=" ")
-
-            spec.explode()
-
-        transform.callbacks.append(modify_argument_transform)
+        transform.callbacks.append(
+            partial(
+                modify_argument_transform,
+                name,
+                new_name,
+                type_annotation,
+                default_value,
+            )
+        )
         return self
 
     def remove_argument(self, name: str) -> "Query":
@@ -865,33 +976,9 @@ class Query:
         if names[0] in ("self", "cls", "meta"):
             stop_at -= 1
 
-        def remove_argument_transform(
-            node: Node, capture: Capture, filename: Filename
-        ) -> None:
-            if "function_def" not in capture and "function_call" not in capture:
-                return
-
-            spec = FunctionSpec.build(node, capture)
-
-            if spec.is_def or not positional:
-                for argument in spec.arguments:
-                    if argument.name == name:
-                        spec.arguments.remove(argument)
-                        break
-
-            else:
-                for index, argument in reversed(list(enumerate(spec.arguments))):
-                    if argument.name == name:
-                        spec.arguments.pop(index)
-                        break
-
-                    if index == stop_at and not argument.name and not argument.star:
-                        spec.arguments.pop(index)
-                        break
-
-            spec.explode()
-
-        transform.callbacks.append(remove_argument_transform)
+        transform.callbacks.append(
+            partial(remove_argument_transform, name, positional, stop_at)
+        )
         return self
 
     def fixer(self, fx: Type[BaseFix]) -> "Query":
@@ -924,6 +1011,11 @@ class Query:
         self.processors.append(callback)
         return self
 
+    def since(self, revision: str) -> "Query":
+        """Only refactor files that changed since the given git revision."""
+        self.since_revision = revision
+        return self
+
     def create_fixer(self, transform):
         if transform.fixer:
             bm_compat = transform.fixer.BM_compatible
@@ -953,10 +1045,27 @@ class Query:
             PATTERN = pattern  # type: ignore
             BM_compatible = bm_compat
 
+            def compile_pattern(self) -> None:
+                if self.BM_compatible:
+                    # the bottom matcher needs the tree the pattern came from
+                    super().compile_pattern()
+                    self.pattern = dispatch_heads(self.pattern)  # type: ignore
+                else:
+                    self.pattern = compile_pattern(self.PATTERN)
+                self.matcher = pattern_matcher(self.pattern)
+
+            def match(self, node: LN) -> Union[bool, Capture]:
+                results: Capture = {"node": node}
+                return self.matcher(node, results) and results
+
+            def accepts(self, node: LN, capture: Capture) -> bool:
+                filename = cast(Filename, self.filename)
+                return not filters or all(f(node, capture, filename) for f in filters)
+
             def transform(self, node: LN, capture: Capture) -> Optional[LN]:
                 filename = cast(Filename, self.filename)
                 returned_node = None
-                if not filters or all(f(node, capture, filename) for f in filters):
+                if self.accepts(node, capture):
                     if transform.fixer:
                         returned_node = transform.fixer().transform(node, capture)
                     for callback in callbacks:
@@ -969,6 +1078,13 @@ class Query:
                         returned_node = callback(node, capture, filename)
                 return returned_node
 
+        # lets BowlerTool rebuild this fixer in spawned child processes
+        Fixer.TRANSFORM = transform  # type: ignore
+        # lets BowlerTool skip files without parsing them; fixer classes may
+        # have side effects, so files are only skipped for plain selectors
+        Fixer.LITERALS = (  # type: ignore
+            None if transform.fixer else required_literals(pattern)
+        )
         return Fixer
 
     def compile(self) -> List[Type[BaseFix]]:
@@ -978,11 +1094,14 @@ class Query:
 
         fixers: List[Type[BaseFix]] = []
         for transform in self.transforms:
-            fixers.append(self.create_fixer(transform))
+            fixer = self.create_fixer(transform)
+            if fixer.PATTERN and expensive(compile_pattern(fixer.PATTERN)):
+                log.warning(f"pattern may be slow to match: {fixer.PATTERN}")
+            fixers.append(fixer)
 
         return fixers
 
-    def execute(self, **kwargs) -> "Query":
+    def build_tool(self, **kwargs) -> BowlerTool:
         fixers = self.compile()
         if self.processors:
 
@@ -996,9 +1115,16 @@ class Query:
             kwargs["hunk_processor"] = processor
 
         kwargs.setdefault("filename_matcher", self.filename_matcher)
+        kwargs.setdefault("include", self.include)
+        kwargs.setdefault("exclude", self.exclude)
+        if self.since_revision is not None:
+            kwargs.setdefault("since", self.since_revision)
         if self.python_version == 3:
             kwargs.setdefault("options", {})["print_function"] = True
-        tool = BowlerTool(fixers, **kwargs)
+        return BowlerTool(fixers, **kwargs)
+
+    def execute(self, **kwargs) -> "Query":
+        tool = self.build_tool(**kwargs)
         self.retcode = tool.run(self.paths)
         self.exceptions = tool.exceptions
         return self
@@ -1023,3 +1149,52 @@ class Query:
 
     def write(self, **kwargs) -> "Query":
         return self.execute(write=True, silent=True, interactive=False, **kwargs)
+
+    def iter_matches(self, **kwargs) -> Iterator[Match]:
+        """Yield where the selected nodes are, without changing any files.
+
+        Matches are yielded as each file is done, in the same order as `diff`
+        would show them. Filters apply, but callbacks and modifiers don't run,
+        and nothing is diffed or written. Takes the same arguments as `execute`.
+        """
+        found: List[Match] = []
+        tool = self.build_tool(find=True, match_handler=found.append, **kwargs)
+        for _ in tool.iter_refactor(self.paths):
+            yield from found
+            found.clear()
+        yield from found
+        self.retcode = int(bool(tool.errors or tool.exceptions))
+        self.exceptions = tool.exceptions
+
+
+def run_all(queries: Sequence[Query], **kwargs) -> List[Query]:
+    """Execute several queries, walking and parsing each file only once.
+
+    Queries with the same paths, filename matcher, include and exclude globs,
+    python version and `since` revision run together: every query's fixers are
+    applied in turn to the same tree, as if each query was written to disk
+    before running the next. Each query still gets its own hunks, processors,
+    return code and exceptions. Takes the same arguments as `Query.execute`,
+    and returns the queries.
+    """
+    groups: Dict[Tuple, List[Query]] = {}
+    for query in queries:
+        key = (
+            tuple(query.paths),
+            query.filename_matcher,
+            tuple(query.include),
+            tuple(query.exclude),
+            query.python_version,
+            query.since_revision,
+        )
+        groups.setdefault(key, []).append(query)
+
+    for group in groups.values():
+        tools = [query.build_tool(**dict(kwargs)) for query in group]
+        tools[0].stages.extend(tools[1:])
+        tools[0].run(group[0].paths)
+        for query, tool in zip(group, tools):
+            query.retcode = int(bool(tool.errors or tool.exceptions))
+            query.exceptions = tool.exceptions
+
+    return list(queries)
@@ -5,15 +5,29 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from .cache import FingerprintTest, ParseCacheTest, ResultCacheTest
 from .helpers import (
+    ChangedFilesTest,
     DottedPartsTest,
     FilenameEndswithTest,
+    GlobPatternTest,
+    MatchRecordTest,
     PowerPartsTest,
     PrintSelectorPatternTest,
     PrintTreeTest,
+    TrackedFilesTest,
 )
 from .lib import BowlerTestCaseTest
+from .matcher import CompileMatcherTest
+from .pattern import (
+    CandidateMatcherTest,
+    CompilePatternTest,
+    DispatchHeadsTest,
+    PrefilterTest,
+    RequiredLiteralsTest,
+)
 from .query import QueryTest
 from .smoke import SmokeTest
-from .tool import ToolTest
+from .tool import ToolTest, ToolWorkerTest
 from .type_inference import ExpressionTest, OpMinTypeTest
+from .writer import WriterTest
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import types
+from pathlib import Path
+from unittest import TestCase, mock
+
+import volatile
+from fissix import pygram
+
+from .. import __version__
+from ..cache import ParseCache, fingerprint
+from ..query import Query
+from ..tool import BowlerTool, fixer_specs
+
+SOURCE = "def foo(a):\n    return a\n"
+
+
+class ParseCacheTest(TestCase):
+    def test_key(self):
+        cache = ParseCache("unused")
+        grammar = pygram.python_grammar
+        no_print = pygram.python_grammar_no_print_statement
+        key = cache.key(SOURCE, grammar)
+        self.assertEqual(key, cache.key(SOURCE, grammar))
+        self.assertNotEqual(key, cache.key(SOURCE + "\n", grammar))
+        self.assertNotEqual(key, cache.key(SOURCE, no_print))
+
+    def test_round_trip(self):
+        with volatile.dir() as d:
+            tool = BowlerTool(Query().compile(), parse_cache=d)
+            first = tool.parse_source(SOURCE, "a.py")
+            second = tool.parse_source(SOURCE, "b.py")
+            self.assertEqual((tool.parse_cache.hits, tool.parse_cache.misses), (1, 1))
+            self.assertIsNot(first, second)
+            self.assertEqual(str(second), SOURCE)
+            self.assertEqual(second, first)
+            self.assertEqual(second.future_features, first.future_features)
+
+    def test_corrupt_entry(self):
+        with volatile.dir() as d:
+            cache = ParseCache(d)
+            key = cache.key(SOURCE, pygram.python_grammar)
+            cache.entry(key).parent.mkdir(parents=True)
+            cache.entry(key).write_bytes(b"garbage")
+            self.assertIsNone(cache.get(key))
+            self.assertFalse(cache.entry(key).exists())
+            self.assertEqual(cache.misses, 1)
+
+    def test_prune(self):
+        with volatile.dir() as d:
+            tool = BowlerTool(Query().compile(), parse_cache=d)
+            keys = []
+            for index in range(3):
+                source = f"x = {index}\n"
+                tool.parse_source(source, "a.py")
+                keys.append(tool.parse_cache.key(source, tool.grammar))
+                os.utime(tool.parse_cache.entry(keys[-1]), (index, index))
+            size = tool.parse_cache.entry(keys[0]).stat().st_size
+
+            tool.parse_cache.max_bytes = size * 2
+            self.assertEqual(tool.parse_cache.prune(), 1)
+            self.assertFalse(tool.parse_cache.entry(keys[0]).exists())
+            self.assertTrue(tool.parse_cache.entry(keys[2]).exists())
+
+    def test_counters(self):
+        with volatile.dir() as d:
+            src = Path(d) / "src"
+            src.mkdir()
+            (src / "a.py").write_text(SOURCE)
+            cache = str(Path(d) / "cache")
+
+            for expected in ((0, 1), (1, 0)):
+                query = Query(str(src)).select_function("foo").rename("bar")
+                tool = query.build_tool(silent=True, parse_cache=cache)
+                tool.run(query.paths)
+                self.assertEqual((tool.parse_hits, tool.parse_misses), expected)
+                self.assertEqual(tool.options["parse_cache"], cache)
+
+
+def rename_foo(node, capture, filename):
+    capture["function_name"].value = "bar"
+    capture["function_name"].changed()
+
+
+class FingerprintTest(TestCase):
+    def test_stable(self):
+        def transforms(name):
+            return fixer_specs(Query().select_function("foo").rename(name).compile())
+
+        self.assertIsNotNone(fingerprint(transforms("bar")))
+        self.assertEqual(fingerprint(transforms("bar")), fingerprint(transforms("bar")))
+        self.assertNotEqual(
+            fingerprint(transforms("bar")), fingerprint(transforms("baz"))
+        )
+
+    def test_unstable(self):
+        class Opaque:
+            def __reduce__(self):
+                raise TypeError("nope")
+
+        opaque = Opaque()
+        self.assertIsNone(fingerprint(lambda: opaque))
+        self.assertIsNone(fingerprint([object.__repr__(opaque)]))
+
+    def test_described_by_name(self):
+        # helper modules and their state could change without the cache knowing
+        namespace = {"__name__": "helpers", "TABLE": {}, "os": os}
+        namespace["syms"] = pygram.python_symbols
+        exec("def table():\n    return TABLE\n", namespace)
+        exec("def path():\n    return os.path, syms.funcdef\n", namespace)
+        self.assertIsNone(fingerprint(namespace["table"]))
+        self.assertIsNotNone(fingerprint(namespace["path"]))
+        self.assertIsNone(fingerprint([types.ModuleType("helpers")]))
+        self.assertIsNone(fingerprint([type("Generated", (), {})]))
+
+    def test_version(self):
+        self.assertIn(__version__, ParseCache("unused").version)
+
+
+class ResultCacheTest(TestCase):
+    def run_query(self, root, cache, **kwargs):
+        query = Query(str(root)).select_function("foo").modify(rename_foo)
+        tool = query.build_tool(silent=True, result_cache=cache, **kwargs)
+        tool.run(query.paths)
+        return tool
+
+    def test_rerun(self):
+        with volatile.dir() as d:
+            root = Path(d) / "src"
+            root.mkdir()
+            (root / "a.py").write_text(SOURCE)
+            (root / "b.py").write_text("foo = 1\n")
+            cache = str(Path(d) / "cache")
+
+            tool = self.run_query(root, cache)
+            self.assertEqual((tool.result_hits, tool.result_misses), (0, 2))
+
+            with mock.patch.object(BowlerTool, "process_hunks") as process_hunks:
+                tool = self.run_query(root, cache, in_process=True)
+            self.assertEqual((tool.result_hits, tool.result_misses), (2, 0))
+            hunks = {c[0][0]: c[0][1] for c in process_hunks.call_args_list}
+            self.assertEqual(hunks[str(root / "b.py")], [])
+            self.assertIn("+def bar(a):", hunks[str(root / "a.py")][0])
+
+            (root / "b.py").write_text("foo = 2\n")
+            tool = self.run_query(root, cache, write=True)
+            self.assertEqual((tool.result_hits, tool.result_misses), (1, 1))
+            self.assertEqual((root / "a.py").read_text(), SOURCE.replace("foo", "bar"))
+
+    def test_stages(self):
+        with volatile.dir() as d:
+            (Path(d) / "a.py").write_text(SOURCE)
+            cache = str(Path(d) / "cache")
+
+            for expected in ((0, 2), (2, 0)):
+                tool = (
+                    Query(d)
+                    .select_function("foo")
+                    .rename("bar")
+                    .build_tool(silent=True, in_process=True, result_cache=cache)
+                )
+                second = (
+                    Query(d)
+                    .select_function("bar")
+                    .rename("baz")
+                    .build_tool(silent=True, in_process=True, result_cache=cache)
+                )
+                tool.stages.append(second)
+                with mock.patch.object(
+                    BowlerTool,
+                    "parse_source",
+                    autospec=True,
+                    side_effect=BowlerTool.parse_source,
+                ) as parse_source:
+                    tool.run([d])
+                self.assertEqual((tool.result_hits, tool.result_misses), expected)
+                self.assertEqual(parse_source.call_count, 1 if expected[1] else 0)
+                self.assertEqual(second.files, [str(Path(d) / "a.py")])
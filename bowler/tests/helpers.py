@@ -5,17 +5,26 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
+import subprocess
 import unittest
 
+import volatile
 from fissix.pytree import Leaf, Node
 
 from ..helpers import (
+    changed_files,
     dotted_parts,
     filename_endswith,
+    format_match,
+    glob_pattern,
+    match_record,
     power_parts,
     print_selector_pattern,
     print_tree,
+    tracked_files,
 )
+from ..types import GitError
 from .lib import BowlerTestCase
 
 
@@ -90,6 +99,27 @@ arith_expr < 'x' rest='+' rest='1' > \n"""
         self.assertMultiLineEqual(expected, self.buffer.getvalue())
 
 
+class MatchRecordTest(BowlerTestCase):
+    def test_match_record(self):
+        node = self.parse_line("x = foo(1,\n    2)  # bar")
+        call = node.children[2]
+        capture = {"node": call, "args": call.children[1].children[1].children}
+        match = match_record(call, capture, "a.py")
+        self.assertEqual(
+            (match.filename, match.line, match.column, match.node_type),
+            ("a.py", 1, 4, "power"),
+        )
+        self.assertEqual(match.captures, {"args": "1, 2"})
+        self.assertEqual(format_match(match), "a.py:1:4: power args='1, 2'")
+
+    def test_match_record_leaf(self):
+        node = self.parse_line("x = " + "y" * 100)
+        leaf = node.children[2]
+        match = match_record(leaf, {"name": leaf}, "a.py")
+        self.assertEqual(match.node_type, "NAME")
+        self.assertEqual(match.captures["name"], "y" * 77 + "...")
+
+
 class PowerPartsTest(unittest.TestCase):
     def test_power_parts_include_trailer(self):
         self.assertEqual(["'Model'"], power_parts("Model"))
@@ -123,3 +153,104 @@ class FilenameEndswithTest(unittest.TestCase):
         self.assertTrue(py("foo/foo.pyi"))
         self.assertFalse(py("foo.txt"))
         self.assertFalse(py("foo/foo.txt"))
+
+
+class GlobPatternTest(unittest.TestCase):
+    def test_globs(self):
+        self.assertIsNone(glob_pattern([]))
+        pattern = glob_pattern(
+            ["**/third_party/**", "./build", "src/*.py", "t[!a]?.py"]
+        )
+        for path in (
+            "third_party",
+            "a/b/third_party",
+            "a/third_party/c/d.py",
+            "build",
+            "src/a.py",
+            "tb1.py",
+        ):
+            self.assertTrue(pattern.fullmatch(path), path)
+        for path in (
+            "third_party_x",
+            "a/build",
+            "build/a.py",
+            "src/a/b.py",
+            "src/a.pyc",
+            "ta1.py",
+            "tb/1.py",
+        ):
+            self.assertFalse(pattern.fullmatch(path), path)
+
+
+def git_repo(path, files):
+    """Create a git repository with the given files committed."""
+    subprocess.run(["git", "init", "-q", path], check=True)
+    for name, content in files.items():
+        os.makedirs(os.path.join(path, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(path, name), "w") as f:
+            f.write(content)
+    subprocess.run(["git", "add", "-A"], cwd=path, check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + ["commit", "-q", "-m", "initial"],
+        cwd=path,
+        check=True,
+    )
+
+
+class ChangedFilesTest(unittest.TestCase):
+    def test_changed_files(self):
+        with volatile.dir() as d:
+            git_repo(d, {"a.py": "", "b.py": "", "pkg/c.py": "", "pkg/d.py": ""})
+            for name in ("a.py", "pkg/c.py", "pkg/e.py", ".hidden/f.py"):
+                os.makedirs(os.path.join(d, os.path.dirname(name)), exist_ok=True)
+                with open(os.path.join(d, name), "w") as f:
+                    f.write("x = 1\n")
+            os.remove(os.path.join(d, "pkg/d.py"))
+
+            self.assertEqual(
+                changed_files(d, "HEAD"),
+                [
+                    os.path.join(d, "a.py"),
+                    os.path.join(d, "pkg", "c.py"),
+                    os.path.join(d, "pkg", "e.py"),
+                ],
+            )
+            pkg = os.path.join(d, "pkg")
+            self.assertEqual(
+                changed_files(pkg, "HEAD"),
+                [os.path.join(pkg, "c.py"), os.path.join(pkg, "e.py")],
+            )
+            a = os.path.join(d, "a.py")
+            self.assertEqual(changed_files(a, "HEAD"), [a])
+            self.assertEqual(changed_files(os.path.join(d, "b.py"), "HEAD"), [])
+
+    def test_bad_revision(self):
+        with volatile.dir() as d:
+            git_repo(d, {"a.py": ""})
+            with self.assertRaises(GitError):
+                changed_files(d, "no-such-revision")
+
+
+class TrackedFilesTest(unittest.TestCase):
+    def test_tracked_files(self):
+        with volatile.dir() as d:
+            git_repo(
+                d,
+                {".gitignore": "build/\n", "b.py": "", "a/c.py": "", "a.py": ""},
+            )
+            for name in ("build/d.py", "e.py", "a/b/f.py"):
+                os.makedirs(os.path.join(d, os.path.dirname(name)), exist_ok=True)
+                with open(os.path.join(d, name), "w") as f:
+                    f.write("x = 1\n")
+
+            self.assertEqual(
+                tracked_files(d),
+                [".gitignore", "a.py", "b.py", "e.py", "a/c.py", "a/b/f.py"],
+            )
+            self.assertEqual(tracked_files(os.path.join(d, "a")), ["c.py", "b/f.py"])
+
+    def test_not_a_checkout(self):
+        with volatile.dir() as d:
+            with self.assertRaises(GitError):
+                tracked_files(d)
@@ -68,6 +68,7 @@ class BowlerTestCase(unittest.TestCase):
             raise ValueError("Pass modifier")
 
         exception_queue = multiprocessing.Queue()
+        local_exceptions = []
 
         def store_exceptions_on(func):
             @functools.wraps(func)
@@ -76,6 +77,7 @@ class BowlerTestCase(unittest.TestCase):
                 try:
                     return func(node, capture, filename)
                 except Exception as e:
+                    local_exceptions.append(e)
                     exception_queue.put(e)
 
             return inner
@@ -126,6 +128,10 @@ class BowlerTestCase(unittest.TestCase):
             # at all unless you pass --debug, and even then you don't get the
             # traceback.
             # See https://github.com/facebookincubator/Bowler/issues/63
+            # Exceptions raised in this process are checked directly, since the
+            # queue may not have flushed them yet.
+            if local_exceptions:
+                raise AssertionError from local_exceptions[0]
             if not exception_queue.empty():
                 raise AssertionError from exception_queue.get()
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sys
+from unittest import TestCase
+
+from fissix.fixes.fix_idioms import FixIdioms
+from fissix.fixes.fix_ws_comma import FixWsComma
+from fissix.patcomp import PatternCompiler
+
+from ..matcher import compile_matcher, expensive
+from ..pattern import dispatch_heads
+from ..query import SELECTORS, Query
+
+SOURCE = """\
+import os
+import os.path as osp
+from foo import (bar, baz as qux)
+from foo.bar import foo
+
+
+@decorator
+def foo(self, a, *args, b=1, **kwargs):
+    x = foo(a, b=b).bar.foo()
+    x.foo = y = foo
+    v = list(x)
+    v.sort()
+    return os.path.join(a, str(b))
+
+
+class Foo(Base, foo.Foo, metaclass=Meta):
+    foo = 1
+    bar: int = 2
+
+    def foo(cls):
+        super().foo(1, 2)[3].foo
+
+
+while 1:
+    isinstance(x, foo)
+    print(a.b.c.d.e.f(g)(h)[i].foo)
+"""
+
+
+def same(expected, actual):
+    """Whether two results dicts capture the very same nodes."""
+    if expected.keys() != actual.keys():
+        return False
+    for key, value in expected.items():
+        other = actual[key]
+        if isinstance(value, list):
+            if not isinstance(other, list) or len(value) != len(other):
+                return False
+            if any(a is not b for a, b in zip(value, other)):
+                return False
+        elif value is not other:
+            return False
+    return True
+
+
+class CompileMatcherTest(TestCase):
+    def assertMatchesLikeFissix(self, pattern, tree):
+        compiled = PatternCompiler().compile_pattern(pattern)
+        for variant in (compiled, dispatch_heads(compiled)):
+            matcher = compile_matcher(variant)
+            matches = 0
+            for node in tree.pre_order():
+                expected, actual = {}, {}
+                result = compiled.match(node, expected)
+                self.assertEqual(result, matcher(node, actual), str(node))
+                if result:
+                    matches += 1
+                    self.assertTrue(same(expected, actual), (expected, actual))
+            self.assertTrue(matches, pattern)
+
+    def test_selectors(self):
+        tree = Query().build_tool(silent=True).parse_source(SOURCE, "a.py")
+        for selector in ("module", "class", "method", "function", "attribute", "var"):
+            for name in ("foo", "os", "os.path", "Foo", "Base", "x"):
+                query = getattr(Query(), f"select_{selector}")(name)
+                pattern = SELECTORS[selector].format(**query.current.kwargs)
+                compiled = compile_matcher(PatternCompiler().compile_pattern(pattern))
+                if not any(compiled(node, {}) for node in tree.pre_order()):
+                    continue
+                with self.subTest(selector=selector, name=name):
+                    self.assertMatchesLikeFissix(pattern, tree)
+
+    def test_patterns(self):
+        tree = Query().build_tool(silent=True).parse_source(SOURCE, "a.py")
+        for pattern in (
+            FixIdioms.PATTERN,
+            FixWsComma.PATTERN,
+            "power< any* trailer< any* >* trailer< '.' name='foo' any* > rest=any* >",
+            "power< first=any* trailer< '.' 'foo' > any* >",
+            "arglist< (args=any ',')+ last=any >",
+            "parameters< '(' (not ')' any)* ')' >",
+            "classdef< 'class' name=NAME any* suite< any* > >",
+            "( 'x' | 'v' | any< 'v' '=' any > )",
+            "power< (first=any* trailer)* trailer< '.' 'foo' > >",
+            "power< (pairs=(any any) | single=any)* trailer< '(' any* ')' > >",
+            "power< ( (any* trailer)* any )* last=trailer< '.' 'foo' > >",
+        ):
+            with self.subTest(pattern):
+                self.assertMatchesLikeFissix(pattern, tree)
+
+    def test_deep(self):
+        source = "x = f(" + ", ".join(f"a{i}" for i in range(4000)) + ")\n"
+        tree = Query().build_tool(silent=True).parse_source(source, "a.py")
+        pattern = "arglist< (args=any ',')* last=any >"
+        matcher = compile_matcher(PatternCompiler().compile_pattern(pattern))
+        arglist = next(tree.leaves()).next_sibling.next_sibling.children[1].children[1]
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(500)
+        try:
+            results = {}
+            self.assertTrue(matcher(arglist, results))
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(results["last"].value, "a3999")
+
+    def test_memoized(self):
+        # fissix takes exponential time to rule out these nested wildcards
+        source = "a" + "".join(f".b{i}" for i in range(40)) + "\n"
+        tree = Query().build_tool(silent=True).parse_source(source, "a.py")
+        power = tree.children[0].children[0]
+        for name, expected in (("zzz", False), ("b39", True)):
+            pattern = f"power< (any* trailer)* trailer< '.' last='{name}' > >"
+            matcher = compile_matcher(PatternCompiler().compile_pattern(pattern))
+            results = {}
+            self.assertEqual(matcher(power, results), expected)
+        self.assertIs(results["last"], power.children[-1].children[1])
+
+    def test_expensive(self):
+        for pattern, expected in (
+            ("power< any* trailer< any* >* trailer< '.' 'foo' > any* >", False),
+            ("power< (any* trailer)* trailer< '.' 'foo' > >", False),
+            ("power< ( (any* trailer)* any )* trailer< '.' 'foo' > >", True),
+            ("( 'x' | any< ( any< (any* 'y')+ > any* )* > )", False),
+        ):
+            with self.subTest(pattern):
+                compiled = PatternCompiler().compile_pattern(pattern)
+                self.assertEqual(expensive(compiled), expected)
+
+        with self.assertLogs("bowler.query", "WARNING"):
+            Query().select("power< ( (any* trailer)* any )* >").compile()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from unittest import TestCase
+
+from fissix.patcomp import PatternCompiler
+from fissix.pygram import python_symbols as syms
+from fissix.pytree import Node
+
+from ..pattern import (
+    CandidateMatcher,
+    HeadDispatchPattern,
+    Prefilter,
+    compile_pattern,
+    dispatch_heads,
+    required_literals,
+    resume_post_order,
+)
+from ..query import SELECTORS, Query
+
+
+def selector_pattern(query: Query) -> str:
+    transform = query.current
+    return SELECTORS[transform.selector].format(**transform.kwargs)
+
+
+class RequiredLiteralsTest(TestCase):
+    def test_selectors(self):
+        for query, expected in (
+            (Query().select_function("foo"), ({"foo"},)),
+            (Query().select_class("Foo"), ({"Foo"},)),
+            (Query().select_var("x"), ({"x"},)),
+            (Query().select_attribute("attr"), ({"attr"},)),
+            (Query().select_root(), None),
+        ):
+            with self.subTest(query.current.selector):
+                literals = required_literals(selector_pattern(query))
+                if expected is None:
+                    self.assertIsNone(literals)
+                else:
+                    self.assertEqual([set(c) for c in literals], list(expected))
+
+    def test_patterns(self):
+        for pattern, expected in (
+            ("power< 'print' trailer< '(' any* ')' > >", [{"print"}]),
+            ("power< 'os' trailer< '.' 'path' > any* >", [{"os"}, {"path"}]),
+            ("( 'foo' | 'bar' )", [{"foo", "bar"}]),
+            ("( 'foo' | any )", None),
+            ("[ 'foo' ] 'bar'", [{"bar"}]),
+            ("funcdef< 'def' any* >", None),
+            ("STRING", None),
+        ):
+            with self.subTest(pattern):
+                literals = required_literals(pattern)
+                if expected is None:
+                    self.assertIsNone(literals)
+                else:
+                    self.assertEqual([set(c) for c in literals], expected)
+
+
+class PrefilterTest(TestCase):
+    def test_may_match(self):
+        prefilter = Prefilter([(frozenset(["foo"]), frozenset(["bar", "baz"]))])
+        self.assertTrue(prefilter.may_match(b"foo(baz)"))
+        self.assertTrue(prefilter.may_match(b"bar = foo"))
+        self.assertFalse(prefilter.may_match(b"foo()"))
+        self.assertFalse(prefilter.may_match(b"food(bar)"))
+        self.assertEqual(prefilter.skipped, 2)
+
+    def test_any_fixer(self):
+        prefilter = Prefilter([(frozenset(["foo"]),), (frozenset(["bar"]),)])
+        self.assertTrue(prefilter.may_match(b"bar"))
+        self.assertFalse(prefilter.may_match(b"baz"))
+
+    def test_unknown(self):
+        prefilter = Prefilter([(frozenset(["foo"]),), None])
+        self.assertIsNone(prefilter.fixers)
+        self.assertTrue(prefilter.may_match(b"baz"))
+        self.assertIsNone(Prefilter([]).fixers)
+
+
+SOURCE = """\
+def foo(a):
+    return foo(a.foo)
+
+
+foo = bar(foo)
+"""
+
+
+def parse(source: str) -> Node:
+    return Query().build_tool(silent=True).parse_source(source, "a.py")
+
+
+class CandidateMatcherTest(TestCase):
+    def test_candidates(self):
+        tool = Query().select_function("foo").rename("baz").build_tool(silent=True)
+        matcher = CandidateMatcher(tool.post_order)
+        self.assertTrue(matcher.complete)
+        tree = parse(SOURCE)
+        candidates = [node for node, _fixers in matcher.run(tree)]
+        matches = [node for node in candidates if tool.post_order[0].match(node)]
+        self.assertEqual(
+            [node for node in tree.post_order() if tool.post_order[0].match(node)],
+            matches,
+        )
+        self.assertEqual(len(matches), 2)
+        # attribute access and names aren't even tried
+        self.assertNotIn(syms.trailer, [node.type for node in candidates])
+
+    def test_incomplete(self):
+        tool = Query().select_root().build_tool(silent=True)
+        self.assertFalse(CandidateMatcher(tool.post_order).complete)
+
+    def test_resume_post_order(self):
+        tree = parse(SOURCE)
+        nodes = list(tree.post_order())
+        for index in (0, 5, len(nodes) - 2):
+            with self.subTest(index):
+                self.assertEqual(
+                    list(resume_post_order(nodes[index])), nodes[index + 1 :]
+                )
+
+
+class DispatchHeadsTest(TestCase):
+    def test_selectors(self):
+        tree = parse(SOURCE + "import foo\nfrom foo import bar\nclass foo(foo): pass\n")
+        for query in (
+            Query().select_module("foo"),
+            Query().select_class("foo"),
+            Query().select_function("foo"),
+            Query().select_attribute("foo"),
+            Query().select_var("foo"),
+        ):
+            with self.subTest(query.current.selector):
+                pattern = PatternCompiler().compile_pattern(selector_pattern(query))
+                dispatched = dispatch_heads(pattern)
+                self.assertIsInstance(dispatched, HeadDispatchPattern)
+                for node in tree.pre_order():
+                    expected = {}
+                    results = {}
+                    self.assertEqual(
+                        pattern.match(node, expected), dispatched.match(node, results)
+                    )
+                    self.assertEqual(expected, results)
+
+    def test_order(self):
+        pattern = PatternCompiler().compile_pattern("( any | NAME )")
+        dispatched = dispatch_heads(pattern)
+        self.assertIsInstance(dispatched, HeadDispatchPattern)
+        leaf = parse("foo\n").leaves().__next__()
+        self.assertIs(dispatched.heads[leaf.type][0], dispatched.others[0])
+
+    def test_unchanged(self):
+        for pattern in ("funcdef< any* >", "( 'foo' 'bar' | 'baz' )", "( 'a' | 'b' )*"):
+            with self.subTest(pattern):
+                compiled = PatternCompiler().compile_pattern(pattern)
+                self.assertIs(dispatch_heads(compiled), compiled)
+
+
+class CompilePatternTest(TestCase):
+    def test_shared(self):
+        pattern = selector_pattern(Query().select_function("foo"))
+        first = Query().select_function("foo").build_tool(silent=True)
+        second = Query().select_function("foo").rename("bar").build_tool(silent=True)
+        self.assertIs(first.post_order[0].pattern, second.post_order[0].pattern)
+        self.assertIs(compile_pattern(pattern), compile_pattern(pattern))
+        self.assertIsInstance(compile_pattern(pattern), HeadDispatchPattern)
@@ -5,10 +5,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from pathlib import Path
 from unittest import mock
 
-from ..query import SELECTORS, Query
+import volatile
+
+from ..query import SELECTORS, Query, run_all
+from ..tool import BowlerTool, apply_single_file
 from ..types import TOKEN, Leaf
+from .helpers import git_repo
 from .lib import BowlerTestCase
 
 
@@ -343,3 +348,159 @@ class Bar:
             self.assertIn(
                 "Only the last fixer/callback may return", error.call_args[0][0]
             )
+
+    def test_since(self):
+        with volatile.dir() as d:
+            git_repo(d, {"a.py": "def foo():\n    pass\n", "b.py": "foo()\n"})
+            Path(d, "c.py").write_text("foo()\n")
+            query = Query(d).select_function("foo").rename("bar").since("HEAD")
+            with mock.patch.object(BowlerTool, "refactor_dir") as refactor_dir:
+                query.write(in_process=True)
+            refactor_dir.assert_not_called()
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(Path(d, "a.py").read_text(), "def foo():\n    pass\n")
+            self.assertEqual(Path(d, "b.py").read_text(), "foo()\n")
+            self.assertEqual(Path(d, "c.py").read_text(), "bar()\n")
+
+    def test_iter_matches(self):
+        source = "def foo(a):\n    return a\n\n\nfoo(1)\nx = foo\n"
+        with volatile.dir() as d:
+            path = Path(d) / "a.py"
+            path.write_text(source)
+            modifier = mock.Mock()
+            for in_process in (True, False):
+                query = (
+                    Query(d)
+                    .select_function("foo")
+                    .filter(lambda node, capture, filename: "function_call" in capture)
+                    .modify(modifier)
+                )
+                matches = list(query.iter_matches(in_process=in_process))
+                self.assertEqual(query.retcode, 0)
+                self.assertEqual(len(matches), 1)
+                self.assertEqual(
+                    (matches[0].filename, matches[0].line, matches[0].column),
+                    (str(path), 5, 0),
+                )
+                self.assertEqual(matches[0].node_type, "power")
+                self.assertEqual(matches[0].captures["function_arguments"], "1")
+            modifier.assert_not_called()
+            self.assertEqual(path.read_text(), source)
+
+    def test_write_direct(self):
+        sources = {
+            "a.py": "def foo():\r\n    return 1\r\n".encode(),
+            "b.py": "# coding: latin-1\nfoo('\xe9')".encode("latin-1"),
+            "c.py": b"bar()\n",
+        }
+        expected = {
+            "a.py": "def baz():\r\n    return 1\r\n".encode(),
+            "b.py": "# coding: latin-1\nbaz('\xe9')".encode("latin-1"),
+            "c.py": b"bar()\n",
+        }
+        for in_process in (True, False):
+            with volatile.dir() as d, mock.patch(
+                "bowler.tool.apply_single_file"
+            ) as patched:
+                for name, data in sources.items():
+                    Path(d, name).write_bytes(data)
+                query = Query(d).select_function("foo").rename("baz")
+                tool = query.build_tool(
+                    write=True, silent=True, interactive=False, in_process=in_process
+                )
+                self.assertEqual(tool.run([d]), 0)
+                patched.assert_not_called()
+                self.assertEqual(tool.files_written, 2)
+                self.assertEqual(
+                    tool.bytes_saved, len(sources["a.py"] + sources["b.py"])
+                )
+                for name, data in expected.items():
+                    self.assertEqual(Path(d, name).read_bytes(), data)
+
+        # hunks go through processors when any query has them
+        with volatile.dir() as d:
+            Path(d, "a.py").write_text("def foo():\n    return x\n")
+            processor = mock.Mock(return_value=True)
+            queries = [
+                Query(d).select_function("foo").rename("baz"),
+                Query(d).select_var("x").rename("y").process(processor),
+            ]
+            with mock.patch(
+                "bowler.tool.apply_single_file", wraps=apply_single_file
+            ) as patched:
+                run_all(queries, write=True, silent=True, in_process=True)
+            self.assertEqual(patched.call_count, 2)
+            processor.assert_called_once()
+            self.assertEqual(Path(d, "a.py").read_text(), "def baz():\n    return y\n")
+
+        with volatile.dir() as d:
+            Path(d, "a.py").write_text("def foo():\n    return x\n")
+            queries = [
+                Query(d).select_function("foo").rename("baz"),
+                Query(d).select_var("x").rename("y"),
+            ]
+            with mock.patch("bowler.tool.apply_single_file") as patched:
+                run_all(queries, write=True, silent=True, in_process=True)
+            patched.assert_not_called()
+            self.assertEqual(Path(d, "a.py").read_text(), "def baz():\n    return y\n")
+
+    def test_run_all(self):
+        with volatile.dir() as d:
+            path = Path(d) / "foo.py"
+            path.write_text("x = 1\n\n\ndef foo(a):\n    return a + x\n")
+            processed = []
+
+            def processor(filename, hunk):
+                processed.append(hunk[3:])
+                return True
+
+            queries = [
+                Query(d).select_function("foo").rename("bar").process(processor),
+                Query(d).select_var("x").rename("y").process(processor),
+                Query(d).select_var("missing").rename("z").process(processor),
+            ]
+            original = BowlerTool.parse_source
+            with mock.patch.object(BowlerTool, "parse_source", autospec=True) as m:
+                m.side_effect = original
+                result = run_all(queries, write=True, silent=True, in_process=True)
+            self.assertEqual(m.call_count, 1)
+
+            self.assertEqual(result, queries)
+            self.assertEqual([q.retcode for q in queries], [0, 0, 0])
+            self.assertEqual(
+                path.read_text(), "y = 1\n\n\ndef bar(a):\n    return a + y\n"
+            )
+            self.assertEqual(
+                processed,
+                [
+                    [
+                        " x = 1",
+                        " ",
+                        " ",
+                        "-def foo(a):",
+                        "+def bar(a):",
+                        "     return a + x",
+                    ],
+                    [
+                        "-x = 1",
+                        "+y = 1",
+                        " ",
+                        " ",
+                        " def bar(a):",
+                        "-    return a + x",
+                        "+    return a + y",
+                    ],
+                ],
+            )
+
+    def test_run_all_bad_transform(self):
+        with volatile.dir() as d:
+            path = Path(d) / "foo.py"
+            path.write_text("def foo(a):\n    return a\n")
+            queries = [
+                Query(d).select_function("foo").rename("foo/"),
+                Query(d).select_function("foo").rename("bar"),
+            ]
+            run_all(queries, write=True, silent=True, in_process=True)
+            self.assertEqual([q.retcode for q in queries], [1, 0])
+            self.assertEqual(path.read_text(), "def bar(a):\n    return a\n")
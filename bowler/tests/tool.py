@@ -5,13 +5,38 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import difflib
+import multiprocessing
 import os
+import pickle
+import random
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from unittest import TestCase, mock
 
-from ..query import Query
-from ..tool import BadTransform, BowlerTool, log
-from ..types import BowlerQuit
+import volatile
+from fissix.fixes.fix_print import FixPrint
+from fissix.pgen2 import token
+from fissix.pgen2.parse import ParseError
+from fissix.pgen2.tokenize import TokenError
+from fissix.pytree import Leaf
+
+from ..query import Query, run_all
+from ..tool import (
+    BadTransform,
+    BowlerTool,
+    Pool,
+    build_fixers,
+    build_tool,
+    diff_texts,
+    fixer_specs,
+    log,
+    stage_patterns,
+    stage_specs,
+)
+from ..types import BowlerQuit, Filename, Match
+from .helpers import git_repo
 
 target = Path(__file__).parent / "smoke-target.py"
 hunks = [
@@ -72,6 +97,15 @@ class ToolTest(TestCase):
 
         mock_patch.assert_called_with(input, string_hunks)
 
+    def test_print_match(self):
+        tool = BowlerTool(Query().compile(), find=True)
+        tool.print_match(Match(Filename("a.py"), 1, 4, "power", {"args": "'1, 2'"}))
+        tool.print_match(Match(Filename("a.py"), 2, 0, "funcdef", {}))
+        self.assertEqual(
+            [c[0][0] for c in self.mock_echo.call_args_list],
+            ["a.py:1:4: power args=\"'1, 2'\"", "a.py:2:0: funcdef"],
+        )
+
     @mock.patch.object(log, "exception")
     def test_process_hunks_invalid_hunks(self, mock_log):
         tool = BowlerTool(Query().compile(), write=True, interactive=False, silent=True)
@@ -155,3 +189,744 @@ class ToolTest(TestCase):
         tool = BowlerTool(Query().compile(), silent=False)
         with self.assertRaises(BadTransform):
             tool.processed_file(new_text="x=1///2", filename="foo.py", old_text="x=1/2")
+
+    def test_validate_strategies(self):
+        old_text = "def foo(a):\n    return a\n\n\nx = 1\n"
+        for strategy in ("compile", "incremental", "full"):
+            tool = BowlerTool(
+                Query().compile(), options={"print_function": True}, validate=strategy
+            )
+            for old_value, new_value, valid in (
+                ("1", "2", True),
+                ("1", "(1", False),
+                ("a", "a +", False),
+                ("def", "print 'foo'\ndef", False),
+            ):
+                tree = tool.parse_source(old_text, "foo.py")
+                leaf = next(leaf for leaf in tree.leaves() if leaf.value == old_value)
+                leaf.value = new_value
+                new_text = str(tree)
+                with self.subTest(strategy=strategy, new_text=new_text):
+                    if valid:
+                        hunks = tool.processed_file(
+                            new_text, "foo.py", old_text, tree=tree
+                        )
+                        self.assertTrue(hunks)
+                        continue
+                    with self.assertRaises(BadTransform) as context:
+                        tool.processed_file(new_text, "foo.py", old_text, tree=tree)
+                    self.assertIsInstance(
+                        context.exception.__cause__, (ParseError, TokenError)
+                    )
+
+    def test_validate_parses_less(self):
+        old_text = "def foo(a):\n    return a\n\n\nx = 1\n"
+        new_text = old_text.replace("x = 1", "x = 2")
+        for strategy, parsed in (
+            ("compile", []),
+            ("incremental", ["x = 2\n"]),
+            ("full", [new_text]),
+        ):
+            tool = BowlerTool(
+                Query().compile(), options={"print_function": True}, validate=strategy
+            )
+            tree = tool.parse_source(new_text, "foo.py")
+            with mock.patch.object(
+                tool.driver, "parse_string", wraps=tool.driver.parse_string
+            ) as parse_string:
+                tool.processed_file(new_text, "foo.py", old_text, tree=tree)
+            with self.subTest(strategy):
+                self.assertEqual([c[0][0] for c in parse_string.call_args_list], parsed)
+
+        # python 2 source can't be compiled by CPython
+        tool = BowlerTool(Query().compile(), validate="compile")
+        with mock.patch.object(tool.driver, "parse_string") as parse_string:
+            tool.processed_file(new_text, "foo.py", old_text)
+        parse_string.assert_called_once_with(new_text)
+
+    def test_diff_texts_localized(self):
+        old_text = "".join(
+            f"def foo{i}(a):\n    x = a\n\n    return x\n\n\n" for i in range(70)
+        )
+        tool = BowlerTool(Query().compile(), options={"print_function": True})
+
+        def edit_value(tree):
+            leaf = next(leaf for leaf in tree.leaves() if leaf.value == "foo20")
+            leaf.value = "bar20"  # without changed()
+
+        def edit_node(tree):
+            statement = tree.children[30].children[4].children[-2].children[0]
+            statement.replace(Leaf(token.NAME, "raise", prefix=statement.prefix))
+            tree.children[50].children[1].value = "bar50"
+            tree.children[50].changed()
+
+        def edit_ambiguous(tree):
+            tree.children[10].prefix = "\n" + tree.children[10].prefix
+
+        for edit, localized in (
+            (edit_value, True),
+            (edit_node, True),
+            (edit_ambiguous, False),
+        ):
+            tree = tool.parse_source(old_text, "foo.py")
+            edit(tree)
+            new_text = str(tree)
+            expected = list(diff_texts(old_text, new_text, "foo.py"))
+            with self.subTest(edit.__name__), mock.patch(
+                "bowler.tool.difflib.unified_diff", wraps=difflib.unified_diff
+            ) as unified_diff:
+                self.assertEqual(
+                    list(diff_texts(old_text, new_text, "foo.py", tree)), expected
+                )
+                self.assertEqual(unified_diff.called, not localized)
+
+    def test_diff_texts_random(self):
+        tool = BowlerTool(Query().compile(), options={"print_function": True})
+        # unique lines, with some popular ones that autojunk ignores in long files
+        statements = [
+            "x{} = 1\n",
+            "def foo{}(a):\n    pass\n\n\n",
+            "if x{}:\n    pass\n",
+            "\n",
+            "y = x\n",
+        ]
+        rand = random.Random(42)
+        for count in (5, 20, 60, 250):
+            for _ in range(50):
+                old_text = "".join(
+                    rand.choice(statements).format(i) for i in range(count)
+                )
+                tree = tool.parse_source(old_text, "foo.py")
+                leaves = list(tree.leaves())
+                names = [leaf for leaf in leaves if leaf.type == token.NAME]
+                for _ in range(rand.randint(1, rand.choice([4, count // 5 + 1]))):
+                    edit = rand.randrange(3)
+                    leaf = rand.choice(names if edit < 2 else leaves)
+                    if edit == 0:
+                        leaf.value += "_"  # without changed()
+                    elif edit == 1:
+                        leaf.value = rand.choice(["x", "y", "pass", "z"])
+                        leaf.changed()
+                    else:
+                        leaf.prefix = rand.choice(["", "\n", "  "]) + leaf.prefix
+                new_text = str(tree)
+                with self.subTest(old_text=old_text, new_text=new_text):
+                    self.assertEqual(
+                        list(diff_texts(old_text, new_text, "foo.py", tree)),
+                        list(
+                            difflib.unified_diff(
+                                old_text.splitlines(),
+                                new_text.splitlines(),
+                                "foo.py",
+                                "foo.py",
+                                lineterm="",
+                            )
+                        ),
+                    )
+
+
+def rename_to_bar(node, capture, filename):
+    capture["function_name"].value = "bar"
+    capture["function_name"].changed()
+
+
+def kill_worker(node, capture, filename):
+    if Path(filename).name == "kill.py":
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+class ToolWorkerTest(TestCase):
+    def run_query(self, query_func, **kwargs):
+        with volatile.dir() as d:
+            path = Path(d) / "foo.py"
+            path.write_text("def foo():\n    pass\n\nfoo()\n")
+            query = query_func(str(path)).write(in_process=False, **kwargs)
+            return query, path.read_text()
+
+    def test_fixer_specs_roundtrip(self):
+        query = Query().select_function("foo").modify(rename_to_bar)
+        specs = fixer_specs(query.compile())
+        self.assertEqual(specs, query.transforms)
+        fixers = build_fixers(pickle.loads(pickle.dumps(specs)))
+        self.assertEqual(len(fixers), 1)
+        self.assertEqual(fixers[0].PATTERN, query.compile()[0].PATTERN)
+
+    def test_stage_patterns(self):
+        query = Query().select_function("foo").modify(rename_to_bar)
+        tool = query.build_tool(silent=True)
+        specs, options, patterns = pickle.loads(
+            pickle.dumps((stage_specs(tool), tool.options, stage_patterns(tool)))
+        )
+        self.assertEqual(list(patterns), [tool.fixers[0].PATTERN])
+        with mock.patch("bowler.pattern._compiled", {}), mock.patch(
+            "bowler.pattern.PatternCompiler"
+        ) as compiler:
+            rebuilt = build_tool(specs, options, patterns)
+        compiler.assert_not_called()
+        self.assertIs(rebuilt.post_order[0].pattern, patterns[tool.fixers[0].PATTERN])
+
+    def test_fixer_specs_plain_fixer(self):
+        specs = fixer_specs([FixPrint])
+        self.assertEqual(specs, [FixPrint])
+        self.assertEqual(build_fixers(specs), [FixPrint])
+
+    @mock.patch.object(BowlerTool, "START_METHOD", "spawn")
+    def test_spawn_worker(self):
+        with mock.patch("bowler.tool.BowlerTool.refactor_queue") as mock_queue:
+            query, text = self.run_query(
+                lambda p: Query(p).select_function("foo").modify(rename_to_bar)
+            )
+        mock_queue.assert_not_called()
+        self.assertEqual(query.retcode, 0)
+        self.assertEqual(text, "def bar():\n    pass\n\nbar()\n")
+
+    @mock.patch.object(BowlerTool, "START_METHOD", "spawn")
+    def test_spawn_builtin_modifiers(self):
+        with mock.patch("bowler.tool.BowlerTool.refactor_pending") as mock_pending:
+            query, text = self.run_query(
+                lambda p: Query(p)
+                .select_function("foo")
+                .is_def()
+                .add_argument("a", "1")
+                .rename("baz")
+            )
+        mock_pending.assert_not_called()
+        self.assertEqual(query.retcode, 0)
+        self.assertEqual(text, "def baz(a=1):\n    pass\n\nfoo()\n")
+
+    @mock.patch.object(BowlerTool, "START_METHOD", "spawn")
+    def test_spawn_unpicklable_falls_back(self):
+        with self.assertLogs(level="WARNING"):
+            query, text = self.run_query(
+                lambda p: Query(p)
+                .select_function("foo")
+                .modify(lambda n, c, f: rename_to_bar(n, c, f))
+            )
+        self.assertEqual(query.retcode, 0)
+        self.assertEqual(text, "def bar():\n    pass\n\nbar()\n")
+
+    def test_fork_worker(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("fork not available")
+        with mock.patch.object(BowlerTool, "START_METHOD", "fork"):
+            query, text = self.run_query(
+                lambda p: Query(p).select_function("foo").rename("baz")
+            )
+        self.assertEqual(query.retcode, 0)
+        self.assertEqual(text, "def baz():\n    pass\n\nbaz()\n")
+
+    def test_pool(self):
+        query_func = lambda p: Query(p).select_function("foo").modify(rename_to_bar)
+        with Pool(processes=1) as pool:
+            with mock.patch("bowler.tool.BowlerTool.refactor_queue") as mock_queue:
+                for _ in range(2):
+                    query, text = self.run_query(query_func, pool=pool)
+                    self.assertEqual(query.retcode, 0)
+                    self.assertEqual(text, "def bar():\n    pass\n\nbar()\n")
+            mock_queue.assert_not_called()
+            self.assertTrue(all(worker.process.is_alive() for worker in pool.workers))
+        self.assertEqual(pool.workers, [])
+
+    def test_pool_fresh_callbacks(self):
+        # encapsulate only adds the property once, so its state must not carry over
+        texts = []
+        with Pool(processes=1) as pool:
+            for _ in range(2):
+                with volatile.dir() as d:
+                    path = Path(d) / "bar.py"
+                    path.write_text("class Bar:\n    f = 42\n")
+                    query = (
+                        Query(str(path))
+                        .select_attribute("f")
+                        .in_class("Bar")
+                        .encapsulate()
+                        .write(in_process=False, pool=pool)
+                    )
+                    self.assertEqual(query.retcode, 0)
+                    texts.append(path.read_text())
+        self.assertIn("@property", texts[0])
+        self.assertEqual(texts[0], texts[1])
+
+    def test_pool_worker_died(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("fork not available")
+
+        with Pool(processes=1, start_method="fork") as pool, volatile.dir() as d:
+            for name in ("foo.py", "kill.py"):
+                (Path(d) / name).write_text("def foo():\n    pass\n")
+            query = Query(d).select_function("foo").modify(kill_worker)
+            query.write(in_process=False, pool=pool)
+            self.assertEqual(query.retcode, 1)
+            self.assertFalse(pool.workers[0].alive)
+
+            # the next query gets a new worker
+            pid = pool.workers[0].process.pid
+            query, text = self.run_query(
+                lambda p: Query(p).select_function("foo").modify(rename_to_bar),
+                pool=pool,
+            )
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(text, "def bar():\n    pass\n\nbar()\n")
+            self.assertNotEqual(pool.workers[0].process.pid, pid)
+
+    def test_worker_died(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("fork not available")
+
+        def kill_worker(node, capture, filename):
+            if filename.endswith("04.py"):  # first of a batch, after a sync
+                os.kill(os.getpid(), signal.SIGKILL)
+
+        for processes in (2, 1):
+            with volatile.dir() as d:
+                for index in range(20):
+                    (Path(d) / f"{index:02}.py").write_text("x = 1\n")
+                query = Query(d).select_var("x").modify(kill_worker).rename("y")
+                tool = query.build_tool(write=True, silent=True, in_process=False)
+                tool.BATCH_FILES = 4
+                tool.NUM_PROCESSES = processes
+                with mock.patch.object(BowlerTool, "START_METHOD", "fork"):
+                    self.assertEqual(tool.run([d]), 1)
+                texts = [(Path(d) / f"{i:02}.py").read_text() for i in range(20)]
+
+            self.assertIn("04.py", tool.exceptions[0].filename)
+            if processes == 2:
+                # the rest of the dead worker's batch is done by the other one
+                self.assertEqual(len(tool.exceptions), 1)
+                self.assertEqual(texts[4], "x = 1\n")
+                self.assertEqual(texts.count("y = 1\n"), 19)
+            else:
+                self.assertEqual(len(tool.exceptions), 2)
+                self.assertIn("were not refactored", str(tool.exceptions[1]))
+                self.assertEqual(texts[:4], ["y = 1\n"] * 4)
+                self.assertEqual(texts[4:], ["x = 1\n"] * 16)
+                self.assertEqual(tool.files_done, 5)
+
+    def test_worker_died_stages(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("fork not available")
+
+        def kill_worker(node, capture, filename):
+            if filename.endswith("04.py"):
+                os.kill(os.getpid(), signal.SIGKILL)
+
+        for processes in (2, 1):
+            with volatile.dir() as d:
+                for index in range(8):
+                    (Path(d) / f"{index:02}.py").write_text("x = 1\n")
+                queries = [
+                    Query(d).select_var("x").rename("y"),
+                    Query(d).select_var("y").modify(kill_worker),
+                ]
+                with mock.patch.multiple(
+                    BowlerTool,
+                    START_METHOD="fork",
+                    BATCH_FILES=4,
+                    NUM_PROCESSES=processes,
+                ):
+                    run_all(
+                        queries,
+                        write=True,
+                        interactive=False,
+                        silent=True,
+                        in_process=False,
+                    )
+
+            # either query could have been running, so both failed on the file
+            for query in queries:
+                self.assertEqual(query.retcode, 1)
+                self.assertIn("04.py", query.exceptions[0].filename)
+                self.assertEqual(len(query.exceptions), 3 - processes)
+
+    def test_pool_unpicklable_falls_back(self):
+        with Pool(processes=1) as pool, self.assertLogs(log, "WARNING"):
+            query, text = self.run_query(
+                lambda p: Query(p)
+                .select_function("foo")
+                .modify(lambda n, c, f: rename_to_bar(n, c, f)),
+                pool=pool,
+            )
+        self.assertEqual(query.retcode, 0)
+        self.assertEqual(text, "def bar():\n    pass\n\nbar()\n")
+
+    def test_batches(self):
+        tool = BowlerTool(Query().compile(), silent=True)
+        tool.BATCH_SIZE = 100
+        tool.BATCH_FILES = 3
+        sizes = {"a.py": 10, "b.py": 500, "c.py": 20, "d.py": 30, "e.py": 10}
+        for name, size in sizes.items():
+            tool.queue_work(Filename(name), size)
+        self.assertEqual(tool.queue_count, 5)
+        pending = list(tool.pending)
+
+        self.assertEqual(
+            list(tool.batches()),
+            [
+                [(1, "b.py", 500)],
+                [(0, "a.py", 10), (2, "c.py", 20), (3, "d.py", 30)],
+                [(4, "e.py", 10)],
+            ],
+        )
+        self.assertEqual(tool.pending, [])
+
+        tool.pending = pending
+        self.assertEqual(
+            list(tool.batches(ordered=True)),
+            [
+                [(0, "a.py", 10)],
+                [(1, "b.py", 500)],
+                [(2, "c.py", 20), (3, "d.py", 30), (4, "e.py", 10)],
+            ],
+        )
+
+    def test_large_files_first(self):
+        tool = BowlerTool(Query().compile(), silent=True)
+        tool.BATCH_SIZE = 100
+        tool.BATCH_FILES = 2
+        for name, size in [("a.py", 10), ("b.py", 200), ("c.py", 10), ("d.py", 10)]:
+            tool.queue_work(Filename(name), size)
+        tool.hold_batches()
+        for name, size in [("e.py", 10), ("f.py", 500)]:
+            tool.queue_work(Filename(name), size)
+        tool.hold_batches()
+
+        # large files found later still go out before small batches found earlier
+        worker = mock.Mock(alive=True, batches=[])
+        tool.workers = [worker]
+        tool.WORKER_BATCHES = 5
+        tool.queue_batch = lambda batch, worker: worker.batches.append(batch)
+        tool.dispatch()
+        self.assertEqual(
+            [[name for _, name, _ in batch] for batch in worker.batches],
+            [["f.py"], ["b.py"], ["a.py", "c.py"], ["d.py"], ["e.py"]],
+        )
+
+    def test_results_in_order(self):
+        tool = BowlerTool(Query().compile(), silent=True)
+        processed = []
+        with mock.patch.object(tool, "process_hunks") as mock_process:
+            mock_process.side_effect = lambda f, h: processed.append(f)
+            tool.handle_message((2, [("c.py", [], None)]))
+            tool.handle_message((1, [("b.py", [], None)]))
+            self.assertEqual(processed, [])
+            tool.handle_message((0, [("a.py", [], None)]))
+            self.assertEqual(processed, ["a.py", "b.py", "c.py"])
+            tool.handle_message((4, [("e.py", [], None)]))
+            tool.flush_results()
+        self.assertEqual(processed, ["a.py", "b.py", "c.py", "e.py"])
+
+    def test_streaming_in_process(self):
+        with volatile.dir() as d:
+            for name in ("a.py", "b.py"):
+                (Path(d) / name).write_text("def foo():\n    pass\n")
+            processed = []
+            original = BowlerTool.refactor_file
+
+            def refactor_file(tool, filename):
+                processed.append(("refactor", os.path.basename(filename)))
+                return original(tool, filename)
+
+            def process_hunks(filename, hunk):
+                processed.append(("process", os.path.basename(filename)))
+                return True
+
+            query = Query(d).select_function("foo").rename("bar").process(process_hunks)
+            with mock.patch.object(BowlerTool, "refactor_file", autospec=True) as m:
+                m.side_effect = refactor_file
+                query.diff(silent=True, in_process=True)
+
+        self.assertEqual(
+            processed,
+            [
+                ("refactor", "a.py"),
+                ("process", "a.py"),
+                ("refactor", "b.py"),
+                ("process", "b.py"),
+            ],
+        )
+
+    def test_iter_refactor_close(self):
+        with volatile.dir() as d:
+            for index in range(20):
+                (Path(d) / f"{index}.py").write_text("def foo():\n    pass\n")
+            tool = Query().select_function("foo").build_tool(silent=True, find=True)
+            tool.BATCH_FILES = 1
+            steps = tool.iter_refactor([d])
+            next(steps)
+            steps.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_walk(self):
+        with volatile.dir() as d:
+            for name in (
+                "a.py",
+                "b.txt",
+                ".c.py",
+                "d/e.py",
+                "d/third_party/f.py",
+                "g/third_party/h/i.py",
+                "g/j.py",
+                ".k/l.py",
+            ):
+                path = Path(d) / name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text("x = 1\n")
+            os.symlink(Path(d) / "d", Path(d) / "m")
+
+            tool = BowlerTool(Query().compile(), exclude=["**/third_party"])
+            with mock.patch.object(
+                BowlerTool, "scan_dir", autospec=True, side_effect=BowlerTool.scan_dir
+            ) as scan_dir:
+                found = list(tool.walk(d))
+            self.assertEqual(
+                found,
+                [(os.path.join(d, name), 6) for name in ("a.py", "d/e.py", "g/j.py")],
+            )
+            self.assertEqual([c[0][2] for c in scan_dir.call_args_list], ["", "d", "g"])
+
+            tool = BowlerTool(Query().compile(), include=["*/*.py"])
+            tool.walker = ThreadPoolExecutor(2)
+            found = list(tool.walk(d))
+            tool.walker.shutdown()
+            self.assertEqual(
+                [name for name, _ in found],
+                [os.path.join(d, "d/e.py"), os.path.join(d, "g/j.py")],
+            )
+
+            # batches are dispatched to workers while the walk is still running
+            query = Query(d, exclude=["g"]).select_var("x").rename("y")
+            tool = query.build_tool(write=True, silent=True, in_process=False)
+            tool.BATCH_FILES = 1
+            tool.NUM_PROCESSES = 1
+            queued = []
+            queue_batch = tool.queue_batch
+            tool.queue_batch = lambda batch, worker: (
+                queued.append((batch[0][1], tool.queue_count)),
+                queue_batch(batch, worker),
+            )
+            tool.run([d])
+            names = [os.path.join(d, name) for name in ("a.py", "d/e.py")]
+            names.append(os.path.join(d, "d/third_party/f.py"))
+            self.assertEqual(queued, [(name, i + 1) for i, name in enumerate(names)])
+            self.assertEqual(Path(d, "a.py").read_text(), "y = 1\n")
+            self.assertEqual(Path(d, "g/j.py").read_text(), "x = 1\n")
+
+    def test_git_discovery(self):
+        with volatile.dir() as d:
+            git_repo(d, {".gitignore": "build/\n", "a.py": "", "b/c.py": ""})
+            for name in ("build/d.py", "b/e.py", "b/f.txt", "b/.g.py", "h/i.py"):
+                path = Path(d) / name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text("x = 1\n")
+            os.remove(Path(d) / "a.py")
+
+            tool = BowlerTool(Query().compile(), discovery="git", exclude=["h"])
+            self.assertEqual(
+                list(tool.discover([d])),
+                [(os.path.join(d, "b/c.py"), 0), (os.path.join(d, "b/e.py"), 6)],
+            )
+            self.assertEqual(tool.discovered_by, {"git"})
+            # the same files the walker finds, when none are ignored
+            (Path(d) / "build" / "d.py").unlink()
+            self.assertEqual(
+                tool.git_files(d), list(BowlerTool(Query().compile()).walk(d))[:2]
+            )
+
+        with volatile.dir() as d:
+            (Path(d) / "a.py").write_text("x = 1\n")
+            tool = Query(d).build_tool(silent=True, in_process=True, discovery="git")
+            with mock.patch.object(tool, "log_message") as log_message:
+                tool.run([d])
+            self.assertEqual(tool.discovered_by, {"walk"})
+            self.assertEqual(tool.queue_count, 1)
+            self.assertIn(
+                mock.call("found %d files in %.3fs with %s", 1, mock.ANY, "walk"),
+                log_message.call_args_list,
+            )
+
+    def test_read_source(self):
+        sources = {
+            "utf8.py": "x = 'é'\n".encode(),
+            "bom.py": b"\xef\xbb\xbfx = 1\r\ny = 2",
+            "latin1.py": "# coding: latin-1\nx = 'é'\n".encode("latin-1"),
+            "bad.py": b"x = '\xff'\n",
+        }
+        with volatile.dir() as d:
+            for name, data in sources.items():
+                (Path(d) / name).write_bytes(data)
+            tool = BowlerTool(Query().compile(), silent=True)
+            for mmap_size in (1 << 20, 1):
+                tool.MMAP_SIZE = mmap_size
+                for name in sources:
+                    filename = os.path.join(d, name)
+                    if name == "bad.py":
+                        self.assertIsNone(tool.read_source(filename))
+                        continue
+                    expected, encoding = tool._read_python_source(filename)
+                    added = not expected.endswith("\n")
+                    self.assertEqual(
+                        tool.read_source(filename), expected + "\n" * added
+                    )
+                    self.assertEqual(tool.last_read, (filename, encoding, added))
+                    self.assertIsNone(tool.loaded)
+
+            # each file is opened once, for both the prefilter and refactoring
+            filename = os.path.join(d, "latin1.py")
+            tool = Query().select_var("x").rename("y").build_tool(silent=True)
+            with mock.patch("builtins.open", side_effect=open) as opened:
+                results = tool.refactor_task(Filename(filename))
+            self.assertEqual(len(results[0][1]), 1)
+            self.assertEqual(opened.call_count, 1)
+            self.assertIsNone(tool.loaded)
+
+    def test_write_keeps_newlines(self):
+        # files are written directly, or patched with hunks for processors
+        for process in (False, True):
+            with volatile.dir() as d:
+                path = Path(d) / "a.py"
+                path.write_bytes(b"x = 1\r\nz = x\r\n")
+                query = Query(str(path)).select_var("x").rename("y")
+                if process:
+                    query.process(lambda filename, hunk: True)
+                query.write(in_process=True)
+                self.assertEqual(path.read_bytes(), b"y = 1\r\nz = y\r\n")
+
+    def test_backpressure(self):
+        with volatile.dir() as d:
+            for index in range(200):
+                (Path(d) / f"{index:03}.py").write_text("x = 1\n")
+            query = Query().select_var("x").rename("y")
+            for in_process in (False, True):
+                tool = query.build_tool(silent=True, in_process=in_process)
+                tool.BATCH_FILES = 4
+                tool.NUM_PROCESSES = 2
+                tool.QUEUED_FILES = 16
+                waiting = []
+                handle_message = tool.handle_message
+
+                def watch(message):
+                    handle_message(message)
+                    waiting.append(tool.queue_count - tool.next_index)
+
+                tool.handle_message = watch
+                tool.run([d])
+                self.assertEqual(tool.files_done, 200)
+                self.assertEqual(tool.next_index, 200)
+                # files found but not handled never exceed the limit and a batch
+                self.assertLessEqual(max(waiting), 20)
+
+        # the walk only lists a few directories ahead of the files it yields
+        with volatile.dir() as d:
+            for index in range(50):
+                (Path(d) / f"{index:02}").mkdir()
+                (Path(d) / f"{index:02}" / "a.py").write_text("x = 1\n")
+            tool = BowlerTool(Query().compile())
+            tool.WALK_THREADS = 2
+            tool.walker = ThreadPoolExecutor(2)
+            with mock.patch.object(
+                BowlerTool, "scan_dir", autospec=True, side_effect=BowlerTool.scan_dir
+            ) as scan_dir:
+                for index, _ in enumerate(tool.walk(d)):
+                    self.assertLessEqual(scan_dir.call_count, index + 2 + 4)
+            tool.walker.shutdown()
+            self.assertEqual(index, 49)
+
+    def test_worker_stats(self):
+        with volatile.dir() as d:
+            for name in ("a.py", "b.py"):
+                (Path(d) / name).write_text("x = 1\n")
+            tool = BowlerTool(Query().compile(), silent=True, in_process=True)
+            tool.run([d])
+        stats = tool.worker_stats[os.getpid()]
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(stats.bytes, 12)
+        self.assertEqual(stats.batches, 1)
+
+    def test_bottom_up(self):
+        source = "".join(
+            f"def foo{i}(a):\n    return foo(bar(foo), foo{i}.foo)\n\n\n"
+            for i in range(BowlerTool.RESCANS + 2)
+        )
+        query = (
+            Query()
+            .select_function("foo")
+            .rename("bar")
+            .select_function("bar")
+            .add_argument("x", "1")
+            .select_var("foo")
+            .rename("baz")
+        )
+        outputs = []
+        for bottom_up in (False, True):
+            with mock.patch.object(BowlerTool, "BOTTOM_UP", bottom_up):
+                tool = query.build_tool(silent=True)
+                with mock.patch.object(
+                    BowlerTool,
+                    "traverse_by",
+                    autospec=True,
+                    side_effect=BowlerTool.traverse_by,
+                ) as traverse_by:
+                    outputs.append(str(tool.refactor_string(source, "a.py")))
+            self.assertTrue(traverse_by.called)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("    return baz(bar(baz), foo9.baz)\n", outputs[1])
+
+    def test_prefilter(self):
+        with volatile.dir() as d:
+            (Path(d) / "a.py").write_text("def foo():\n    pass\n")
+            (Path(d) / "b.py").write_text("def bar():\n    pass\n")
+            query = Query(d).select_function("foo").rename("baz")
+            for in_process in (True, False):
+                tool = query.build_tool(silent=True, in_process=in_process)
+                with mock.patch.object(
+                    BowlerTool,
+                    "parse_source",
+                    autospec=True,
+                    side_effect=BowlerTool.parse_source,
+                ) as parse_source:
+                    tool.run([d])
+                self.assertEqual(tool.files_skipped, 1)
+                self.assertEqual(sum(s.files for s in tool.worker_stats.values()), 2)
+                if in_process:
+                    parse_source.assert_called_once()
+                    self.assertEqual(parse_source.call_args[0][2], str(Path(d, "a.py")))
+
+            BowlerTool.PREFILTER = False
+            try:
+                tool = query.build_tool(silent=True, in_process=True)
+                tool.run([d])
+            finally:
+                BowlerTool.PREFILTER = True
+            self.assertEqual(tool.files_skipped, 0)
+
+    def test_unmatched(self):
+        with volatile.dir() as d:
+            (Path(d) / "a.py").write_text("def foo():\n    pass\n")
+            (Path(d) / "b.py").write_text("foo = 1\n")
+            (Path(d) / "c.py").write_text("bar = 1\n")
+            query = Query(d).select_function("foo").rename("baz")
+            for in_process in (True, False):
+                tool = query.build_tool(silent=True, in_process=in_process)
+                with mock.patch.object(
+                    BowlerTool,
+                    "processed_file",
+                    autospec=True,
+                    side_effect=BowlerTool.processed_file,
+                ) as processed_file:
+                    tool.run([d])
+                self.assertEqual(tool.files_modified, 1)
+                self.assertEqual(tool.files_unmatched, 1)
+                self.assertEqual(tool.files_skipped, 1)
+                if in_process:
+                    processed_file.assert_called_once()
+                    self.assertEqual(tool.files, [str(Path(d, "a.py"))])
+
+            # with several stages, files are unmatched when no stage matches
+            tool = query.build_tool(silent=True, in_process=True)
+            other = Query(d).select_var("foo").rename("qux").build_tool(silent=True)
+            tool.stages.append(other)
+            tool.run([d])
+            self.assertEqual(tool.files_modified, 2)
+            self.assertEqual(tool.files_unmatched, 0)
+            self.assertEqual(tool.files, [str(Path(d, "a.py"))])
+            self.assertEqual(other.files, [str(Path(d, "b.py"))])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import threading
+from pathlib import Path
+from unittest import TestCase, mock
+
+import volatile
+
+from ..query import Query
+from ..writer import TEMP_SUFFIX, Writer, recover_journal
+
+
+class WriterTest(TestCase):
+    def test_write(self):
+        with volatile.dir() as d:
+            target = Path(d) / "a.py"
+            target.write_text("old\n")
+            target.chmod(0o754)
+            link = Path(d) / "link.py"
+            link.symlink_to(target)
+
+            writer = Writer()
+            writer.write(str(link), "new\r\n", newline="")
+            self.assertTrue(link.is_symlink())
+            self.assertEqual(target.read_bytes(), b"new\r\n")
+            self.assertEqual(target.stat().st_mode & 0o777, 0o754)
+            self.assertEqual(sorted(os.listdir(d)), ["a.py", "link.py"])
+
+    def test_interrupted(self):
+        with volatile.dir() as d:
+            target = Path(d) / "a.py"
+            target.write_text("old\n")
+            journal = str(Path(d) / "journal")
+
+            writer = Writer(journal=journal)
+            with mock.patch("bowler.writer.os.replace", side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    writer.write(str(target), "new\n")
+            self.assertEqual(target.read_text(), "old\n")
+            self.assertEqual(sorted(os.listdir(d)), ["a.py", "journal"])
+
+            # a crash leaves the temporary file behind
+            with mock.patch("bowler.writer.os.remove", side_effect=OSError):
+                with mock.patch("bowler.writer.os.replace", side_effect=OSError):
+                    with self.assertRaises(OSError):
+                        writer.write(str(target), "new\n")
+            temps = [name for name in os.listdir(d) if name.endswith(TEMP_SUFFIX)]
+            self.assertEqual(len(temps), 1)
+
+            self.assertEqual(recover_journal(journal), 1)
+            self.assertEqual(os.listdir(d), ["a.py"])
+            self.assertEqual(target.read_text(), "old\n")
+            self.assertEqual(recover_journal(journal), 0)
+
+    def test_submit_order(self):
+        with volatile.dir() as d:
+            target = str(Path(d) / "a.py")
+            order = []
+            release = threading.Event()
+
+            def append(value, wait=False):
+                if wait:
+                    release.wait(5)
+                order.append(value)
+
+            writer = Writer()
+            writer.start(4)
+            writer.submit(target, append, 1, True)
+            writer.submit(target, append, 2)
+            writer.submit("other.py", append, 3)
+            writer.submit("other.py", release.set)
+            writer.close()
+            self.assertEqual(order, [3, 1, 2])
+
+    def test_query_write(self):
+        with volatile.dir() as d:
+            target = Path(d) / "a.py"
+            target.write_text("def foo():\n    pass\n")
+            journal = Path(d) / "journal"
+
+            def keep(filename, hunk):
+                return True
+
+            query = Query(d).select_function("foo").rename("bar").process(keep)
+            query.write(journal=str(journal), fsync=True)
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(target.read_text(), "def bar():\n    pass\n")
+            self.assertFalse(journal.exists())
+            self.assertEqual(os.listdir(d), ["a.py"])
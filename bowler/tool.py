@@ -5,33 +5,84 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import ast
 import difflib
+import heapq
+import io
+import itertools
 import logging
+import mmap
 import multiprocessing
 import os
-import sys
+import pickle
+import re
+import stat
 import time
-from queue import Empty
-from typing import Any, Iterator, List, Optional, Sequence, Tuple
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import connection
+from multiprocessing.connection import Connection
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import click
+from attr import dataclass
 from fissix import pygram
+from fissix.fixer_base import BaseFix
+from fissix.pgen2 import tokenize
 from fissix.pgen2.parse import ParseError
-from fissix.refactor import RefactoringTool, _detect_future_features
+from fissix.pygram import python_symbols
+from fissix.pytree import BasePattern, Node
+from fissix.refactor import RefactoringTool, _detect_future_features, _get_headnode_dict
 from moreorless.patch import PatchException, apply_single_file
 
-from .helpers import filename_endswith
+from .cache import ParseCache, ResultCache, fingerprint
+from .helpers import (
+    changed_files,
+    filename_endswith,
+    format_match,
+    glob_pattern,
+    match_record,
+    tracked_files,
+)
+from .pattern import (
+    CandidateMatcher,
+    Prefilter,
+    compiled_patterns,
+    load_patterns,
+    resume_post_order,
+)
 from .types import (
+    LN,
     BadTransform,
     BowlerException,
     BowlerQuit,
     Filename,
     FilenameMatcher,
     Fixers,
+    GitError,
     Hunk,
+    Match,
     Processor,
     RetryFile,
+    Transform,
 )
+from .writer import Writer, recover_journal
 
 PROMPT_HELP = {
     "y": "apply this hunk",
@@ -45,12 +96,229 @@ PROMPT_HELP = {
 log = logging.getLogger(__name__)
 
 
-def diff_texts(a: str, b: str, filename: str) -> Iterator[str]:
+Block = Tuple[int, int, int]  # equal lines at a, b, of size
+
+
+def diff_texts(
+    a: str, b: str, filename: str, tree: Optional[Node] = None
+) -> Iterator[str]:
+    """Unified diff of two texts, by line.
+
+    When `tree` is the tree that `b` was rendered from, unchanged statements
+    are skipped and only the lines around changes are diffed, as long as the
+    hunks are certain to be the same as `difflib` would find.
+    """
     lines_a = a.splitlines()
     lines_b = b.splitlines()
+    if (
+        tree is not None
+        and tree.type == python_symbols.file_input
+        and len(lines_a) == a.count("\n") + (not a.endswith("\n"))
+        and len(lines_b) == b.count("\n") + (not b.endswith("\n"))
+    ):
+        blocks = statement_blocks(tree, lines_a, lines_b)
+        matching = matching_blocks(lines_a, lines_b, blocks)
+        if matching is not None:
+            return unified_diff(lines_a, lines_b, filename, matching)
     return difflib.unified_diff(lines_a, lines_b, filename, filename, lineterm="")
 
 
+def statement_blocks(tree: Node, lines_a: List[str], lines_b: List[str]) -> List[Block]:
+    """Lines of top level statements that are the same in both texts.
+
+    Statements are found in the original text by the line numbers of their
+    first leaf. Ones that were `changed()`, or don't match the new lines, are
+    rendered again to find where the next statement starts.
+    """
+    starts: List[int] = []
+    for child in tree.children:
+        leaf = child
+        while leaf.children:
+            leaf = leaf.children[0]
+        starts.append(leaf.lineno - 1 - leaf.prefix.count("\n"))
+    starts.append(len(lines_a))
+
+    blocks: List[Block] = []
+    a_end = b = 0
+    for index, child in enumerate(tree.children):
+        start, end = starts[index], starts[index + 1]
+        size = end - start
+        if (
+            not child.was_changed
+            and a_end <= start <= end
+            and lines_a[start:end] == lines_b[b : b + size]
+        ):
+            if blocks and blocks[-1][0] + blocks[-1][2] == start:
+                if blocks[-1][1] + blocks[-1][2] == b:
+                    blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + size)
+                else:
+                    blocks.append((start, b, size))
+            elif size:
+                blocks.append((start, b, size))
+            a_end = end
+        else:
+            size = str(child).count("\n")
+        b += size
+    return blocks
+
+
+def matching_blocks(
+    lines_a: List[str], lines_b: List[str], blocks: List[Block]
+) -> Optional[List[Block]]:
+    """The blocks `difflib` would match between lines, given some equal ones.
+
+    Lines between the given blocks are matched when they're equal at either
+    end, or line by line when there are as many on both sides. Returns None
+    unless `difflib.SequenceMatcher` is certain to find exactly these blocks:
+    no changed line can start a match on the other side, no block can be
+    extended, lines made adjacent by an insertion or deletion aren't adjacent
+    on the other side, and each block but the first has a line that can start
+    a match.
+    """
+    found: List[Block] = []
+
+    def add(a: int, b: int, size: int) -> None:
+        if (
+            found
+            and found[-1][0] + found[-1][2] == a
+            and found[-1][1] + found[-1][2] == b
+        ):
+            found[-1] = (found[-1][0], found[-1][1], found[-1][2] + size)
+        elif size:
+            found.append((a, b, size))
+
+    a = b = 0
+    for block_a, block_b, size in blocks + [(len(lines_a), len(lines_b), 0)]:
+        while a < block_a and b < block_b and lines_a[a] == lines_b[b]:
+            add(a, b, 1)
+            a, b = a + 1, b + 1
+        end_a, end_b = block_a, block_b
+        while end_a > a and end_b > b and lines_a[end_a - 1] == lines_b[end_b - 1]:
+            end_a, end_b = end_a - 1, end_b - 1
+        if end_a - a == end_b - b:
+            for offset in range(end_a - a):
+                if lines_a[a + offset] == lines_b[b + offset]:
+                    add(a + offset, b + offset, 1)
+        add(end_a, end_b, block_a - end_a)
+        add(block_a, block_b, size)
+        a, b = block_a + size, block_b + size
+
+    # lines that can start a match: ones in b that autojunk doesn't drop
+    matcher: Any = difflib.SequenceMatcher(None, (), lines_b)
+    starts = matcher.b2j
+    in_a = set(lines_a)
+    pairs_a: Optional[Set[Tuple[str, str]]] = None
+    pairs_b: Optional[Set[Tuple[str, str]]] = None
+    end_a, end_b = len(lines_a), len(lines_b)
+    a = b = 0
+    for block_a, block_b, size in found + [(end_a, end_b, 0)]:
+        if any(line in starts for line in lines_a[a:block_a]) or any(
+            line in starts and line in in_a for line in lines_b[b:block_b]
+        ):
+            return None
+        if (a, b) == (block_a, block_b):
+            pass  # nothing changed before the first block or after the last
+        elif (a < end_a and b < end_b and lines_a[a] == lines_b[b]) or (
+            block_a and block_b and lines_a[block_a - 1] == lines_b[block_b - 1]
+        ):
+            return None  # blocks either side could be extended
+        if a == block_a and 0 < a < end_a:
+            if pairs_b is None:
+                pairs_b = set(zip(lines_b, lines_b[1:]))
+            if (lines_a[a - 1], lines_a[a]) in pairs_b:
+                return None
+        if b == block_b and 0 < b < end_b:
+            if pairs_a is None:
+                pairs_a = set(zip(lines_a, lines_a[1:]))
+            if (lines_b[b - 1], lines_b[b]) in pairs_a:
+                return None
+        if (
+            size
+            and (block_a or block_b)
+            and not any(line in starts for line in lines_b[block_b : block_b + size])
+        ):
+            return None  # a block without a line that can start a match
+        a, b = block_a + size, block_b + size
+
+    return found + [(len(lines_a), len(lines_b), 0)]
+
+
+class BlockMatcher(difflib.SequenceMatcher):
+    """A `SequenceMatcher` that's given the blocks it would match."""
+
+    def __init__(self, blocks: List[Block]) -> None:
+        super().__init__(None, (), ())  # opcodes only need the blocks
+        self.blocks = blocks
+
+    def get_matching_blocks(self) -> List[Any]:
+        return [difflib.Match(*block) for block in self.blocks]
+
+
+def format_range(start: int, stop: int) -> str:
+    """Line range of a unified diff hunk header, as `difflib` formats it."""
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+
+def unified_diff(
+    lines_a: List[str], lines_b: List[str], filename: str, blocks: List[Block]
+) -> Iterator[str]:
+    """Like `difflib.unified_diff`, given the matching blocks it would find."""
+    matcher = BlockMatcher(blocks)
+    for index, group in enumerate(matcher.get_grouped_opcodes()):
+        if not index:
+            yield f"--- {filename}"
+            yield f"+++ {filename}"
+        first, last = group[0], group[-1]
+        yield (
+            f"@@ -{format_range(first[1], last[2])}"
+            f" +{format_range(first[3], last[4])} @@"
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                yield from (" " + line for line in lines_a[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                yield from ("-" + line for line in lines_a[i1:i2])
+            if tag in ("replace", "insert"):
+                yield from ("+" + line for line in lines_b[j1:j2])
+
+
+Source = Union[bytes, mmap.mmap]
+
+
+def load_source(filename: str, mmap_size: int) -> Source:
+    """Read the bytes of a file, opening it once.
+
+    Files of at least `mmap_size` bytes are memory mapped rather than copied,
+    and must be closed once they're no longer needed.
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size and size >= mmap_size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def decode_source(data: Source) -> Tuple[str, str]:
+    """Decode Python source, returning the text and the encoding it was in.
+
+    The encoding is found from the first two lines like the tokenizer does,
+    and newlines are left as they are.
+    """
+    end = data.find(b"\n", data.find(b"\n") + 1)
+    head = data[: end + 1] if end >= 0 else data[:]
+    encoding = tokenize.detect_encoding(io.BytesIO(head).readline)[0]
+    return str(data, encoding), encoding
+
+
+def accept_hunk(filename: Filename, hunk: Hunk) -> bool:
+    """The default hunk processor, which accepts every hunk."""
+    return True
+
+
 def prompt_user(question: str, options: str, default: str = "") -> str:
     options = options.lower()
     default = default.lower()
@@ -79,9 +347,300 @@ def prompt_user(question: str, options: str, default: str = "") -> str:
             return default
 
 
+FixerSpec = Union[Transform, Type[BaseFix]]
+# the new lines covered by a unified diff hunk, as 1-based start and length
+HUNK_HEADER = re.compile(r"@@ -\d+(?:,\d+)? \+(\d+)")
+# (filename, hunks, exception), with matches instead of hunks when finding
+Result = Tuple[Filename, List[Any], Any]
+Batch = List[Tuple[int, Filename, int]]  # (index, filename, size in bytes)
+Found = Tuple[Filename, Optional[int]]  # (filename, size in bytes if known)
+Listing = Tuple[List[Tuple[Filename, int]], List[Tuple[str, str]]]  # see `scan_dir`
+
+
+@dataclass
+class WorkerStats:
+    pid: int
+    files: int = 0
+    bytes: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+    parse_hits: int = 0
+    parse_misses: int = 0
+    result_hits: int = 0
+    result_misses: int = 0
+    skipped: int = 0
+    unmatched: int = 0
+    written: int = 0
+    saved: int = 0
+
+    def add(self, other: "WorkerStats") -> None:
+        self.files += other.files
+        self.bytes += other.bytes
+        self.batches += other.batches
+        self.seconds += other.seconds
+        self.parse_hits += other.parse_hits
+        self.parse_misses += other.parse_misses
+        self.result_hits += other.result_hits
+        self.result_misses += other.result_misses
+        self.skipped += other.skipped
+        self.unmatched += other.unmatched
+        self.written += other.written
+        self.saved += other.saved
+
+
+def fixer_specs(fixers: Fixers) -> List[FixerSpec]:
+    """Describe fixers in a form that can be shipped to spawned workers.
+
+    Fixers generated by `Query.create_fixer` are local classes, and can't be
+    pickled, so they are described by the `Transform` they were built from.
+    Any other fixer class is shipped by reference.
+    """
+    return [getattr(fixer, "TRANSFORM", None) or fixer for fixer in fixers]
+
+
+def build_fixers(specs: Sequence[FixerSpec]) -> Fixers:
+    """Rebuild fixer classes from the output of `fixer_specs`."""
+    from .query import Query  # avoid circular import
+
+    fixers: Fixers = []
+    for spec in specs:
+        if isinstance(spec, Transform):
+            fixers.append(Query().create_fixer(spec))
+        else:
+            fixers.append(spec)
+    return fixers
+
+
+def stage_specs(tool: "BowlerTool") -> List[List[FixerSpec]]:
+    """Describe the fixers of every stage of a tool, see `fixer_specs`."""
+    return [fixer_specs(stage.fixers) for stage in tool.stages]
+
+
+def stage_patterns(tool: "BowlerTool") -> Dict[str, BasePattern]:
+    """Compiled patterns of every stage's generated fixers, see `load_patterns`."""
+    return compiled_patterns(
+        fixer.PATTERN
+        for stage in tool.stages
+        for fixer in stage.fixers
+        if hasattr(fixer, "TRANSFORM") and not fixer.BM_compatible
+    )
+
+
+def build_tool(
+    specs: Sequence[Sequence[FixerSpec]],
+    options: dict,
+    patterns: Optional[Dict[str, BasePattern]] = None,
+) -> "BowlerTool":
+    """Rebuild a tool and its stages from the output of `stage_specs`.
+
+    Patterns from `stage_patterns` are reused instead of compiled again.
+    """
+    if patterns:
+        load_patterns(patterns)
+    tools = [
+        BowlerTool(build_fixers(stage), options=options, in_process=True)
+        for stage in specs
+    ]
+    tools[0].stages.extend(tools[1:])
+    return tools[0]
+
+
+def refactor_worker(
+    specs: Sequence[Sequence[FixerSpec]],
+    options: dict,
+    patterns: Dict[str, BasePattern],
+    tasks: Any,
+    results: Connection,
+) -> None:
+    """Entry point for worker processes that can't inherit the parent's fixers."""
+    tool = build_tool(specs, options, patterns)
+    tool.refactor_queue(tasks, results)
+
+
+def pool_worker(tasks: Any, results: Connection) -> None:
+    """Entry point for long-lived `Pool` worker processes.
+
+    Each job's tool is built from its own copy of the fixers, so state kept by
+    filters and callbacks can't leak into later queries. Compiled patterns and
+    the grammar stay warm between jobs.
+    """
+    job = 0
+    tool: Optional[BowlerTool] = None
+    error: Optional[Exception] = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        job_id, stages, payload, batch = task
+        if job_id != job:
+            job, tool = job_id, None
+            try:
+                tool = build_tool(*pickle.loads(payload))
+            except Exception as e:
+                log.exception(f"Skipping job: failed to load fixers: {e}")
+                error = e
+
+        if tool is None:
+            for index, filename, _ in batch:
+                results.send((job_id, (index, [(filename, [], error)] * stages)))
+            results.send((job_id, WorkerStats(os.getpid(), files=len(batch))))
+            continue
+
+        tool.refactor_batch(batch, lambda m: results.send((job_id, m)))
+        for stage in tool.stages:
+            stage.files.clear()
+
+
+class Worker:
+    """A worker process, with a queue of its own for batches of files, and a
+    pipe of its own for results.
+
+    Workers send a message for each file of a batch, in order, followed by the
+    batch's `WorkerStats`, so the parent always knows which file a worker is
+    on. A worker that dies can't leave a shared lock held, or stop the others.
+    """
+
+    def __init__(
+        self,
+        context: Any,
+        target: Callable[..., None],
+        args: Tuple,
+        daemon: bool = False,
+    ) -> None:
+        self.tasks = context.Queue()
+        self.results, results = context.Pipe(duplex=False)
+        self.process = context.Process(target=target, args=args + (self.tasks, results))
+        self.process.daemon = daemon
+        self.process.start()
+        results.close()  # so that the pipe is closed when the worker exits
+        self.alive = True
+        self.batches: Deque[Batch] = deque()  # sent but not done, oldest first
+        self.position = 0  # files of the oldest batch that have been reported
+        self.retried = 0  # files of the oldest batch sent back to be retried
+        self.job = 0  # the last `PoolJob` sent, see `BowlerTool.queue_batch`
+
+    def receive(self, exited: bool = False) -> List[Any]:
+        """Messages that have arrived from the worker, without waiting.
+
+        Once the worker has exited, and every message it sent has been read,
+        None is added as its last message.
+        """
+        messages = []
+        try:
+            while self.results.poll():
+                messages.append(self.results.recv())
+        except (EOFError, OSError):
+            exited = True
+        if exited:
+            self.alive = False
+            messages.append(None)
+        return messages
+
+    def stop(self, terminate: bool = False) -> None:
+        """Tell the worker to exit, or kill it, and wait until it has."""
+        if terminate:
+            self.process.terminate()
+        elif self.alive:
+            self.tasks.put(None)
+        try:
+            while True:
+                self.results.recv()  # results nobody is waiting for anymore
+        except (EOFError, OSError):
+            pass
+        self.alive = False
+        self.process.join()
+        self.tasks.cancel_join_thread()  # batches it never read don't matter
+        self.tasks.close()
+        self.results.close()
+
+
+@dataclass
+class PoolJob:
+    id: int
+    stages: int
+    payload: bytes
+
+
+class Pool:
+    """Worker processes that stay warm across many queries.
+
+    Pass the same pool to consecutive queries to skip process startup and
+    fixer compilation, eg `Query(...).select_function("foo").diff(pool=pool)`.
+    Filters and callbacks must be picklable; otherwise the query falls back to
+    starting its own workers. Queries sharing a pool must run one at a time.
+    """
+
+    def __init__(
+        self, processes: Optional[int] = None, start_method: Optional[str] = None
+    ) -> None:
+        self.context = multiprocessing.get_context(start_method)
+        self.job_ids = itertools.count(1)
+        self.workers = [
+            self.spawn() for _ in range(processes or BowlerTool.NUM_PROCESSES)
+        ]
+
+    def __enter__(self) -> "Pool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def spawn(self) -> Worker:
+        return Worker(self.context, pool_worker, (), daemon=True)
+
+    def job(self, tool: "BowlerTool") -> Optional[PoolJob]:
+        """Describe a tool's fixers for the workers, or None if they can't be shipped.
+
+        Workers that died since the last job are replaced first; the files they
+        had were failed, or sent to other workers, by the query they died in.
+        """
+        try:
+            payload = pickle.dumps(
+                (stage_specs(tool), tool.options, stage_patterns(tool))
+            )
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            log.warning(f"can't ship fixers to pool, running without it: {e}")
+            return None
+
+        for i, worker in enumerate(self.workers):
+            if not worker.alive or not worker.process.is_alive():
+                log.warning(
+                    f"replacing pool worker {worker.process.pid}, which died "
+                    f"with exit code {worker.process.exitcode}"
+                )
+                worker.stop()
+                worker = self.workers[i] = self.spawn()
+            worker.batches.clear()  # left by a query that quit early
+            worker.position = worker.retried = 0
+        return PoolJob(next(self.job_ids), len(tool.stages), payload)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+        self.workers.clear()
+
+
 class BowlerTool(RefactoringTool):
     NUM_PROCESSES = os.cpu_count() or 1
     IN_PROCESS = False  # set when run DEBUG mode from command line
+    START_METHOD: Optional[str] = None  # multiprocessing default if None
+    WORKER_BATCHES = 2  # batches sent to each worker ahead of time, see `dispatch`
+    BATCH_SIZE = 64 * 1024  # bytes of source per batch of small files
+    BATCH_FILES = 32  # maximum files per batch
+    PARSE_CACHE: Optional[str] = None  # directory for cached parse trees
+    RESULT_CACHE: Optional[str] = None  # directory for cached hunks
+    PREFILTER = True  # skip files missing literals that every match needs
+    BOTTOM_UP = True  # only try fixers on nodes found from their literal leaves
+    RESCANS = 8  # times to find candidates again in a tree, see `traverse_candidates`
+    VALIDATE = "compile"  # how to check transformed source, see `validate_quickly`
+    WRITE_THREADS = 4  # threads applying hunks while results arrive, see `Writer`
+    FSYNC = False  # flush written files to disk before the run finishes
+    JOURNAL: Optional[str] = None  # file listing writes in progress, see `Writer`
+    WALK_THREADS = 4  # threads listing directories, see `walk`
+    MMAP_SIZE = 1024 * 1024  # bytes from which files are mapped, see `load_source`
+    QUEUED_FILES = 4096  # files queued but not yet handled, see `feed`
+    DISCOVERY = "walk"  # how to find files in directories, see `discover`
 
     def __init__(
         self,
@@ -93,30 +652,98 @@ class BowlerTool(RefactoringTool):
         in_process: Optional[bool] = None,
         hunk_processor: Processor = None,
         filename_matcher: Optional[FilenameMatcher] = None,
+        include: Optional[Sequence[str]] = None,
+        exclude: Optional[Sequence[str]] = None,
+        discovery: Optional[str] = None,
+        pool: Optional[Pool] = None,
+        parse_cache: Optional[str] = None,
+        result_cache: Optional[str] = None,
+        since: Optional[str] = None,
+        validate: Optional[str] = None,
+        fsync: Optional[bool] = None,
+        journal: Optional[str] = None,
+        find: bool = False,
+        match_handler: Optional[Callable[[Match], None]] = None,
         **kwargs,
     ) -> None:
-        options = kwargs.pop("options", {})
+        options = dict(kwargs.pop("options", None) or {})
+        # workers only match nodes, see `find_task`
+        if find:
+            options["find"] = True
+        if validate:
+            options["validate"] = validate
+        # kept in options so that spawned workers share the same caches
+        parse_cache = parse_cache or options.get("parse_cache") or self.PARSE_CACHE
+        if parse_cache:
+            options["parse_cache"] = str(parse_cache)
+        result_cache = result_cache or options.get("result_cache") or self.RESULT_CACHE
+        if result_cache:
+            options["result_cache"] = str(result_cache)
+        if fsync is None:
+            fsync = options.get("fsync", self.FSYNC)
+        options["fsync"] = bool(fsync)
+        journal = journal or options.get("journal") or self.JOURNAL
+        if journal:
+            options["journal"] = os.path.abspath(journal)
         super().__init__(fixers, *args, options=options, **kwargs)
+        self.parse_cache = ParseCache(parse_cache) if parse_cache else None
+        self.result_cache = ResultCache(result_cache) if result_cache else None
+        self.writer = Writer(options["fsync"], options.get("journal"))
+        self.transforms_key: Optional[str] = None  # see `result_key`
+        self.prefilter: Optional[Prefilter] = None  # see `may_match`
+        self.candidates: Optional[CandidateMatcher] = None  # see `refactor_tree`
         self.queue_count = 0
-        self.queue = multiprocessing.JoinableQueue()  # type: ignore
-        self.results = multiprocessing.Queue()  # type: ignore
-        self.semaphore = multiprocessing.Semaphore(self.NUM_PROCESSES)
+        self.context = multiprocessing.get_context(self.START_METHOD)
+        self.workers: List[Worker] = []
+        self.backlog: Deque[Batch] = deque()  # batches waiting for a worker
+        self.large: List[Tuple[int, int, Batch]] = []  # see `hold_batches`
+        self.inbox: Deque[Tuple[Worker, Any]] = deque()  # see `next_message`
         self.interactive = interactive
         self.write = write
         self.silent = silent
         if in_process is None:
             in_process = self.IN_PROCESS
-        # pick the most restrictive of flags; we can pickle fixers when
-        # using spawn.
-        if sys.platform == "win32" or sys.version_info > (3, 7):
-            in_process = True
         self.in_process = in_process
         self.exceptions: List[BowlerException] = []
         if hunk_processor is not None:
             self.hunk_processor = hunk_processor
         else:
-            self.hunk_processor = lambda f, h: True
+            self.hunk_processor = accept_hunk
         self.filename_matcher = filename_matcher or filename_endswith(".py")
+        self.include = glob_pattern(include or [])
+        self.exclude = glob_pattern(exclude or [])
+        self.walker: Optional[ThreadPoolExecutor] = None  # see `scan`
+        self.discovery = discovery or self.DISCOVERY
+        self.discovered_by: Set[str] = set()  # how files were found, see `discover`
+        self.discovery_seconds = 0.0
+        self.pool = pool
+        self.job: Optional[PoolJob] = None
+        self.since = since
+        self.find = bool(options.get("find"))
+        self.write_direct = bool(options.get("write_direct"))  # see `iter_refactor`
+        self.last_read: Optional[Tuple[str, Optional[str], bool]] = None
+        self.loaded: Optional[Tuple[str, Source]] = None  # see `source_bytes`
+        self.match_handler = match_handler or self.print_match
+        self.find_heads: Optional[Dict[int, List[BaseFix]]] = None  # see `find_matches`
+        # tools whose fixers are applied in turn to each file, see `run_all`
+        self.stages: List[BowlerTool] = [self]
+        self.pending: Batch = []
+        self.worker_stats: Dict[int, WorkerStats] = {}
+        self.files_done = 0
+        self.next_index = 0
+        self.reorder: Dict[int, List[Result]] = {}
+        self.parse_hits = 0
+        self.parse_misses = 0
+        self.result_hits = 0
+        self.result_misses = 0
+        self.files_skipped = 0
+        self.files_unmatched = 0
+        self.files_modified = 0
+        self.matches = 0  # fixer matches in this process, see `refactor_tree`
+        self.unmatched = 0  # files in this process where no fixer matched
+        self.written = 0  # files written by this process, see `write_source`
+        self.files_written = 0
+        self.bytes_saved = 0
 
     def log_error(self, msg: str, *args: Any, **kwds: Any) -> None:
         self.logger.error(msg, *args, **kwds)
@@ -128,12 +755,23 @@ class BowlerTool(RefactoringTool):
         return pre, post
 
     def processed_file(
-        self, new_text: str, filename: str, old_text: str = "", *args, **kwargs
+        self,
+        new_text: str,
+        filename: str,
+        old_text: str = "",
+        *args,
+        tree: Optional[Node] = None,
+        **kwargs,
     ) -> List[Hunk]:
+        """Diff transformed source against the original, and check that it's valid.
+
+        Raises `BadTransform` if fissix can't parse the new source. Most valid
+        source is recognized without parsing all of it, see `validate_quickly`.
+        """
         self.files.append(filename)
         hunks: List[Hunk] = []
         if old_text != new_text:
-            a, b, *lines = list(diff_texts(old_text, new_text, filename))
+            a, b, *lines = list(diff_texts(old_text, new_text, filename, tree))
 
             hunk: Hunk = []
             for line in lines:
@@ -146,6 +784,9 @@ class BowlerTool(RefactoringTool):
             if hunk:
                 hunks.append([a, b, *hunk])
 
+            if self.validate_quickly(new_text, old_text, hunks, tree):
+                return hunks
+
             original_grammar = self.driver.grammar
             if "print_function" in _detect_future_features(new_text):
                 self.driver.grammar = pygram.python_grammar_no_print_statement
@@ -164,28 +805,445 @@ class BowlerTool(RefactoringTool):
 
         return hunks
 
-    def refactor_file(self, filename: str, *a, **k) -> List[Hunk]:
+    def validate_quickly(
+        self, new_text: str, old_text: str, hunks: List[Hunk], tree: Optional[Node]
+    ) -> bool:
+        """Whether transformed source is valid, without fissix parsing all of it.
+
+        The strategy is set by the "validate" option, or `VALIDATE`:
+
+        - "compile" compiles the source with CPython, unless it's Python 2;
+        - "incremental" parses top level statements of `tree` that overlap the
+          hunks, when the source's future imports haven't changed;
+        - "full" leaves every check to fissix.
+
+        Returns False whenever in doubt, so the caller can parse the whole
+        source, and report errors the same way regardless of strategy.
+        """
+        strategy = self.options.get("validate") or self.VALIDATE
+        features = _detect_future_features(new_text)
+
+        if strategy == "compile":
+            if "print" in self.grammar.keywords and "print_function" not in features:
+                return False
+            if not new_text.endswith("\n"):
+                return False  # fissix needs a newline at the end, CPython doesn't
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    compile(
+                        new_text,
+                        "<bowler>",
+                        "exec",
+                        ast.PyCF_ONLY_AST,
+                        dont_inherit=True,
+                    )
+            except (SyntaxError, ValueError, RecursionError, MemoryError):
+                return False
+            return True
+
+        if strategy == "incremental" and tree is not None:
+            if features != _detect_future_features(old_text):
+                return False
+            return self.validate_statements(tree, hunks, features)
+
+        return False
+
+    def validate_statements(
+        self, tree: Node, hunks: List[Hunk], features: FrozenSet[str]
+    ) -> bool:
+        """Whether top level statements overlapping the hunks parse on their own.
+
+        The rest of the tree is assumed to be as valid as the original source.
+        """
+        if tree.type != python_symbols.file_input:
+            return False
+        changed: List[Tuple[int, int]] = []  # ranges of lines, from zero
+        for hunk in hunks:
+            match = HUNK_HEADER.match(hunk[2])
+            if match is None:
+                return False
+            number = int(match.group(1)) - 1
+            removed = False
+            for text in hunk[3:] + [" "]:
+                if text.startswith("+"):
+                    changed.append((number, number))
+                    number += 1
+                    removed = False
+                elif text.startswith("-"):
+                    removed = True
+                else:
+                    if removed:
+                        # lines either side of a deletion may belong to one statement
+                        changed.append((number - 1, number))
+                    number += 1
+                    removed = False
+
+        grammar = self.grammar
+        if "print_function" in features:
+            grammar = pygram.python_grammar_no_print_statement
+        line = 0
+        last = len(tree.children) - 1
+        for index, child in enumerate(tree.children):
+            text = str(child)
+            end = line + text.count("\n")
+            final = end - 1 if text.endswith("\n") else end
+            if text and any(line <= hi and final >= lo for lo, hi in changed):
+                if index < last and not text.endswith("\n"):
+                    return False
+                self.driver.grammar = grammar
+                try:
+                    if self.driver.parse_string(text) is None:
+                        return False
+                except Exception:
+                    return False
+                finally:
+                    self.driver.grammar = self.grammar
+            line = end
+        return True
+
+    def source_bytes(self, filename: str) -> Source:
+        """The bytes of a file, read once for both `may_match` and `read_source`.
+
+        Raises `OSError` if the file can't be read.
+        """
+        if self.loaded is None or self.loaded[0] != filename:
+            self.release_source()
+            self.loaded = (filename, load_source(filename, self.MMAP_SIZE))
+        return self.loaded[1]
+
+    def release_source(self) -> None:
+        """Forget the bytes kept by `source_bytes`, unmapping them if mapped."""
+        if self.loaded is not None:
+            data = self.loaded[1]
+            self.loaded = None
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def read_source(self, filename: str) -> Optional[str]:
+        """Read a file for refactoring, returning None if it can't be read."""
         try:
-            hunks: List[Hunk] = []
-            input, encoding = self._read_python_source(filename)
-            if input is None:
-                # Reading the file failed.
-                return hunks
+            input, encoding = decode_source(self.source_bytes(filename))
         except (OSError, UnicodeDecodeError) as e:
             log.error(f"Skipping {filename}: failed to read because {e}")
+            return None
+        finally:
+            self.release_source()  # the text is all that's needed now
+
+        self.last_read = (filename, encoding, not input.endswith("\n"))
+        if not input.endswith("\n"):
+            input += "\n"
+        return input
+
+    def write_source(self, filename: str, text: str) -> None:
+        """Write transformed source over a file, as it was read by `read_source`.
+
+        The file keeps its encoding, newlines, and lack of a final newline.
+        """
+        encoding = None
+        if self.last_read is not None and self.last_read[0] == filename:
+            _, encoding, newline_added = self.last_read
+            if newline_added and text.endswith("\n"):
+                text = text[:-1]
+        self.writer.write(filename, text, encoding, newline="")
+        self.log_debug("Wrote changes to %s", filename)
+        self.wrote = True
+        self.written += 1
+
+    def parse_source(self, data: str, name: str) -> Optional[Node]:
+        """Parse source text, returning None if it can't be parsed.
+
+        Trees are loaded from the parse cache when one is configured.
+        """
+        features = _detect_future_features(data)
+        grammar = self.grammar
+        if "print_function" in features:
+            grammar = pygram.python_grammar_no_print_statement
+
+        key = None
+        tree = None
+        if self.parse_cache is not None:
+            key = self.parse_cache.key(data, grammar)
+            tree = self.parse_cache.get(key)
+
+        if tree is None:
+            self.driver.grammar = grammar
+            try:
+                tree = self.driver.parse_string(data)
+            except Exception as err:
+                self.log_error(f"Can't parse {name}: {type(err).__name__}: {err}")
+                return None
+            finally:
+                self.driver.grammar = self.grammar
+            if key is not None and self.parse_cache is not None:
+                self.parse_cache.put(key, tree)
+
+        tree.future_features = features
+        return tree
+
+    def result_key(self, filename: Filename, data: str) -> Optional[str]:
+        """Key for this tool's results for a file in the result cache.
+
+        Returns None if there's no result cache, or the fixers can't be
+        fingerprinted reliably.
+        """
+        if self.result_cache is None:
+            return None
+        if self.transforms_key is None:
+            options = {
+                key: value
+                for key, value in self.options.items()
+                if key
+                not in (
+                    "parse_cache",
+                    "result_cache",
+                    "validate",
+                    "write_direct",
+                    "fsync",
+                    "journal",
+                )
+            }
+            self.transforms_key = fingerprint((fixer_specs(self.fixers), options)) or ""
+        if not self.transforms_key:
+            return None
+        return self.result_cache.key(filename, data, self.transforms_key)
+
+    def refactor_string(self, data: str, name: str) -> Optional[Node]:
+        tree = self.parse_source(data, name)
+        if tree is not None:
+            self.log_debug("Refactoring %s", name)
+            self.refactor_tree(tree, name)
+        return tree
+
+    def refactor_tree(self, tree: Node, name: str) -> bool:
+        """Apply the fixers to a tree, only visiting nodes they might match.
+
+        Candidate nodes are found in one pass over the leaves, see
+        `CandidateMatcher`, and fixers are tried on them in the same order as
+        a full post-order traversal. Falls back to fissix when some fixers
+        can't be anchored.
+
+        Returns False when the tree is certainly unchanged, because no fixer
+        matched and none of them do anything in `finish_tree`.
+        """
+        if self.candidates is None:
+            self.candidates = CandidateMatcher(self.post_order)
+        matches = self.matches
+        fixers = self.pre_order + self.post_order
+        if (
+            not self.BOTTOM_UP
+            or not self.candidates.complete
+            or self.pre_order
+            or self.BM.fixers
+        ):
+            super().refactor_tree(tree, name)
+            if self.BM.fixers:
+                return True  # the bottom matcher transforms nodes itself
+        else:
+            for fixer in fixers:
+                fixer.start_tree(tree, name)
+            self.traverse_candidates(self.bmi_post_order_heads, tree)
+            for fixer in fixers:
+                fixer.finish_tree(tree, name)
+        return self.matches > matches or any(
+            type(fixer).finish_tree is not BaseFix.finish_tree for fixer in fixers
+        )
+
+    def traverse_by(self, fixers: Dict[int, List[BaseFix]], traversal: Any) -> None:
+        """Apply fixers to each node of a traversal, counting matches."""
+        if not fixers:
+            return
+        for node in traversal:
+            for fixer in fixers[node.type]:
+                results = fixer.match(node)
+                if results:
+                    self.matches += 1
+                    new = fixer.transform(node, results)
+                    if new is not None:
+                        node.replace(new)
+                        node = new
+
+    def traverse_candidates(self, fixers: Dict[int, List[BaseFix]], tree: Node) -> None:
+        """Like `traverse_by` over `tree.post_order()`, skipping non-candidates.
+
+        Candidates are found again after each match, until that's been done
+        `RESCANS` times; the rest of the tree is then traversed node by node.
+        """
+        if not fixers or self.candidates is None:
+            return
+        rescans = 0
+        for node, candidate_fixers in self.candidates.run(tree):
+            rest = None
+            for fixer in fixers[node.type]:
+                if rest is None and fixer not in candidate_fixers:
+                    continue
+                results = fixer.match(node)
+                if results:
+                    self.matches += 1
+                    if rest is None:
+                        # must be captured before the tree changes
+                        rest = resume_post_order(node)
+                    new = fixer.transform(node, results)
+                    if new is not None:
+                        node.replace(new)
+                        node = new
+            if rest is not None:
+                if rescans == self.RESCANS:
+                    self.traverse_by(fixers, rest)
+                    return
+                rescans += 1
+                self.candidates.update(tree)
+
+    def refactor_file(self, filename: str, *a, **k) -> List[Hunk]:
+        hunks: List[Hunk] = []
+        input = self.read_source(filename)
+        if input is None:
             return hunks
 
+        key = self.result_key(Filename(filename), input)
+        if key is not None and self.result_cache is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                self.files.append(filename)
+                if self.write_direct and cached[1] is not None:
+                    self.write_source(filename, cached[1])
+                return cached[0]
+
         try:
-            if not input.endswith("\n"):
-                input += "\n"
-            tree = self.refactor_string(input, filename)
-            if tree:
-                hunks = self.processed_file(str(tree), filename, input)
+            tree = self.parse_source(input, filename)
+            if tree is None:
+                return hunks
+            self.log_debug("Refactoring %s", filename)
+            if not self.refactor_tree(tree, filename):
+                # nothing matched, so there's nothing to render or compare
+                self.unmatched += 1
+                output = input
+            else:
+                output = str(tree)
+                hunks = self.processed_file(output, filename, input, tree=tree)
+            if key is not None and self.result_cache is not None:
+                changed = None if output == input else output
+                self.result_cache.put(key, (hunks, changed))
+            if self.write_direct and hunks:
+                self.write_source(filename, output)
         except ParseError as e:
             log.exception("Skipping {filename}: failed to parse ({e})")
 
         return hunks
 
+    def find_task(self, filename: Filename) -> List[Result]:
+        """Find where each stage's fixers match a file, without changing it."""
+        text = self.read_source(filename)
+        tree = self.parse_source(text, filename) if text is not None else None
+        if tree is None:
+            return [(filename, [], None) for _stage in self.stages]
+        return [
+            (filename, stage.find_matches(tree, filename), None)
+            for stage in self.stages
+        ]
+
+    def find_matches(self, tree: Node, filename: Filename) -> List[Match]:
+        """Nodes in a tree that the fixers match and accept, in post-order.
+
+        Fixers built by `Query` apply their filters, but never transform the
+        tree. Only candidate nodes are visited when possible, like in
+        `refactor_tree`.
+        """
+        fixers = self.pre_order + self.post_order
+        if self.find_heads is None:
+            self.find_heads = _get_headnode_dict(fixers)
+        if self.candidates is None:
+            self.candidates = CandidateMatcher(self.post_order)
+
+        nodes: Iterator[Tuple[LN, Optional[Set[BaseFix]]]]
+        if self.BOTTOM_UP and self.candidates.complete and not self.pre_order:
+            nodes = self.candidates.run(tree)
+        else:
+            nodes = ((node, None) for node in tree.post_order())
+
+        matches: List[Match] = []
+        for fixer in fixers:
+            fixer.start_tree(tree, filename)
+        for node, candidate_fixers in nodes:
+            for fixer in self.find_heads.get(node.type, ()):
+                if candidate_fixers is not None and fixer not in candidate_fixers:
+                    continue
+                results = fixer.match(node)
+                if not results:
+                    continue
+                accepts = getattr(fixer, "accepts", None)
+                if accepts is None or accepts(node, results):
+                    matches.append(match_record(node, results, filename))
+        for fixer in fixers:
+            fixer.finish_tree(tree, filename)
+        return matches
+
+    def refactor_stages(self, filename: Filename) -> List[Result]:
+        """Refactor a file with the fixers of each stage in turn, parsing it once.
+
+        Each stage sees the tree as left by the stages before it, and its hunks
+        are relative to their output. A stage that fails is rolled back by
+        parsing the text from before it again, so later stages can still run.
+        The file is only parsed once a stage misses the result cache.
+        """
+        results: List[Result] = []
+        text = original = self.read_source(filename)
+        tree: Optional[Node] = None
+        matched = False
+        for stage in self.stages:
+            if text is None:
+                results.append((filename, [], None))
+                continue
+
+            key = stage.result_key(filename, text)
+            if key is not None and stage.result_cache is not None:
+                cached = stage.result_cache.get(key)
+                if cached is not None:
+                    hunks, changed = cached
+                    stage.files.append(filename)
+                    results.append((filename, hunks, None))
+                    if changed is not None:
+                        text, tree = changed, None
+                    continue
+
+            if tree is None:
+                tree = self.parse_source(text, filename)
+                if tree is None:
+                    text = None  # skip the remaining stages
+                    results.append((filename, [], None))
+                    continue
+
+            try:
+                if not stage.refactor_tree(tree, filename):
+                    results.append((filename, [], None))
+                    if key is not None and stage.result_cache is not None:
+                        stage.result_cache.put(key, ([], None))
+                    continue
+                matched = True
+                new_text = str(tree)
+                hunks = stage.processed_file(new_text, filename, text, tree=tree)
+                results.append((filename, hunks, None))
+                if key is not None and stage.result_cache is not None:
+                    changed = None if new_text == text else new_text
+                    stage.result_cache.put(key, (hunks, changed))
+                text = new_text
+            except RetryFile:
+                raise
+            except BowlerException as e:
+                log.exception(f"Bowler exception during transform of {filename}: {e}")
+                results.append((filename, e.hunks, e))
+                tree = None
+            except Exception as e:
+                log.exception(f"Skipping {filename}: failed to transform because {e}")
+                results.append((filename, [], e))
+                tree = None
+
+        if text is not None and not matched:
+            self.unmatched += 1
+        if self.write_direct and text is not None and text != original:
+            self.write_source(filename, text)
+        return results
+
     def refactor_dir(self, dir_name: str, *a, **k) -> None:
         """Descends down a directory and refactor every Python file found.
 
@@ -194,112 +1252,708 @@ class BowlerTool(RefactoringTool):
 
         Files and subdirectories starting with '.' are skipped.
         """
-        for dirpath, dirnames, filenames in os.walk(dir_name):
-            self.log_debug("Descending into %s", dirpath)
-            dirnames.sort()
-            filenames.sort()
-            for name in filenames:
-                fullname = os.path.join(dirpath, name)
-                if not name.startswith(".") and self.filename_matcher(
-                    Filename(fullname)
-                ):
-                    self.queue_work(Filename(fullname))
-            # Modify dirnames in-place to remove subdirs with leading dots
-            dirnames[:] = [dn for dn in dirnames if not dn.startswith(".")]
-
-    def refactor_queue(self) -> None:
-        self.semaphore.acquire()
+        for filename, size in self.walk(dir_name):
+            self.queue_work(filename, size)
+
+    def discover(self, items: Sequence[str]) -> Generator[Found, None, None]:
+        """Files to refactor in a list of files and directories, in a stable order.
+
+        Files given directly are always included. Directories are only searched
+        for files changed since `self.since`, if set. Otherwise, with the "git"
+        discovery option, their files are listed by `git_files`, and they're
+        walked outside of a git checkout, or with the default "walk" option.
+        """
+        if self.since is not None:
+            self.discovered_by.add("git diff")
+            for filename in self.changed(items, self.since):
+                yield filename, None
+            return
+
+        for dir_or_file in sorted(items):
+            if not os.path.isdir(dir_or_file):
+                yield Filename(dir_or_file), None
+                continue
+            listed = self.git_files(dir_or_file) if self.discovery == "git" else None
+            if listed is not None:
+                self.discovered_by.add("git")
+                yield from listed
+            else:
+                self.discovered_by.add("walk")
+                yield from self.walk(dir_or_file)
+
+    def git_files(self, top: str) -> Optional[List[Tuple[Filename, int]]]:
+        """Files to refactor in a directory, listed by git rather than walking it.
+
+        Files are the ones git tracks, or would track if added, so ignored files
+        are skipped, along with the same files and directories `walk` skips, in
+        the same order. Returns None if `top` isn't in a git checkout.
+        """
+        try:
+            names = tracked_files(top)
+        except GitError as e:
+            self.log_debug(f"walking {top}, as git can't list its files: {e}")
+            return None
+
+        found: List[Tuple[Filename, int]] = []
+        globs = self.include is not None or self.exclude is not None
+        prefix = os.path.join(top, "")
+        for name in names:
+            if name.startswith(".") or "/." in name:
+                continue
+            if globs and not self.included(name):
+                continue
+            filename = Filename(prefix + name.replace("/", os.sep))
+            if not self.filename_matcher(filename):
+                continue
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue  # deleted, but not from the index
+            if stat.S_ISREG(info.st_mode):
+                found.append((filename, info.st_size))
+        return found
+
+    def changed(self, items: Sequence[str], revision: str) -> Iterator[Filename]:
+        """Files that changed since a git revision, without walking.
+
+        Files in directories are matched with `self.filename_matcher` and the
+        include and exclude globs, while files given directly are included if
+        they changed at all.
+        """
+        for dir_or_file in sorted(items):
+            is_dir = os.path.isdir(dir_or_file)
+            for filename in changed_files(dir_or_file, revision):
+                if not is_dir:
+                    yield filename
+                    continue
+                rel = os.path.relpath(filename, dir_or_file).replace(os.sep, "/")
+                if self.included(rel) and self.filename_matcher(filename):
+                    yield filename
+
+    def included(self, rel: str) -> bool:
+        """Whether a file, given by its path relative to the directory being
+        searched, passes the include and exclude globs.
+
+        Files in excluded directories are excluded too, as `walk` would never
+        find them.
+        """
+        if self.exclude is not None:
+            parts = rel.split("/")
+            for i in range(1, len(parts) + 1):
+                if self.exclude.fullmatch("/".join(parts[:i])):
+                    return False
+        return self.include is None or bool(self.include.fullmatch(rel))
+
+    def walk(self, top: str) -> Iterator[Tuple[Filename, int]]:
+        """Files to refactor in a directory, with their sizes, in `os.walk` order.
+
+        The next few directories are listed ahead of time, by `self.walker`
+        threads once they are started, and excluded directories are never
+        listed. Only directories still to be listed are kept, so memory use
+        doesn't grow with the number of files.
+        """
+        stack: List[Tuple[str, str, Optional["Future[Listing]"]]] = [(top, "", None)]
+        while stack:
+            ahead = 2 * self.WALK_THREADS if self.walker is not None else 1
+            for index in range(max(0, len(stack) - ahead), len(stack)):
+                path, rel, listing = stack[index]
+                if listing is None:
+                    stack[index] = (path, rel, self.scan(path, rel))
+            listing = stack.pop()[2]
+            assert listing is not None
+            files, dirs = listing.result()
+            yield from files
+            stack.extend((path, rel, None) for path, rel in reversed(dirs))
+
+    def scan(self, path: str, rel: str) -> "Future[Listing]":
+        """List a directory with `scan_dir`, in a `walker` thread if there is one."""
+        if self.walker is not None:
+            return self.walker.submit(self.scan_dir, path, rel)
+        future: "Future[Listing]" = Future()
+        future.set_result(self.scan_dir(path, rel))
+        return future
+
+    def scan_dir(self, path: str, rel: str) -> Listing:
+        """List the files to refactor in a directory, and the subdirectories to
+        descend into, both sorted by name.
+
+        `rel` is the path of the directory relative to the one being searched.
+        Names starting with '.' are skipped, symlinks to directories aren't
+        followed, and directories that can't be listed are treated as empty,
+        like `os.walk` does. Files are only stat'd if they will be refactored.
+        """
+        self.log_debug("Descending into %s", path)
+        files: List[Tuple[Filename, int]] = []
+        dirs: List[Tuple[str, str]] = []
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return files, dirs
+
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            name = f"{rel}/{entry.name}" if rel else entry.name
+            if self.exclude is not None and self.exclude.fullmatch(name):
+                continue  # pruned before listing it, if it's a directory
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    dirs.append((entry.path, name))
+                continue
+            if self.include is not None and not self.include.fullmatch(name):
+                continue
+            filename = Filename(entry.path)
+            if self.filename_matcher(filename):
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = 0
+                files.append((filename, size))
+        return files, dirs
+
+    def may_match(self, filename: Filename) -> bool:
+        """Whether any fixer could match a file, without parsing it.
+
+        Fixers built by `Query` know which literals their selector needs, like
+        the name of a function, and files missing them can be skipped.
+        """
+        if self.prefilter is None:
+            requirements = [
+                getattr(fixer, "LITERALS", None)
+                for stage in self.stages
+                for fixer in stage.fixers
+            ]
+            self.prefilter = Prefilter(requirements if self.PREFILTER else [])
+        if self.prefilter.fixers is None:
+            return True
+
+        try:
+            data = self.source_bytes(filename)
+        except OSError:
+            return True  # reported when refactoring
+        return self.prefilter.may_match(data)
+
+    def refactor_task(self, filename: Filename) -> Optional[List[Result]]:
+        """Refactor a single queued file, returning None if it should be retried.
+
+        Returns one result for each stage.
+        """
+        try:
+            if not self.may_match(filename):
+                return [(filename, [], None) for _stage in self.stages]
+            if self.find:
+                return self.find_task(filename)
+            if len(self.stages) > 1:
+                return self.refactor_stages(filename)
+            hunks = self.refactor_file(filename)
+            return [(filename, hunks, None)]
+
+        except RetryFile:
+            self.log_debug(f"Retrying {filename} later...")
+            return None
+        except BowlerException as e:
+            log.exception(f"Bowler exception during transform of {filename}: {e}")
+            return self.failed(filename, e, e.hunks)
+        except Exception as e:
+            log.exception(f"Skipping {filename}: failed to transform because {e}")
+            return self.failed(filename, e)
+        finally:
+            self.release_source()
+
+    def failed(
+        self, filename: Filename, exc: Exception, hunks: Optional[List[Hunk]] = None
+    ) -> List[Result]:
+        """Fail a file in every stage, as each stage's query would have alone."""
+        return [(filename, hunks or [], exc) for _stage in self.stages]
+
+    def refactor_batch(self, batch: Batch, emit: Callable[[Any], None]) -> Batch:
+        """Refactor a batch of files, returning the files that should be retried.
+
+        Results for each file are emitted as soon as they are ready, or None if
+        it should be retried, followed by the stats for the whole batch.
+        """
+        start = time.monotonic()
+        stats = WorkerStats(os.getpid(), batches=1)
+        before = self.cache_counts()
+        skipped = self.prefilter.skipped if self.prefilter else 0
+        unmatched = self.unmatched
+        retry: Batch = []
+        for index, filename, size in batch:
+            written = self.written
+            results = self.refactor_task(filename)
+            emit((index, results))
+            if results is None:
+                retry.append((index, filename, size))
+            else:
+                stats.files += 1
+                stats.bytes += size
+                if self.written > written:
+                    stats.written += 1
+                    stats.saved += size  # not read again to apply hunks
+        self.writer.sync()
+        stats.seconds = time.monotonic() - start
+        after = self.cache_counts()
+        stats.parse_hits, stats.parse_misses, stats.result_hits, stats.result_misses = (
+            a - b for a, b in zip(after, before)
+        )
+        if self.prefilter is not None:
+            stats.skipped = self.prefilter.skipped - skipped
+        stats.unmatched = self.unmatched - unmatched
+        emit(stats)
+        return retry
+
+    def cache_counts(self) -> Tuple[int, int, int, int]:
+        """Parse and result cache hits and misses so far in this process."""
+        counts = [0, 0, 0, 0]
+        if self.parse_cache is not None:
+            counts[0:2] = self.parse_cache.hits, self.parse_cache.misses
+        for stage in self.stages:
+            if stage.result_cache is not None:
+                counts[2] += stage.result_cache.hits
+                counts[3] += stage.result_cache.misses
+        return counts[0], counts[1], counts[2], counts[3]
+
+    def refactor_queue(self, tasks: Any, results: Connection) -> None:
+        """Refactor batches from the parent until it sends None."""
         while True:
-            filename = self.queue.get()
+            batch = tasks.get()
 
-            if filename is None:
+            if batch is None:
                 break
 
-            try:
-                hunks = self.refactor_file(filename)
-                self.results.put((filename, hunks, None))
+            self.refactor_batch(batch, results.send)
 
-            except RetryFile:
-                self.log_debug(f"Retrying {filename} later...")
-                self.queue.put(filename)
-            except BowlerException as e:
-                log.exception(f"Bowler exception during transform of {filename}: {e}")
-                self.results.put((filename, e.hunks, e))
-            except Exception as e:
-                log.exception(f"Skipping {filename}: failed to transform because {e}")
-                self.results.put((filename, [], e))
+    def refactor_pending(
+        self, found: Optional[Iterator[Found]] = None
+    ) -> Iterator[None]:
+        """Refactor pending files in this process, handling results as they're ready.
 
-            finally:
-                self.queue.task_done()
-        self.semaphore.release()
+        Files from `discover` are found a batch at a time, and files to retry are
+        refactored once every other file is done. Yields after each batch.
+        """
+        retries: List[Batch] = []
+        more = True
+        while True:
+            if found is not None and more:
+                more = self.queue_found(found, self.queue_count + self.BATCH_FILES)
+            batches = list(self.batches(ordered=True))
+            if not batches:
+                if not retries:
+                    break
+                batches, retries = retries, []
+            for batch in batches:
+                retry = self.refactor_batch(batch, self.handle_message)
+                if retry:
+                    retries.append(retry)
+                yield
+
+    def worker_target(self) -> Optional[Tuple[Callable[..., None], Tuple]]:
+        """Pick the entry point and arguments for child processes.
+
+        Forked children inherit the fixers from the parent as-is. Otherwise,
+        fixers are rebuilt in each child from their transforms, which requires
+        that filters and callbacks be picklable (eg, module level functions).
+        Returns None if the work can't be shipped to child processes.
+        """
+        if self.context.get_start_method() == "fork":
+            return self.refactor_queue, ()
+
+        specs = stage_specs(self)
+        try:
+            pickle.dumps(specs)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            self.logger.warning(
+                f"can't ship fixers to child processes, running in process: {e}"
+            )
+            return None
+
+        return refactor_worker, (specs, self.options, stage_patterns(self))
 
-    def queue_work(self, filename: Filename) -> None:
-        self.queue.put(filename)
+    def queue_work(self, filename: Filename, size: Optional[int] = None) -> None:
+        """Add a file to the pending work; it will be grouped by `batches`."""
+        if size is None:
+            try:
+                size = os.stat(filename).st_size
+            except OSError:
+                size = 0
+        self.pending.append((self.queue_count, filename, size))
         self.queue_count += 1
 
-    def refactor(self, items: Sequence[str], *a, **k) -> None:
-        """Refactor a list of files and directories."""
+    def queue_found(self, found: Iterator[Found], limit: int) -> bool:
+        """Queue work for files from `discover` until `limit` files are queued.
 
-        for dir_or_file in sorted(items):
-            if os.path.isdir(dir_or_file):
-                self.refactor_dir(dir_or_file)
+        Returns False once every file has been found.
+        """
+        start = time.monotonic()
+        try:
+            for filename, size in found:
+                self.queue_work(filename, size)
+                if self.queue_count >= limit:
+                    return True
+            return False
+        finally:
+            self.discovery_seconds += time.monotonic() - start
+
+    def feed(self, found: Iterator[Found]) -> Generator[None, None, bool]:
+        """Hand out batches to workers as they make room, handling their results.
+
+        Files are found a batch at a time while workers are busy, until
+        `QUEUED_FILES` files are queued but not yet handled, so memory use doesn't
+        grow with the size of the tree. Batches of a worker that died go to the
+        others. Yields after each message, and returns False if every worker died
+        before all files were found.
+        """
+        limit = max(self.QUEUED_FILES, 2 * self.NUM_PROCESSES * self.BATCH_FILES)
+        more = True
+        self.dispatch()  # what was found before the workers started
+        while (
+            more
+            or self.backlog
+            or self.large
+            or any(worker.batches for worker in self.workers)
+        ):
+            searching = more and self.queue_count - self.next_index < limit
+            if searching:
+                more = self.queue_found(found, self.queue_count + self.BATCH_FILES)
+                self.hold_batches()
+            self.dispatch()
+            if not any(worker.alive for worker in self.workers):
+                break
+
+            # keep looking for files while waiting, unless enough are queued
+            received = self.next_message(0 if searching else None)
+            while received is not None:
+                self.handle_worker_message(*received)
+                yield
+                received = self.next_message(0)
+        return not more
+
+    def hold_batches(self) -> None:
+        """Group pending files into batches, to wait in the backlog for a worker.
+
+        Large files wait apart from the rest, largest first, and go out ahead of
+        every small batch still waiting, however early it was found.
+        """
+        for batch in self.batches():
+            index, _, size = batch[0]
+            if size > self.BATCH_SIZE:
+                heapq.heappush(self.large, (-size, index, batch))
             else:
-                self.queue_work(Filename(dir_or_file))
+                self.backlog.append(batch)
 
-        children: List[multiprocessing.Process] = []
-        if self.in_process:
-            self.queue.put(None)
-            self.refactor_queue()
+    def dispatch(self) -> None:
+        """Send waiting batches to the least busy workers with room for them."""
+        while self.large or self.backlog:
+            ready = [
+                worker
+                for worker in self.workers
+                if worker.alive and len(worker.batches) < self.WORKER_BATCHES
+            ]
+            if not ready:
+                break
+            worker = min(ready, key=lambda worker: len(worker.batches))
+            if self.large:
+                batch = heapq.heappop(self.large)[2]
+            else:
+                batch = self.backlog.popleft()
+            self.queue_batch(batch, worker)
+
+    def queue_batch(self, batch: Batch, worker: Worker) -> None:
+        worker.batches.append(batch)
+        if self.job is None:
+            worker.tasks.put(batch)
         else:
-            child_count = max(1, min(self.NUM_PROCESSES, self.queue_count))
-            self.log_debug(f"starting {child_count} processes")
-            for i in range(child_count):
-                child = multiprocessing.Process(target=self.refactor_queue)
-                child.start()
-                children.append(child)
-                self.queue.put(None)
+            # each worker only needs the fixers once per job
+            payload = self.job.payload if worker.job != self.job.id else None
+            worker.tasks.put((self.job.id, self.job.stages, payload, batch))
+            worker.job = self.job.id
 
-        results_count = 0
+    def batches(self, ordered: bool = False) -> Iterator[Batch]:
+        """Group pending files into batches for workers.
 
-        while True:
-            try:
-                filename, hunks, exc = self.results.get_nowait()
-                results_count += 1
-
-                if exc:
-                    self.log_error(f"{type(exc).__name__}: {exc}")
-                    if exc.__cause__:
-                        self.log_error(
-                            f"  {type(exc.__cause__).__name__}: {exc.__cause__}"
-                        )
-                    if isinstance(exc, BowlerException) and exc.hunks:
-                        diff = "\n".join("\n".join(hunk) for hunk in exc.hunks)
-                        self.log_error(f"Generated transform:\n{diff}")
-                    self.exceptions.append(exc)
-                else:
-                    self.log_debug(f"results: got {len(hunks)} hunks for {filename}")
-                    self.process_hunks(filename, hunks)
+        Unless `ordered`, files larger than `BATCH_SIZE` come first, largest
+        first and one per batch. Small files follow in discovery order, grouped
+        to save queue round trips; this keeps output flowing in order. Only the
+        files found so far are grouped, so `hold_batches` keeps large files
+        ahead of small batches found earlier that are still waiting: a huge file
+        found late in the walk starts as soon as a worker has room, instead of
+        holding up the end of the run.
+        """
+        pending, self.pending = self.pending, []
+        if not ordered:
+            large = [item for item in pending if item[2] > self.BATCH_SIZE]
+            large.sort(key=lambda item: item[2], reverse=True)
+            for item in large:
+                yield [item]
+            pending = [item for item in pending if item[2] <= self.BATCH_SIZE]
 
-            except Empty:
-                if self.queue.empty() and results_count == self.queue_count:
-                    break
+        batch: Batch = []
+        batch_size = 0
+        for item in pending:
+            size = item[2]
+            if batch and (
+                batch_size + size > self.BATCH_SIZE or len(batch) >= self.BATCH_FILES
+            ):
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(item)
+            batch_size += size
+        if batch:
+            yield batch
 
-                elif not self.in_process and not any(
-                    child.is_alive() for child in children
-                ):
-                    self.log_debug(f"child processes stopped without consuming work")
-                    break
+    def next_message(self, timeout: Optional[float]) -> Optional[Tuple[Worker, Any]]:
+        """Wait up to `timeout` seconds for the next message from a worker.
+
+        Returns the worker with its message, which is None once the worker has
+        exited, or None if no worker sent anything in time. Messages are either
+        the index of a file in discovery order paired with a `Result` for each
+        stage, or with None if the file should be retried, or `WorkerStats` for
+        a batch.
+        """
+        while not self.inbox:
+            workers = {}
+            for worker in self.workers:
+                if worker.alive:
+                    workers[worker.results] = workers[worker.process.sentinel] = worker
+            ready = connection.wait(list(workers), timeout) if workers else []
+            if not ready:
+                return None
+
+            for worker in set(workers[obj] for obj in ready):
+                exited = worker.process.sentinel in ready
+                for message in worker.receive(exited):
+                    if message is not None and self.job is not None:
+                        job_id, message = message
+                        if job_id != self.job.id:
+                            continue  # left from a query that quit early
+                    self.inbox.append((worker, message))
+        return self.inbox.popleft()
+
+    def handle_worker_message(self, worker: Worker, message: Any) -> None:
+        """Keep track of where a worker is in its batches, then handle the message."""
+        if message is None:
+            self.recover_lost(worker)
+            return
+
+        if isinstance(message, WorkerStats):
+            worker.batches.popleft()
+            worker.position = worker.retried = 0
+        else:
+            if message[1] is None:
+                self.backlog.append([worker.batches[0][worker.position]])
+                worker.retried += 1
+            worker.position += 1
+        self.handle_message(message)
+
+    def recover_lost(self, worker: Worker) -> None:
+        """Fail the file a worker died on, and send the rest of its work elsewhere."""
+        worker.process.join()
+        pid = worker.process.pid
+        self.log_error(
+            f"worker process {pid} died with exit code {worker.process.exitcode}"
+        )
+        if not worker.batches:
+            return
+
+        # the stats for a batch follow its files, so count files done from here
+        batch = worker.batches.popleft()
+        self.files_done += worker.position - worker.retried
+        lost = list(worker.batches)
+        if worker.position < len(batch):
+            index, filename, _ = batch[worker.position]
+            exc = BowlerException(
+                f"worker process {pid} died while refactoring {filename}",
+                filename=filename,
+            )
+            self.handle_message((index, self.failed(filename, exc)))
+            self.files_done += 1
+            lost.insert(0, batch[worker.position + 1 :])
+        self.backlog.extendleft(reversed([batch for batch in lost if batch]))
+        worker.batches.clear()
+        worker.position = worker.retried = 0
+
+    def check_finished(self, found_all: bool) -> None:
+        """Report files that weren't refactored because every worker died."""
+        missing = self.queue_count - self.files_done
+        if found_all and not missing:
+            return
 
+        message = f"{missing} files were not refactored, as every worker process died"
+        if not found_all:
+            message += " before all files were found"
+        self.log_error(message)
+        exc = BowlerException(message)
+        for stage in self.stages:
+            stage.exceptions.append(exc)
+
+    def handle_message(self, message: Any) -> None:
+        """Handle a message from a worker, processing results in discovery order.
+
+        Results that arrive early wait in a reorder buffer until every file
+        before them has been processed, so output is stable between runs.
+        """
+        if isinstance(message, WorkerStats):
+            stats = self.worker_stats.setdefault(message.pid, WorkerStats(message.pid))
+            stats.add(message)
+            self.files_done += message.files
+            self.parse_hits += message.parse_hits
+            self.parse_misses += message.parse_misses
+            self.result_hits += message.result_hits
+            self.result_misses += message.result_misses
+            self.files_skipped += message.skipped
+            self.files_unmatched += message.unmatched
+            self.files_written += message.written
+            self.bytes_saved += message.saved
+            return
+
+        index, results = message
+        if results is None:
+            return  # retried later, see `refactor_batch`
+
+        if any(result[1] and not result[2] for result in results) and not self.find:
+            self.files_modified += 1
+        self.reorder[index] = results
+        while self.next_index in self.reorder:
+            results = self.reorder.pop(self.next_index)
+            self.next_index += 1
+            for stage, result in zip(self.stages, results):
+                stage.process_result(*result)
+
+    def flush_results(self) -> None:
+        """Process buffered results that are still waiting on missing files."""
+        for index in sorted(self.reorder):
+            for stage, result in zip(self.stages, self.reorder.pop(index)):
+                stage.process_result(*result)
+
+    def refactor(self, items: Sequence[str], *a, **k) -> None:
+        """Refactor a list of files and directories."""
+        for _ in self.iter_refactor(items):
+            pass
+
+    def iter_refactor(self, items: Sequence[str]) -> Iterator[None]:
+        """Refactor a list of files and directories, yielding as results arrive.
+
+        Closing the generator early stops the workers, like quitting does.
+        """
+
+        # when no hunk can be rejected, workers write whole files themselves
+        self.write_direct = not self.find and all(
+            stage.write
+            and (stage.silent or not stage.interactive)
+            and stage.hunk_processor is accept_hunk
+            for stage in self.stages
+        )
+        for stage in self.stages:
+            stage.write_direct = self.write_direct
+            stage.writer = self.writer  # so each file's stages are applied in order
+        self.options["write_direct"] = self.write_direct
+
+        # files are replaced atomically, so an interrupted run only leaves
+        # temporary files behind, which are listed in the journal
+        journal = self.options.get("journal")
+        if journal and recover_journal(journal):
+            self.log_message("removed temporary files left by an interrupted run")
+        if not self.find:
+            self.writer.start(self.WRITE_THREADS)
+        workers_stopped = True
+
+        if self.pool is not None and not self.in_process:
+            self.job = self.pool.job(self)
+
+        found = self.discover(items)
+        pooled = self.pool is not None and self.job is not None
+        target = None
+        if not pooled and not self.in_process:
+            target = self.worker_target()
+        terminate = False
+
+        try:
+            if target is None and not pooled:
+                self.in_process = True
+                self.walker = ThreadPoolExecutor(self.WALK_THREADS)
+                yield from self.refactor_pending(found)
+
+            else:
+                # find enough files to keep every worker busy before starting
+                # any, so small runs don't start more processes than they need
+                self.queue_found(found, self.NUM_PROCESSES * self.BATCH_FILES)
+                self.hold_batches()
+                if target is not None:
+                    count = max(1, min(self.NUM_PROCESSES, self.queue_count))
+                    self.log_debug(f"starting {count} processes")
+                    self.workers = [Worker(self.context, *target) for _ in range(count)]
                 else:
-                    time.sleep(0.05)
+                    self.workers = self.pool.workers  # type: ignore
+                    self.log_debug(f"using {len(self.workers)} pooled processes")
 
-            except BowlerQuit:
-                for child in children:
-                    child.terminate()
-                break
+                # walk the rest with threads, which mustn't exist while forking
+                self.walker = ThreadPoolExecutor(self.WALK_THREADS)
+                found_all = yield from self.feed(found)
+                self.check_finished(found_all)
+
+            self.flush_results()
+
+        except (BowlerQuit, GeneratorExit) as e:
+            if pooled:
+                workers_stopped = False  # they finish the batches they have
+            else:
+                terminate = True
+            if isinstance(e, GeneratorExit):
+                raise
+
+        finally:
+            found.close()
+            if self.walker is not None:
+                self.walker.shutdown()
+                self.walker = None
+            if not pooled:
+                for worker in self.workers:
+                    worker.stop(terminate)
+            self.workers = []
+            self.backlog.clear()
+            self.large.clear()
+            self.inbox.clear()
+            self.writer.close()
+
+        if journal and workers_stopped:
+            recover_journal(journal)
+        if self.parse_cache is not None and self.parse_misses:
+            self.parse_cache.prune()
+        if self.result_cache is not None and self.result_misses:
+            self.result_cache.prune()
 
         self.log_debug(f"all children stopped and all diff hunks processed")
 
+    def process_result(
+        self, filename: Filename, hunks: List[Any], exc: Optional[Exception]
+    ) -> None:
+        if exc:
+            self.log_error(f"{type(exc).__name__}: {exc}")
+            if exc.__cause__:
+                self.log_error(f"  {type(exc.__cause__).__name__}: {exc.__cause__}")
+            if isinstance(exc, BowlerException) and exc.hunks:
+                diff = "\n".join("\n".join(hunk) for hunk in exc.hunks)
+                self.log_error(f"Generated transform:\n{diff}")
+            self.exceptions.append(exc)  # type: ignore
+            return
+
+        if self.find:
+            for match in hunks:
+                self.match_handler(match)
+            return
+
+        self.log_debug(f"results: got {len(hunks)} hunks for {filename}")
+        self.process_hunks(filename, hunks)
+
+    def print_match(self, match: Match) -> None:
+        if not self.silent:
+            click.echo(format_match(match))
+
     def process_hunks(self, filename: Filename, hunks: List[Hunk]) -> None:
         auto_yes = False
         result = ""
@@ -331,10 +1985,14 @@ class BowlerTool(RefactoringTool):
                     self.log_debug(f"result = {result}")
 
                     if result == "q":
-                        self.apply_hunks(accepted_hunks, filename)
+                        self.writer.submit(
+                            filename, self.apply_hunks, accepted_hunks, filename
+                        )
                         raise BowlerQuit()
                     elif result == "d":
-                        self.apply_hunks(accepted_hunks, filename)
+                        self.writer.submit(
+                            filename, self.apply_hunks, accepted_hunks, filename
+                        )
                         return  # skip all remaining hunks
                     elif result == "n":
                         continue
@@ -347,12 +2005,29 @@ class BowlerTool(RefactoringTool):
             if result == "y" or self.write:
                 accepted_hunks += "\n".join(hunk[2:]) + "\n"
 
-        self.apply_hunks(accepted_hunks, filename)
+        if self.write_direct:
+            return  # already written by `write_source`
+        if accepted_hunks:
+            self.writer.submit(filename, self.apply_hunks, accepted_hunks, filename)
 
     def apply_hunks(self, accepted_hunks, filename):
+        """Patch a file with the accepted hunks, replacing it atomically.
+
+        The file is read once, and written back in the encoding and with the
+        newlines it was read with, like `write_source` does.
+        """
         if accepted_hunks:
-            with open(filename) as f:
-                data = f.read()
+            source = load_source(filename, self.MMAP_SIZE)
+            try:
+                data, encoding = decode_source(source)
+            finally:
+                if isinstance(source, mmap.mmap):
+                    source.close()
+            # hunks only apply to text with universal newlines, so the file's
+            # own newlines are put back when it's written
+            match = re.search(r"\r\n|\r|\n", data)
+            newline = match.group() if match else "\n"
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
 
             try:
                 accepted_hunks = f"--- {filename}\n+++ {filename}\n{accepted_hunks}"
@@ -361,8 +2036,65 @@ class BowlerTool(RefactoringTool):
                 log.exception(f"failed to apply patch hunk: {err}")
                 return
 
-            with open(filename, "w") as f:
-                f.write(new_data)
+            self.writer.write(filename, new_data, encoding, newline=newline)
+
+    def summarize(self) -> None:
+        super().summarize()
+        if self.discovered_by:
+            self.log_message(
+                "found %d files in %.3fs with %s",
+                self.queue_count,
+                self.discovery_seconds,
+                ", ".join(sorted(self.discovered_by)),
+            )
+        if not self.find:
+            self.log_message(
+                "%d files modified, %d skipped without any matches",
+                self.files_modified,
+                self.files_unmatched,
+            )
+        if self.files_written:
+            self.log_message(
+                "wrote %d files directly, without reading %d bytes again",
+                self.files_written,
+                self.bytes_saved,
+            )
+        if self.files_skipped:
+            self.log_message(
+                "skipped %d files that can't match without parsing them",
+                self.files_skipped,
+            )
+        if self.parse_cache is not None:
+            self.log_message(
+                "parse cache: %d hits, %d misses", self.parse_hits, self.parse_misses
+            )
+        if self.result_cache is not None:
+            self.log_message(
+                "result cache: %d hits, %d misses",
+                self.result_hits,
+                self.result_misses,
+            )
+        if not self.worker_stats:
+            return
+
+        for stats in self.worker_stats.values():
+            self.log_message(
+                "worker %d: %d files, %d bytes, %d batches, %.3fs busy",
+                stats.pid,
+                stats.files,
+                stats.bytes,
+                stats.batches,
+                stats.seconds,
+            )
+        busy = [stats.seconds for stats in self.worker_stats.values()]
+        mean = sum(busy) / len(busy)
+        if mean:
+            self.log_message(
+                "worker balance: busiest %.3fs, mean %.3fs (%.2fx)",
+                max(busy),
+                mean,
+                max(busy) / mean,
+            )
 
     def run(self, paths: Sequence[str]) -> int:
         if not self.errors:
@@ -25,9 +25,23 @@ class Passthrough:
 TOKEN = Passthrough(token)
 SYMBOL = Passthrough(python_symbols)
 
-SENTINEL = object()
-START = object()
-DROP = object()
+
+class Marker:
+    """A unique value, that stays the same object when pickled."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+    def __reduce__(self) -> str:
+        return self.name
+
+
+SENTINEL = Marker("SENTINEL")
+START = Marker("START")
+DROP = Marker("DROP")
 
 STARS = {TOKEN.STAR, TOKEN.DOUBLESTAR}
 ARG_END = {TOKEN.RPAR, TOKEN.COMMA}
@@ -60,6 +74,20 @@ class Transform:
     fixer: Optional[Type[BaseFix]] = None
 
 
+@dataclass
+class Match:
+    """Where a query matched, see `Query.iter_matches`.
+
+    Columns count from zero, and captures are summarized as short strings.
+    """
+
+    filename: Filename
+    line: int
+    column: int
+    node_type: str
+    captures: Dict[str, str] = Factory(dict)
+
+
 class BowlerException(Exception):
     def __init__(
         self, message: str = "", *, filename: str = "", hunks: List[Hunk] = None
@@ -83,3 +111,7 @@ class RetryFile(BowlerException):
 
 class BadTransform(BowlerException):
     pass
+
+
+class GitError(BowlerException):
+    pass
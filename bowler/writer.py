@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+TEMP_SUFFIX = ".bowler-tmp"
+
+
+def recover_journal(journal: str) -> int:
+    """Clean up after an interrupted run that used the given journal.
+
+    Files are only ever replaced by a complete temporary copy, so any
+    temporary file still listed in the journal was never moved into place, and
+    the file it was meant for still has its old contents. Those temporary files
+    are removed, and the journal is emptied. Returns how many there were.
+    """
+    try:
+        with open(journal) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return 0
+
+    unfinished = 0
+    for line in lines:
+        try:
+            temp, filename = json.loads(line)
+        except ValueError:
+            continue  # cut short by the interruption
+        if os.path.exists(temp):
+            log.warning(f"{filename} was not written by an interrupted run")
+            os.remove(temp)
+            unfinished += 1
+    os.remove(journal)
+    return unfinished
+
+
+class Writer:
+    """Writes files atomically, in background threads if any are started.
+
+    Each file is written to a temporary file in the same directory, which is
+    then moved over the original with `os.replace`, so other processes, and
+    interrupted runs, only ever see the whole old file or the whole new one.
+    Temporary files are listed in the journal, if there is one, as soon as
+    they are created; see `recover_journal`.
+    """
+
+    BACKLOG = 256  # queued writes between checks for failures
+
+    def __init__(self, fsync: bool = False, journal: Optional[str] = None) -> None:
+        self.fsync = fsync
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.futures: Dict[str, Future] = {}
+        self.unsynced: List[str] = []  # see `sync`
+
+    def start(self, threads: int) -> None:
+        """Run later calls to `submit` in background threads."""
+        if threads > 0 and self.executor is None:
+            self.executor = ThreadPoolExecutor(threads)
+
+    def submit(self, filename: str, fn: Callable[..., Any], *args: Any) -> None:
+        """Call `fn(*args)`, which writes to `filename`, in the background.
+
+        Calls for the same file run in the order they were submitted. Without
+        background threads, `fn` is called right away.
+        """
+        if self.executor is None:
+            fn(*args)
+            return
+
+        previous = self.futures.get(filename)
+
+        def task() -> None:
+            if previous is not None:
+                wait_futures([previous])
+            fn(*args)
+
+        if len(self.futures) >= self.BACKLOG:
+            self.reap()
+        self.futures[filename] = self.executor.submit(task)
+
+    def reap(self) -> None:
+        """Forget finished writes, raising the first error from any of them."""
+        done = [key for key, future in self.futures.items() if future.done()]
+        futures = [self.futures.pop(key) for key in done]
+        for future in futures:
+            future.result()
+
+    def write(
+        self,
+        filename: str,
+        text: str,
+        encoding: Optional[str] = None,
+        newline: Optional[str] = None,
+    ) -> None:
+        """Replace the contents of a file, which keeps its permissions."""
+        path = os.path.realpath(filename)  # write through symlinks
+        directory, name = os.path.split(path)
+        fd, temp = tempfile.mkstemp(
+            prefix=f".{name}.", suffix=TEMP_SUFFIX, dir=directory
+        )
+        try:
+            if self.journal:
+                with self.lock, open(self.journal, "a") as f:
+                    f.write(json.dumps([temp, path]) + "\n")
+            with open(fd, "w", encoding=encoding, newline=newline) as f:
+                f.write(text)
+            try:
+                os.chmod(temp, stat.S_IMODE(os.stat(path).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(temp, path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+        if self.fsync:
+            with self.lock:
+                self.unsynced.append(path)
+
+    def sync(self) -> None:
+        """Flush every file written since the last sync, and their directories,
+        to disk, if this writer was asked to.
+        """
+        with self.lock:
+            paths, self.unsynced = self.unsynced, []
+        directories = {os.path.dirname(path) for path in paths}
+        for path in paths + sorted(directories):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue  # replaced or removed since
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass  # directories can't be synced on some platforms
+            finally:
+                os.close(fd)
+
+    def close(self) -> None:
+        """Wait for background writes to finish, and sync them to disk."""
+        try:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self.reap()
+        finally:
+            self.futures.clear()
+            self.sync()
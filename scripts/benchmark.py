@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measure wall-clock time of Bowler queries over a synthetic tree of files.
+
+    python scripts/benchmark.py --files 2000 --processes 4
+"""
+
+import logging
+import statistics
+import time
+from pathlib import Path
+from typing import List
+
+import click
+import volatile
+
+from bowler import BowlerTool, Query, run_all
+
+SOURCE = """\
+import os
+
+
+def foo(a, b=1):
+    return os.path.join(a, str(b))
+
+
+class Bar:
+    def baz(self):
+        return foo("{index}")
+"""
+
+FUNCTION = """
+
+def func{index}():
+    return foo({index})
+"""
+
+
+def make_tree(root: Path, files: int, functions: int, per_dir: int = 100) -> None:
+    extra = "".join(FUNCTION.format(index=index) for index in range(functions))
+    for index in range(files):
+        subdir = root / f"pkg{index // per_dir}"
+        subdir.mkdir(exist_ok=True)
+        (subdir / f"mod{index}.py").write_text(SOURCE.format(index=index) + extra)
+
+
+def time_query(root: Path, repeat: int, **kwargs) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        Query(str(root)).select_function("foo").rename("foo2").diff(
+            silent=True, **kwargs
+        )
+        timings.append(time.monotonic() - start)
+    return statistics.median(timings)
+
+
+def distinct_queries(root: Path, queries: int) -> List[Query]:
+    return [
+        Query(str(root)).select_function(f"func{index}").rename(f"func{index}_")
+        for index in range(queries)
+    ]
+
+
+def time_separately(root: Path, repeat: int, queries: int, **kwargs) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        for query in distinct_queries(root, queries):
+            query.diff(silent=True, **kwargs)
+        timings.append(time.monotonic() - start)
+    return statistics.median(timings)
+
+
+def time_run_all(root: Path, repeat: int, queries: int, **kwargs) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        run_all(distinct_queries(root, queries), silent=True, **kwargs)
+        timings.append(time.monotonic() - start)
+    return statistics.median(timings)
+
+
+def time_transforms(root: Path, repeat: int, transforms: int, **kwargs) -> float:
+    timings = []
+    for _ in range(repeat):
+        query = Query(str(root))
+        for index in range(transforms):
+            query.select_function(f"missing{index}").rename(f"missing{index}_")
+        query.select_function("foo").rename("foo2")
+        start = time.monotonic()
+        query.diff(silent=True, **kwargs)
+        timings.append(time.monotonic() - start)
+    return statistics.median(timings)
+
+
+@click.command()
+@click.option("--files", default=2000, help="Number of small files to generate")
+@click.option("--processes", default=BowlerTool.NUM_PROCESSES, help="Worker count")
+@click.option("--repeat", default=3, help="Runs per mode; the median is reported")
+@click.option("--queries", default=0, help="Also compare N queries with run_all()")
+@click.option(
+    "--transforms", default=0, help="Also compare N transforms with BOTTOM_UP off"
+)
+def main(
+    files: int, processes: int, repeat: int, queries: int, transforms: int
+) -> None:
+    logging.basicConfig(level=logging.ERROR)
+    BowlerTool.NUM_PROCESSES = processes
+
+    with volatile.dir() as d:
+        root = Path(d)
+        make_tree(root, files, queries)
+
+        for label, kwargs in (
+            ("in-process", {"in_process": True}),
+            (f"{processes} processes", {"in_process": False}),
+        ):
+            elapsed = time_query(root, repeat, **kwargs)
+            click.echo(
+                f"{label:>16}: {elapsed:.3f}s total, "
+                f"{elapsed / files * 1000:.3f}ms per file"
+            )
+
+            if queries:
+                separate = time_separately(root, repeat, queries, **kwargs)
+                combined = time_run_all(root, repeat, queries, **kwargs)
+                click.echo(
+                    f"{label:>16}: {queries} queries, {separate:.3f}s separately, "
+                    f"{combined:.3f}s with run_all()"
+                )
+
+            if transforms:
+                BowlerTool.BOTTOM_UP = False
+                traversal = time_transforms(root, repeat, transforms, **kwargs)
+                BowlerTool.BOTTOM_UP = True
+                bottom_up = time_transforms(root, repeat, transforms, **kwargs)
+                click.echo(
+                    f"{label:>16}: {transforms} transforms, {traversal:.3f}s "
+                    f"traversing every node, {bottom_up:.3f}s bottom-up"
+                )
+
+
+if __name__ == "__main__":
+    main()